@@ -0,0 +1,329 @@
+"""
+------------------------------------------------------------------------------------------------------------------------
+benchmarks.py
+Copyright (C) 2019-20 - NFStream Developers
+This file is part of NFStream, a Flexible Network Data Analysis Framework (https://www.nfstream.org/).
+NFStream is free software: you can redistribute it and/or modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+version.
+NFStream is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+You should have received a copy of the GNU Lesser General Public License along with NFStream.
+If not, see <http://www.gnu.org/licenses/>.
+------------------------------------------------------------------------------------------------------------------------
+"""
+
+
+import argparse
+import heapq
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import queue
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+import nfstream
+from nfstream import NFStreamer, NFPlugin
+from nfstream.utils import MEMORY_COMPONENTS
+
+
+PCAP_GLOBAL_HEADER = struct.pack("<IHHiIII", 0xa1b2c3d4, 2, 4, 0, 0, 65535, 1)  # Ethernet linktype.
+ETH_P_IP, ETH_P_IPV6 = 0x0800, 0x86DD
+IPPROTO_IPIP, IPPROTO_TCP, IPPROTO_UDP, IPPROTO_IPV6 = 4, 6, 17, 41
+GTP_U_V1_PORT = 2152
+TCP_FIN, TCP_SYN, TCP_PSH, TCP_ACK = 0x01, 0x02, 0x08, 0x10
+MAX_PACKETS_PER_FLOW = 10000
+MEASURE_TIMEOUT = 3600  # seconds, a configuration run exceeding it is considered as hanging.
+# Benchmarked NFStreamer configuration: each variation changes one parameter of the baseline.
+BASELINE = {"n_meters": 1, "statistical_analysis": False, "splt_analysis": 0, "n_dissections": 0, "plugins": False}
+VARIATIONS = ({"statistical_analysis": True},
+              {"splt_analysis": 20},
+              {"n_dissections": 20},
+              {"plugins": True},
+              {"statistical_analysis": True, "splt_analysis": 20, "n_dissections": 20, "plugins": True})
+
+
+class PacketCounter(NFPlugin):
+    """ Minimal plugin used to measure plugins hooks overhead """
+    def on_init(self, packet, flow):
+        flow.udps.counter = 1
+
+    def on_update(self, packet, flow):
+        flow.udps.counter += 1
+
+
+def ip_header(version, src, dst, proto, payload_len):
+    """ IPv4/IPv6 header (checksums are not verified by the engine) """
+    if version == 4:
+        return struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + payload_len, 0, 0x4000, 64, proto, 0, src, dst)
+    return struct.pack("!IHBB16s16s", 0x60000000, payload_len, proto, 64, src, dst)
+
+
+def flow_addresses(flow_idx, version):
+    """ Client and server addresses of a synthetic flow """
+    if version == 4:
+        return struct.pack("!BBH", 10, (flow_idx >> 16) & 0xFF, flow_idx & 0xFFFF), \
+               struct.pack("!BBH", 172, 16, flow_idx % 4096)
+    return struct.pack("!HQHI", 0xfd00, 0, 0, flow_idx), struct.pack("!HQHI", 0xfd00, 1, 0, flow_idx % 4096)
+
+
+def build_packet(flow, pkt_idx, n_packets, tunnel):
+    """ Build Ethernet frame of packet pkt_idx of flow (even packets are client to server) """
+    version, proto, client, server, sport, dport, payload_size = flow
+    src, dst, src_port, dst_port = client, server, sport, dport
+    if pkt_idx % 2:
+        src, dst, src_port, dst_port = server, client, dport, sport
+    payload = bytes(payload_size if pkt_idx > 1 or proto == IPPROTO_UDP else 0)
+    if proto == IPPROTO_TCP:
+        if pkt_idx == 0:
+            flags = TCP_SYN
+        elif pkt_idx == 1:
+            flags = TCP_SYN | TCP_ACK
+        elif pkt_idx == n_packets - 1:
+            flags = TCP_FIN | TCP_ACK
+        else:
+            flags = TCP_PSH | TCP_ACK
+        l4 = struct.pack("!HHIIBBHHH", src_port, dst_port, pkt_idx, pkt_idx, 5 << 4, flags, 65535, 0, 0) + payload
+    else:
+        l4 = struct.pack("!HHHH", src_port, dst_port, 8 + len(payload), 0) + payload
+    packet = ip_header(version, src, dst, proto, len(l4)) + l4
+    ether_type = ETH_P_IP if version == 4 else ETH_P_IPV6
+    if tunnel == "gtp":  # Outer IPv4/UDP/GTP-U T-PDU
+        gtp = struct.pack("!BBHI", 0x30, 0xFF, len(packet), 1) + packet
+        udp = struct.pack("!HHHH", GTP_U_V1_PORT, GTP_U_V1_PORT, 8 + len(gtp), 0) + gtp
+        packet = ip_header(4, b"\xc0\xa8\x00\x01", b"\xc0\xa8\x00\x02", IPPROTO_UDP, len(udp)) + udp
+        ether_type = ETH_P_IP
+    elif tunnel == "ipip":  # Outer IPv4 encapsulating IPv4 (4in4) or IPv6 (6in4)
+        packet = ip_header(4, b"\xc0\xa8\x00\x01", b"\xc0\xa8\x00\x02",
+                           IPPROTO_IPIP if version == 4 else IPPROTO_IPV6, len(packet)) + packet
+        ether_type = ETH_P_IP
+    return b"\x00\x0e\x8e\x4d\xb4\xa8\x80\xc6\xca\x00\x9e\x9f" + struct.pack("!H", ether_type) + packet
+
+
+def generate_pcap(path, n_flows, packets_per_flow, ipv6_ratio=0.0, udp_ratio=0.0, tunnel="none", pareto_alpha=0.0,
+                  payload_size=512, duration=60, seed=0):
+    """
+        Generate a synthetic pcap file and return its description.
+        Flows start uniformly over duration (seconds) and send one packet each 10ms. When pareto_alpha is set,
+        flows sizes follow a Pareto distribution with packets_per_flow mean (heavy tailed), else they are fixed.
+    """
+    rng = random.Random(seed)
+    flows, sizes = [], []
+    for flow_idx in range(n_flows):
+        version = 6 if rng.random() < ipv6_ratio else 4
+        proto = IPPROTO_UDP if rng.random() < udp_ratio else IPPROTO_TCP
+        client, server = flow_addresses(flow_idx, version)
+        flows.append((version, proto, client, server, 1024 + flow_idx % 60000, 443 if proto == IPPROTO_TCP else 53,
+                      payload_size))
+        if pareto_alpha > 1:
+            scale = packets_per_flow * (pareto_alpha - 1) / pareto_alpha
+            sizes.append(max(1, min(MAX_PACKETS_PER_FLOW, int(scale * rng.paretovariate(pareto_alpha)))))
+        else:
+            sizes.append(packets_per_flow)
+    start = 1600000000 * 1000000
+    # Packets of all flows are merged in time order: (timestamp_us, flow_idx, pkt_idx)
+    events = [(start + rng.randrange(duration * 1000000), flow_idx, 0) for flow_idx in range(n_flows)]
+    heapq.heapify(events)
+    n_packets = 0
+    with open(path, 'wb') as f:
+        f.write(PCAP_GLOBAL_HEADER)
+        while events:
+            ts, flow_idx, pkt_idx = heapq.heappop(events)
+            frame = build_packet(flows[flow_idx], pkt_idx, sizes[flow_idx], tunnel)
+            f.write(struct.pack("<IIII", ts // 1000000, ts % 1000000, len(frame), len(frame)) + frame)
+            n_packets += 1
+            if pkt_idx + 1 < sizes[flow_idx]:
+                heapq.heappush(events, (ts + 10000, flow_idx, pkt_idx + 1))
+    return {"flows": n_flows, "packets": n_packets, "ipv6_ratio": ipv6_ratio, "udp_ratio": udp_ratio,
+            "tunnel": tunnel, "pareto_alpha": pareto_alpha, "packets_per_flow": packets_per_flow,
+            "payload_size": payload_size, "seed": seed}
+
+
+def streamer_parameters(config):
+    """ NFStreamer parameters of a benchmark configuration """
+    parameters = {key: value for key, value in config.items() if key != "plugins"}
+    parameters["udps"] = PacketCounter() if config["plugins"] else None
+    return parameters
+
+
+def run_configuration(path, config, results):
+    """ Benchmark worker (own process): run streamer over path and push measures on results queue """
+    start = time.perf_counter()
+    packets, flows = 0, 0
+    streamer = NFStreamer(source=path, **streamer_parameters(config))
+    for flow in streamer:
+        packets += flow.bidirectional_packets
+        flows += 1
+    elapsed = time.perf_counter() - start
+    # On replay, each meter reports drops of the packets it owns only.
+    meters = streamer.metrics()["meters"]
+    dropped = sum([meter["packets_dropped_filtered_by_kernel"] for meter in meters])
+    # Bytes per active flow by component (most expensive meter) and peak accounted bytes over all meters.
+    memory = {component: max([meter[component] for meter in meters] + [0]) for component in MEMORY_COMPONENTS}
+    memory["active_flows_peak"] = sum([meter["active_flows_peak"] for meter in meters])
+    memory["memory_peak_bytes"] = sum([meter["memory_peak_bytes"] for meter in meters])
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS.
+    unit = 1024 * 1024 if platform.system() == "Darwin" else 1024
+    results.put({"elapsed_s": elapsed,
+                 "packets": packets,
+                 "flows": flows,
+                 "packets_dropped": dropped,
+                 "memory": memory,
+                 "streamer_peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit,
+                 "meters_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit})
+
+
+def measure(path, config, timeout=MEASURE_TIMEOUT):
+    """
+        Run a configuration within a fresh process so that peak RSS is not shared across configurations.
+        Raise RuntimeError if worker dies without measures or does not complete within timeout.
+    """
+    results = mp.Queue()
+    worker = mp.Process(target=run_configuration, args=(path, config, results))
+    worker.start()
+    deadline = time.monotonic() + timeout
+    measures = None
+    while measures is None and worker.exitcode is None and time.monotonic() < deadline:
+        try:
+            measures = results.get(timeout=1)
+        except queue.Empty:
+            pass
+    if measures is None:  # Worker exited (measures may still be in flight) or timed out.
+        try:
+            measures = results.get(timeout=1)
+        except queue.Empty:
+            if worker.exitcode is None:
+                worker.terminate()
+            worker.join()
+            raise RuntimeError("Benchmark configuration {} failed without measures (exitcode: {}).".format(
+                json.dumps(config), worker.exitcode))
+    worker.join()
+    if worker.exitcode != 0:
+        raise RuntimeError("Benchmark configuration {} failed (exitcode: {}).".format(json.dumps(config),
+                                                                                     worker.exitcode))
+    return measures
+
+
+def benchmark(path, startup_path, config, repeat):
+    """ Benchmark a configuration: best of repeat runs """
+    runs = [measure(path, config) for _ in range(repeat)]
+    best = min(runs, key=lambda run: run["elapsed_s"])
+    startup = min([measure(startup_path, config)["elapsed_s"] for _ in range(repeat)])
+    return {"config": config,
+            "repeat": repeat,
+            "elapsed_s": best["elapsed_s"],
+            "startup_s": startup,
+            "packets": best["packets"],
+            "flows": best["flows"],
+            "packets_dropped": max([run["packets_dropped"] for run in runs]),
+            "packets_per_second": best["packets"] / best["elapsed_s"],
+            "flows_per_second": best["flows"] / best["elapsed_s"],
+            "streamer_peak_rss_mb": max([run["streamer_peak_rss_mb"] for run in runs]),
+            "meters_peak_rss_mb": max([run["meters_peak_rss_mb"] for run in runs])}
+
+
+def memory_benchmark(workdir, flows_counts, payload_size, seed):
+    """
+        Peak memory vs concurrent flows: for each flows count, flows of two packets all start within the first second
+        and thus remain active until end of capture (default idle_timeout). Each baseline variation is measured on a
+        single meter in order to report accounted bytes per flow by component along with meters peak RSS.
+    """
+    path = os.path.join(workdir, "memory.pcap")
+    results = []
+    for n_flows in flows_counts:
+        generate_pcap(path, n_flows, 2, payload_size=payload_size, duration=1, seed=seed)
+        for variation in ({},) + VARIATIONS:
+            config = dict(BASELINE, **variation)
+            measures = measure(path, config)
+            results.append({"config": config,
+                            "concurrent_flows": n_flows,
+                            "memory": measures["memory"],
+                            "bytes_per_flow": measures["memory"]["memory_peak_bytes"] / n_flows,
+                            "meters_peak_rss_mb": measures["meters_peak_rss_mb"]})
+            print("{} flows {}: {:.0f} bytes/flow".format(n_flows, json.dumps(config), results[-1]["bytes_per_flow"]),
+                  file=sys.stderr)
+    os.remove(path)
+    return results
+
+
+def configurations(meters, full_grid, replay_speeds):
+    """
+        Benchmarked configurations: baseline variations for each n_meters value or full cartesian grid.
+        Each configuration is run offline and, if replay speeds are specified, through real-time replay (live path)
+        in order to find the maximum sustainable rate (no drops).
+    """
+    if full_grid:
+        keys = ("n_meters", "statistical_analysis", "splt_analysis", "n_dissections", "plugins")
+        values = (meters, (False, True), (0, 20), (0, 20), (False, True))
+        configs = [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+    else:
+        configs = []
+        for n_meters in meters:
+            configs.append(dict(BASELINE, n_meters=n_meters))
+            for variation in VARIATIONS:
+                configs.append(dict(BASELINE, n_meters=n_meters, **variation))
+    return [dict(config, replay_speed=speed) for config in configs for speed in [0] + list(replay_speeds)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="NFStream benchmark suite on synthetic traffic (JSON output).")
+    parser.add_argument("--flows", type=int, default=10000, help="number of generated flows")
+    parser.add_argument("--packets-per-flow", type=int, default=20, help="packets per flow (mean if heavy tailed)")
+    parser.add_argument("--ipv6-ratio", type=float, default=0.2, help="ratio of IPv6 flows")
+    parser.add_argument("--udp-ratio", type=float, default=0.3, help="ratio of UDP flows")
+    parser.add_argument("--tunnel", choices=("none", "gtp", "ipip"), default="none", help="tunnel encapsulation")
+    parser.add_argument("--pareto-alpha", type=float, default=1.5,
+                        help="Pareto shape of flows sizes (heavy tailed), <= 1 for fixed sizes")
+    parser.add_argument("--payload-size", type=int, default=512, help="payload size of data packets")
+    parser.add_argument("--seed", type=int, default=0, help="generator seed")
+    parser.add_argument("--meters", type=int, nargs="+", default=[1, 2], help="n_meters values to benchmark")
+    parser.add_argument("--full-grid", action="store_true", help="benchmark all parameters combinations")
+    parser.add_argument("--replay-speeds", type=float, nargs="*", default=[],
+                        help="also benchmark real-time replay at these speed multipliers (live path)")
+    parser.add_argument("--memory-flows", type=int, nargs="*", default=[],
+                        help="also report peak memory for these numbers of concurrent flows")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per configuration (best run is reported)")
+    parser.add_argument("--pcap", default=None, help="keep generated pcap at this path")
+    parser.add_argument("--output", default=None, help="JSON results path (default: stdout)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="nfstream-benchmarks-")
+    path = args.pcap if args.pcap is not None else os.path.join(workdir, "synthetic.pcap")
+    startup_path = os.path.join(workdir, "startup.pcap")
+    generation_start = time.perf_counter()
+    traffic = generate_pcap(path, args.flows, args.packets_per_flow, args.ipv6_ratio, args.udp_ratio, args.tunnel,
+                            args.pareto_alpha, args.payload_size, seed=args.seed)
+    traffic["generation_s"] = time.perf_counter() - generation_start
+    generate_pcap(startup_path, 1, 1)  # Startup time is measured on a single packet capture.
+    results = []
+    for config in configurations(args.meters, args.full_grid, args.replay_speeds):
+        results.append(benchmark(path, startup_path, config, args.repeat))
+        print("{}: {:.0f} packets/s".format(json.dumps(config), results[-1]["packets_per_second"]), file=sys.stderr)
+    report = {"nfstream_version": nfstream.__version__,
+              "python_version": platform.python_version(),
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "timestamp": time.time(),
+              "traffic": traffic,
+              "results": results}
+    if args.memory_flows:
+        report["memory"] = memory_benchmark(workdir, args.memory_flows, args.payload_size, args.seed)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.pcap is None:
+        os.remove(path)
+    os.remove(startup_path)
+    os.rmdir(workdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -13,43 +13,106 @@ If not, see <http://www.gnu.org/licenses/>.
 ------------------------------------------------------------------------------------------------------------------------
 """
 
+from functools import lru_cache
 from hashlib import blake2b
 import secrets
+from .engine import create_engine
+
+
+def anonymize_ip(ffi, lib, anonymizer, value):
+    """ Prefix preserving anonymization of an IP string using native anonymizer, None if value is not an IP """
+    anonymized = ffi.new("char[]", 48)
+    if lib.anonymizer_ip(anonymizer, bytes(value, 'utf-8'), anonymized, 48):
+        return ffi.string(anonymized).decode('utf-8', errors='ignore')
+    return None
+
 
 class NFAnonymizer(object):
     """
         NFAnonymizer: NFStream anonymization implementation.
         Anonymizer is initiated at each time to_csv or to_pandas is called with a random secret key (64 bytes).
-        Each specified column is anonymized using blake2b algorithm (digest_size: 64 bytes).
+        Each specified column is anonymized using blake2b algorithm (digest_size: 64 bytes by default).
+        As anonymized values (IPs, MACs) repeat enormously across flows, digests are memoized in a bounded LRU cache
+        owned by the anonymizer (and thus bound to its secret).
+        When prefix_preserving is set, IP values are anonymized using Crypto-PAn (native engine, keyed with the first
+        32 bytes of the secret) so that two anonymized addresses share the same prefix length as their originals.
+        Non IP values of anonymized columns fall back to blake2b.
     """
     __slots__ = ('_secret',
                  '_cols_names',
                  '_cols_index',
-                 "_enabled")
+                 "_enabled",
+                 '_digest_size',
+                 '_digest',
+                 '_prefix_preserving',
+                 '_engine',
+                 '_ip_anonymizer')
 
-    def __init__(self, cols_names):
+    def __init__(self, cols_names, digest_size=64, cache_size=65536, prefix_preserving=False):
+        if not isinstance(digest_size, int) or isinstance(digest_size, bool) or digest_size < 1 or \
+                digest_size > 64:
+            raise ValueError("Please specify a valid anonymization digest_size (possible values in : [1,...,64]).")
         self._secret = secrets.token_bytes(64)
         self._cols_names = cols_names
         self._cols_index = None
         self._enabled = False
+        self._digest_size = digest_size
+        self._digest = lru_cache(maxsize=cache_size)(self._hash)
+        self._prefix_preserving = prefix_preserving
+        self._engine = None  # Native engine is loaded lazily (anonymizer is created before meters fork).
+        self._ip_anonymizer = None
         if len(self._cols_names) > 0:
             self._enabled = True
 
+    def _hash(self, value):
+        if self._prefix_preserving:
+            if self._engine is None:
+                ffi, lib = create_engine()
+                ip_anonymizer = lib.anonymizer_init(self._secret[:32], 65536)
+                if ip_anonymizer == ffi.NULL:
+                    raise ValueError("Error while initializing prefix preserving anonymizer.")
+                self._engine = ffi, lib
+                self._ip_anonymizer = ffi.gc(ip_anonymizer, lib.anonymizer_cleanup)
+            anonymized = anonymize_ip(self._engine[0], self._engine[1], self._ip_anonymizer, value)
+            if anonymized is not None:
+                return anonymized
+        return blake2b(value.encode(), digest_size=self._digest_size, key=self._secret).hexdigest()
+
+    def index(self, flow):
+        """ Extract indexes of cols to anonymize from first flow """
+        if self._cols_index is None:
+            self._cols_index = []
+            for col_name in self._cols_names:
+                keys = flow.keys()
+                try:
+                    self._cols_index.append(keys.index(col_name))
+                except ValueError:
+                    print("WARNING: NFlow do not have {} attribute. Skipping anonymization.".format(col_name))
+
     def process(self, flow):
         if self._enabled:
-            if self._cols_index is None: # First flow, we extract indexes of cols to anonymize.
-                self._cols_index = []
-                for col_name in self._cols_names:
-                    keys = flow.keys()
-                    try:
-                        self._cols_index.append(keys.index(col_name))
-                    except ValueError:
-                        print("WARNING: NFlow do not have {} attribute. Skipping anonymization.")
+            self.index(flow)
             values = flow.values()
             for col_idx in self._cols_index:
                 if values[col_idx] is not None:
-                    values[col_idx] = blake2b(str(values[col_idx]).encode(),
-                                              digest_size=64,
-                                              key=self._secret).hexdigest()
+                    values[col_idx] = self._digest(str(values[col_idx]))
             return values
         return flow.values()
+
+    def process_column(self, values):
+        """ Anonymize a whole column of a chunk at once: each distinct value is hashed only once """
+        digests = {}
+        for value in set(str(value) for value in values if value is not None):
+            digests[value] = self._digest(value)
+        return [digests[str(value)] if value is not None else None for value in values]
+
+    def process_batch(self, flows):
+        """ Anonymize a batch of flows column by column, return their values """
+        rows = [flow.values() for flow in flows]
+        if self._enabled and len(rows) > 0:
+            self.index(flows[0])
+            for col_idx in self._cols_index:
+                column = self.process_column([values[col_idx] for values in rows])
+                for values, value in zip(rows, column):
+                    values[col_idx] = value
+        return rows
@@ -33,7 +33,10 @@ typedef struct nf_packet {
   uint16_t dst_port;
   uint8_t protocol;
   uint16_t vlan_id;
-  char src_ip_str[48], dst_ip_str[48], src_mac[18], src_oui[9], dst_mac[18], dst_oui[9];
+  union { uint8_t src_ip[16]; uint64_t src_ip_key[2]; };
+  union { uint8_t dst_ip[16]; uint64_t dst_ip_key[2]; };
+  uint8_t src_mac[6], dst_mac[6];
+  uint8_t has_mac;
   uint8_t ip_version;
   uint16_t fin:1, syn:1, rst:1, psh:1, ack:1, urg:1, ece:1, cwr:1; /* TCP Flags */
   uint16_t raw_size;
@@ -42,6 +45,7 @@ typedef struct nf_packet {
   uint16_t payload_size;
   uint16_t ip_content_len;
   uint8_t *ip_content;
+  uint8_t parse_error;
 } nf_packet_t;
 typedef struct nf_stat {
   unsigned received;
@@ -1081,10 +1085,11 @@ uint32_t flow_udp_size;
 
 cc_meter_headers = """
 typedef struct nf_flow {
-  char src_ip[48], src_mac[18], src_oui[9];
+  uint8_t src_ip[16], src_mac[6];
   uint16_t src_port;
-  char dst_ip[48], dst_mac[18], dst_oui[9];
+  uint8_t dst_ip[16], dst_mac[6];
   uint16_t dst_port;
+  uint8_t has_mac;
   uint8_t protocol;
   uint8_t ip_version;
   uint16_t vlan_id;
@@ -1168,16 +1173,30 @@ typedef struct nf_flow {
   ndpi_protocol detected_protocol;
   uint8_t guessed;
   uint8_t detection_completed;
+  uint8_t service_cached;
+  ndpi_protocol cached_protocol;
+  uint8_t tcp_closing;
+  uint64_t closed_ms;
+  int16_t timeout_policy;
+  uint16_t timeout_application;
 } nf_flow_t;
 """
 
 cc_capture_apis = """
-pcap_t * capture_open(const uint8_t * pcap_file, int mode, int root_idx);
-int capture_set_fanout(pcap_t * pcap_handle, int mode, int root_idx);
-int capture_set_timeout(pcap_t * pcap_handle, int mode, int root_idx);
+pcap_t * capture_open(const uint8_t * pcap_file, int mode, int root_idx, int backend, int memory_map);
+int capture_set_fanout(pcap_t * pcap_handle, int mode, int root_idx, int hash, int fanout_mode, int group_id);
+int capture_fanout_group(pcap_t * pcap_handle);
+int capture_set_timeout(pcap_t * pcap_handle, int mode, int root_idx, int timeout);
+int capture_set_buffer_size(pcap_t * pcap_handle, int mode, int root_idx, int buffer_size);
+int capture_set_immediate_mode(pcap_t * pcap_handle, int mode, int root_idx, int immediate);
 int capture_set_promisc(pcap_t * pcap_handle, int mode, int root_idx, int promisc);
 int capture_set_snaplen(pcap_t * pcap_handle, int mode, int root_idx, unsigned snaplen);
 int capture_set_filter(pcap_t * pcap_handle, char * bpf_filter, int root_idx);
+int capture_set_replay(pcap_t * pcap_handle, int mode, int root_idx, double speed);
+int capture_set_window(pcap_t * pcap_handle, int mode, int root_idx, int64_t offset, uint64_t start, uint64_t end,
+                       int64_t chunk_from, int64_t chunk_to, int64_t next_from);
+int capture_set_nonblock(pcap_t * pcap_handle, int mode, int root_idx);
+int capture_wait(pcap_t ** pcap_handles, int count, int timeout);
 int capture_next(pcap_t * pcap_handle, struct nf_packet *nf_pkt, int decode_tunnels, int n_roots, int root_idx, int mode);
 void capture_stats(pcap_t * pcap_handle, struct nf_stat *nf_statistics, unsigned mode);
 void capture_close(pcap_t * pcap_handle);
@@ -1186,7 +1205,10 @@ int capture_activate(pcap_t * pcap_handle, int mode, int root_idx);
 
 cc_dissector_apis = """
 struct ndpi_detection_module_struct *dissector_init(struct dissector_checker *checker);
-void dissector_configure(struct ndpi_detection_module_struct *dissector);
+uint32_t dissector_protocols(struct ndpi_detection_module_struct *dissector);
+const char *dissector_protocol_name(struct ndpi_detection_module_struct *dissector, uint16_t protocol_id);
+const char *dissector_protocol_category(struct ndpi_detection_module_struct *dissector, uint16_t protocol_id);
+void dissector_configure(struct ndpi_detection_module_struct *dissector, const uint8_t *selection);
 void dissector_cleanup(struct ndpi_detection_module_struct *dissector);
 """
 
@@ -1195,10 +1217,25 @@ struct nf_flow *meter_initialize_flow(struct nf_packet *packet, uint8_t accounti
                                       uint8_t splt, uint8_t n_dissections, 
                                       struct ndpi_detection_module_struct *dissector);
 uint8_t meter_update_flow(struct nf_flow *flow, struct nf_packet *packet, uint64_t idle_timeout, 
-                          uint64_t active_timeout, uint8_t accounting_mode, uint8_t statistics, uint8_t splt,
-                          uint8_t n_dissections, struct ndpi_detection_module_struct *dissector);
+                          uint64_t active_timeout, uint64_t tcp_linger, uint8_t accounting_mode, uint8_t statistics,
+                          uint8_t splt, uint8_t n_dissections, struct ndpi_detection_module_struct *dissector);
 void meter_expire_flow(struct nf_flow *flow, uint8_t n_dissections, struct ndpi_detection_module_struct *dissector);
 void meter_free_flow(struct nf_flow *flow, uint8_t n_dissections, uint8_t splt, uint8_t full);
+void meter_memory(uint64_t *memory);
+void meter_pools(uint64_t *stats);
+int meter_service_cache(uint32_t size, uint8_t verify);
+void meter_service_cache_stats(uint64_t *stats);
+int meter_host_table(uint32_t size);
+void meter_host_table_stats(uint64_t *stats);
+int meter_timeout_policy(uint8_t protocol, uint16_t port, uint16_t application, uint64_t idle_timeout,
+                         uint64_t active_timeout);
+"""
+
+cc_anonymizer_apis = """
+typedef struct nf_anonymizer nf_anonymizer_t;
+struct nf_anonymizer *anonymizer_init(const uint8_t *key, uint32_t cache_size);
+int anonymizer_ip(struct nf_anonymizer *anonymizer, const char *ip, char *anonymized, unsigned anonymized_len);
+void anonymizer_cleanup(struct nf_anonymizer *anonymizer);
 """
 
 
@@ -1213,4 +1250,5 @@ def create_engine():
     ffi.cdef(cc_capture_apis, override=True)
     ffi.cdef(cc_dissector_apis, override=True)
     ffi.cdef(cc_meter_apis, override=True)
+    ffi.cdef(cc_anonymizer_apis, override=True)
     return ffi, lib
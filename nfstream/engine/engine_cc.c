@@ -17,6 +17,8 @@ If not, see <http://www.gnu.org/licenses/>.
 #include <ndpi_main.h>
 #include <ndpi_typedefs.h>
 #include <pcap.h>
+#include <gcrypt.h>
+#include <arpa/inet.h>
 #include <stdlib.h>
 #include <unistd.h>
 #include <netinet/in.h>
@@ -24,6 +26,16 @@ If not, see <http://www.gnu.org/licenses/>.
 #include <stdint.h>
 #include <string.h>
 #include <sys/time.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <fcntl.h>
+#ifdef __linux__
+#include <linux/if_packet.h>
+#include <linux/filter.h>
+#include <net/if.h>
+#include <sys/socket.h>
+#endif
+#include <poll.h>
 #if defined(__FreeBSD__) || defined(__NetBSD__) || defined(__OpenBSD__)
 #include <machine/endian.h>
 #endif
@@ -90,9 +102,21 @@ If not, see <http://www.gnu.org/licenses/>.
 #define GTP_U_V1_PORT                  2152
 #define NFSTREAM_CAPWAP_DATA_PORT          5247
 #define TZSP_PORT                      37008
+// Parsing errors types (reported on ignored packets).
+#define PARSE_ERROR_TRUNCATED              1
+#define PARSE_ERROR_UNSUPPORTED_DATALINK   2
+#define PARSE_ERROR_NOT_IP                 3
+#define PARSE_ERROR_FRAGMENTED             4
+#define PARSE_ERROR_MALFORMED              5
 #ifndef DLT_LINUX_SLL
 #define DLT_LINUX_SLL  113
 #endif
+#define FANOUT_HASH_SYMMETRIC              0
+#define FANOUT_HASH_LEGACY                 1
+// TCP closing state flags: FIN seen in each direction, RST seen.
+#define TCP_CLOSING_SRC2DST_FIN            0x1
+#define TCP_CLOSING_DST2SRC_FIN            0x2
+#define TCP_CLOSING_RST                    0x4
 
 
 /*
@@ -337,7 +361,11 @@ typedef struct nf_packet {
   uint16_t dst_port;
   uint8_t protocol;
   uint16_t vlan_id;
-  char src_ip_str[48], dst_ip_str[48], src_mac[18], src_oui[9], dst_mac[18], dst_oui[9];
+  // Binary addresses (network order, IPv4 on first 4 bytes). Key words are used to build flow key on Python side.
+  union { uint8_t src_ip[16]; uint64_t src_ip_key[2]; };
+  union { uint8_t dst_ip[16]; uint64_t dst_ip_key[2]; };
+  uint8_t src_mac[6], dst_mac[6];
+  uint8_t has_mac;
   uint8_t ip_version;
   uint16_t fin:1, syn:1, rst:1, psh:1, ack:1, urg:1, ece:1, cwr:1; // TCP Flags
   uint16_t raw_size;
@@ -346,6 +374,7 @@ typedef struct nf_packet {
   uint16_t payload_size;
   uint16_t ip_content_len;
   uint8_t *ip_content;
+  uint8_t parse_error;
 } nf_packet_t;
 
 
@@ -481,24 +510,51 @@ void packet_get_info(struct nf_packet *nf_pkt, uint16_t *sport, uint16_t *dport,
   nf_pkt->delta_time = 0; // This will be filled by meter.
 
   if (version == IPVERSION) {
-	inet_ntop(AF_INET, &iph->saddr, nf_pkt->src_ip_str, sizeof(nf_pkt->src_ip_str));
-	inet_ntop(AF_INET, &iph->daddr, nf_pkt->dst_ip_str, sizeof(nf_pkt->dst_ip_str));
+	memset(nf_pkt->src_ip, 0, sizeof(nf_pkt->src_ip));
+	memset(nf_pkt->dst_ip, 0, sizeof(nf_pkt->dst_ip));
+	memcpy(nf_pkt->src_ip, &iph->saddr, 4);
+	memcpy(nf_pkt->dst_ip, &iph->daddr, 4);
 	nf_pkt->ip_size= ntohs(iph->tot_len);
 	nf_pkt->ip_content = (uint8_t *)iph;
   } else {
-	inet_ntop(AF_INET6, &iph6->ip6_src, nf_pkt->src_ip_str, sizeof(nf_pkt->src_ip_str));
-	inet_ntop(AF_INET6, &iph6->ip6_dst, nf_pkt->dst_ip_str, sizeof(nf_pkt->dst_ip_str));
+	memcpy(nf_pkt->src_ip, &iph6->ip6_src, 16);
+	memcpy(nf_pkt->dst_ip, &iph6->ip6_dst, 16);
 	nf_pkt->ip_size = ntohs(iph->tot_len);
 	nf_pkt->ip_content = (uint8_t *)iph6;
   }
 }
 
 
+// Software fanout hash (offline, replay and non Linux live captures). Each meter runs in its own process.
+static uint8_t fanout_hash = FANOUT_HASH_SYMMETRIC;
+
+
+/**
+ * packet_mix64: 64-bit finalizer (splitmix64), every input bit affects every output bit.
+ */
+static uint64_t packet_mix64(uint64_t value) {
+  value = (value ^ (value >> 30)) * 0xbf58476d1ce4e5b9ULL;
+  value = (value ^ (value >> 27)) * 0x94d049bb133111ebULL;
+  return value ^ (value >> 31);
+}
+
+
+/**
+ * packet_symmetric_hash: Symmetric fanout hash over full addresses, ports, protocol and vlan.
+ */
+static uint64_t packet_symmetric_hash(struct nf_packet *nf_pkt) {
+  // Each endpoint is mixed on its own, then endpoints are combined commutatively: both directions hash the same.
+  uint64_t src = packet_mix64(nf_pkt->src_ip_key[0] ^ packet_mix64(nf_pkt->src_ip_key[1] ^ nf_pkt->src_port));
+  uint64_t dst = packet_mix64(nf_pkt->dst_ip_key[0] ^ packet_mix64(nf_pkt->dst_ip_key[1] ^ nf_pkt->dst_port));
+  return packet_mix64((src + dst) ^ (((uint64_t)nf_pkt->protocol << 16) | nf_pkt->vlan_id));
+}
+
+
 /**
  * packet_fanout: Network flow packet fanout.
  */
 int packet_fanout(struct nf_packet *nf_pkt, int mode, uint64_t hashval, int n_roots, int root_idx) {
-  if (mode == 0) { // Offline, we perform fanout like strategy
+  if (mode != 1) { // Offline or replay, we perform fanout like strategy
     if ((hashval % n_roots) == root_idx) { // If packet match meter idx, he will consume it and process it.
       return 1;
     } else {
@@ -555,8 +611,9 @@ int packet_get_ip_info(const uint8_t version, uint16_t vlan_id, nfstream_packet_
     packet_get_unknown_transport_info(nf_pkt, sport, dport, l4_data_len);
   }
   packet_get_info(nf_pkt, sport, dport, l4_data_len, payload_len, iph, iph6, ipsize, version, vlan_id);
-  uint64_t hashval = 0; // Compute hashval as the sum of 6-tuple fields.
-  hashval = nf_pkt->protocol + nf_pkt->vlan_id + iph->saddr + iph->daddr + nf_pkt->src_port + nf_pkt->dst_port;
+  uint64_t hashval = 0;
+  if (fanout_hash == FANOUT_HASH_SYMMETRIC) hashval = packet_symmetric_hash(nf_pkt);
+  else hashval = nf_pkt->protocol + nf_pkt->vlan_id + iph->saddr + iph->daddr + nf_pkt->src_port + nf_pkt->dst_port;
   return packet_fanout(nf_pkt, mode, hashval, n_roots, root_idx);
 }
 
@@ -664,52 +721,22 @@ void packet_dlt_ppp(const uint8_t *packet, uint16_t eth_offset, uint16_t *type,
 
 
 /**
- * packet_fill_mac_ether_strings: nf_packet ether info filler.
+ * packet_fill_mac_ether: nf_packet ether info filler (addresses are formatted on export).
  */
-void packet_fill_mac_ether_strings(struct nf_packet *nf_pkt, const struct nfstream_ethhdr * ether) {
-  snprintf(nf_pkt->src_mac,
-           sizeof(nf_pkt->src_mac),
-           "%02x:%02x:%02x:%02x:%02x:%02x",
-           ether->h_source[0], ether->h_source[1], ether->h_source[2],
-           ether->h_source[3], ether->h_source[4], ether->h_source[5]);
-  snprintf(nf_pkt->dst_mac,
-           sizeof(nf_pkt->dst_mac),
-           "%02x:%02x:%02x:%02x:%02x:%02x",
-           ether->h_dest[0], ether->h_dest[1], ether->h_dest[2],
-           ether->h_dest[3], ether->h_dest[4], ether->h_dest[5]);
-  snprintf(nf_pkt->src_oui,
-           sizeof(nf_pkt->src_oui),
-           "%02x:%02x:%02x",
-           ether->h_source[0], ether->h_source[1], ether->h_source[2]);
-  snprintf(nf_pkt->dst_oui,
-           sizeof(nf_pkt->dst_oui),
-           "%02x:%02x:%02x",
-           ether->h_dest[0], ether->h_dest[1], ether->h_dest[2]);
+void packet_fill_mac_ether(struct nf_packet *nf_pkt, const struct nfstream_ethhdr * ether) {
+  memcpy(nf_pkt->src_mac, ether->h_source, 6);
+  memcpy(nf_pkt->dst_mac, ether->h_dest, 6);
+  nf_pkt->has_mac = 1;
 }
 
 
 /**
- * packet_fill_mac_wifi_strings: nf_packet wifi info filler.
+ * packet_fill_mac_wifi: nf_packet wifi info filler (addresses are formatted on export).
  */
-void packet_fill_mac_wifi_strings(struct nf_packet *nf_pkt, const struct nfstream_wifi_header * wifi) {
-  snprintf(nf_pkt->src_mac,
-           sizeof(nf_pkt->src_mac),
-           "%02x:%02x:%02x:%02x:%02x:%02x",
-           wifi->trsm[0], wifi->trsm[1], wifi->trsm[2],
-           wifi->trsm[3], wifi->trsm[4], wifi->trsm[5]);
-  snprintf(nf_pkt->dst_mac,
-           sizeof(nf_pkt->dst_mac),
-           "%02x:%02x:%02x:%02x:%02x:%02x",
-           wifi->dest[0], wifi->dest[1], wifi->dest[2],
-           wifi->dest[3], wifi->dest[4], wifi->dest[5]);
-  snprintf(nf_pkt->src_oui,
-           sizeof(nf_pkt->src_oui),
-           "%02x:%02x:%02x",
-           wifi->trsm[0], wifi->trsm[1], wifi->trsm[2]);
-  snprintf(nf_pkt->dst_oui,
-           sizeof(nf_pkt->dst_oui),
-           "%02x:%02x:%02x",
-           wifi->dest[0], wifi->dest[1], wifi->dest[2]);
+void packet_fill_mac_wifi(struct nf_packet *nf_pkt, const struct nfstream_wifi_header * wifi) {
+  memcpy(nf_pkt->src_mac, wifi->trsm, 6);
+  memcpy(nf_pkt->dst_mac, wifi->dest, 6);
+  nf_pkt->has_mac = 1;
 }
 
 
@@ -722,7 +749,7 @@ int packet_dlt_en10mb(const uint8_t *packet, uint16_t eth_offset, uint16_t *type
   const struct nfstream_llc_header_snap *llc;
   int check = 0;
   ethernet = (struct nfstream_ethhdr *) &packet[eth_offset];
-  packet_fill_mac_ether_strings(nf_pkt, ethernet);
+  packet_fill_mac_ether(nf_pkt, ethernet);
   (*ip_offset) = sizeof(struct nfstream_ethhdr) + eth_offset;
   check = ntohs(ethernet->h_proto);
   if (check <= 1500) (*pyld_eth_len) = check;
@@ -763,7 +790,7 @@ int packet_dlt_radiotap(const uint8_t *packet, const struct pcap_pkthdr *header,
     if ((FCF_TO_DS((*fc)) && FCF_FROM_DS((*fc)) == 0x0)
         || (FCF_TO_DS((*fc)) == 0x0 && FCF_FROM_DS((*fc)))) (*wifi_len) = 26; // +4 byte fcs
   } else return 1;
-  packet_fill_mac_wifi_strings(nf_pkt, wifi);
+  packet_fill_mac_wifi(nf_pkt, wifi);
   // Check ether_type from LLC
   if (header->caplen < (eth_offset + (*wifi_len) + (*radio_len) + sizeof(struct nfstream_llc_header_snap))) return 0;
   llc = (struct nfstream_llc_header_snap*)(packet + eth_offset + (*wifi_len) + (*radio_len));
@@ -806,7 +833,10 @@ void packet_dlt_ipv6(uint16_t *type, uint16_t *ip_offset) {
 int packet_datalink_checker(const struct pcap_pkthdr *header, const uint8_t *packet, uint16_t eth_offset, uint16_t *type,
                             int datalink_type, uint16_t *ip_offset, int *pyld_eth_len, uint16_t *radio_len, uint16_t *fc,
                             int *wifi_len, struct nf_packet *nf_pkt) {
-  if (header->caplen < eth_offset + 28) return 0; /* 28 = min IP + min UDP */
+  if (header->caplen < eth_offset + 28) { /* 28 = min IP + min UDP */
+    nf_pkt->parse_error = PARSE_ERROR_TRUNCATED;
+    return 0;
+  }
   switch(datalink_type) {
   case DLT_NULL:
     packet_dlt_null(packet, eth_offset, type, ip_offset);
@@ -825,18 +855,25 @@ int packet_datalink_checker(const struct pcap_pkthdr *header, const uint8_t *pac
     packet_dlt_ipv6(type, ip_offset);
     break;
   case DLT_EN10MB: // IEEE 802.3 Ethernet: 1
-    if (!packet_dlt_en10mb(packet, eth_offset, type, ip_offset, pyld_eth_len, nf_pkt)) return 0;
+    if (!packet_dlt_en10mb(packet, eth_offset, type, ip_offset, pyld_eth_len, nf_pkt)) {
+      nf_pkt->parse_error = PARSE_ERROR_NOT_IP;
+      return 0;
+    }
     break;
   case DLT_LINUX_SLL: // Linux Cooked Capture: 113
     packet_dlt_linux_ssl(packet, eth_offset, type, ip_offset);
     break;
   case DLT_IEEE802_11_RADIO: // Radiotap link-layer: 127
-    if (!packet_dlt_radiotap(packet, header, eth_offset, type, ip_offset, radio_len, fc, wifi_len, nf_pkt)) return 0;
+    if (!packet_dlt_radiotap(packet, header, eth_offset, type, ip_offset, radio_len, fc, wifi_len, nf_pkt)) {
+      nf_pkt->parse_error = PARSE_ERROR_MALFORMED;
+      return 0;
+    }
     break;
   case DLT_RAW:
     (*ip_offset) = eth_offset = 0;
     break;
   default:
+    nf_pkt->parse_error = PARSE_ERROR_UNSUPPORTED_DATALINK;
     return 0;
   }
   return 1;
@@ -923,7 +960,10 @@ int packet_process(pcap_t * pcap_handle, const struct pcap_pkthdr *header, const
 
  iph_check:
   // Check and set IP header size and total packet length
-  if (header->caplen < ip_offset + sizeof(struct nfstream_iphdr)) return 0;
+  if (header->caplen < ip_offset + sizeof(struct nfstream_iphdr)) {
+    nf_pkt->parse_error = PARSE_ERROR_TRUNCATED;
+    return 0;
+  }
   iph = (struct nfstream_iphdr *) &packet[ip_offset];
 
   // just work on Ethernet packets that contain IP */
@@ -941,14 +981,23 @@ int packet_process(pcap_t * pcap_handle, const struct pcap_pkthdr *header, const
       if (ip_len > 0) goto iph_check;
     }
 
-    if ((frag_off & 0x1FFF) != 0) return 0;
+    if ((frag_off & 0x1FFF) != 0) {
+      nf_pkt->parse_error = PARSE_ERROR_FRAGMENTED;
+      return 0;
+    }
 
   } else if (iph->version == 6) {
-    if (header->caplen < ip_offset + sizeof(struct nfstream_ipv6hdr)) return 0;
+    if (header->caplen < ip_offset + sizeof(struct nfstream_ipv6hdr)) {
+      nf_pkt->parse_error = PARSE_ERROR_TRUNCATED;
+      return 0;
+    }
     iph6 = (struct nfstream_ipv6hdr *)&packet[ip_offset];
     proto = iph6->ip6_hdr.ip6_un1_nxt;
     ip_len = ntohs(iph6->ip6_hdr.ip6_un1_plen);
-    if (header->caplen < (ip_offset + sizeof(struct nfstream_ipv6hdr) + ntohs(iph6->ip6_hdr.ip6_un1_plen))) return 0;
+    if (header->caplen < (ip_offset + sizeof(struct nfstream_ipv6hdr) + ntohs(iph6->ip6_hdr.ip6_un1_plen))) {
+      nf_pkt->parse_error = PARSE_ERROR_TRUNCATED;
+      return 0;
+    }
 
     const uint8_t *l4ptr = (((const uint8_t *) iph6) + sizeof(struct nfstream_ipv6hdr));
     if (packet_handle_ipv6_extension_headers(&l4ptr, &ip_len, &proto) != 0) return 0;
@@ -961,6 +1010,7 @@ int packet_process(pcap_t * pcap_handle, const struct pcap_pkthdr *header, const
     }
     iph = NULL;
   } else {
+    nf_pkt->parse_error = PARSE_ERROR_NOT_IP;
     return 0;
   }
 
@@ -1034,7 +1084,7 @@ int packet_process(pcap_t * pcap_handle, const struct pcap_pkthdr *header, const
 	        if (offset + 32 < header->caplen) {
 	          const struct nfstream_wifi_header *wifi_hdr;
               wifi_hdr = (struct nfstream_wifi_header*)(packet + offset);
-              packet_fill_mac_wifi_strings(nf_pkt, wifi_hdr);
+              packet_fill_mac_wifi(nf_pkt, wifi_hdr);
 	          offset += 24;
 	          // LLC header is 8 bytes
 	          type = ntohs((uint16_t)*((uint16_t*)&packet[offset+6]));
@@ -1052,15 +1102,432 @@ int packet_process(pcap_t * pcap_handle, const struct pcap_pkthdr *header, const
 }
 
 
+/***************************************** Memory layer ***************************************************************/
+
+#define MEMORY_FLOW          0  // nf_flow structures.
+#define MEMORY_NDPI_FLOW     1  // nDPI flow structures.
+#define MEMORY_NDPI_ID       2  // nDPI id structures (hosts).
+#define MEMORY_SPLT          3  // SPLT arrays.
+#define MEMORY_COMPONENTS    4
+
+// Bytes currently held by each flow component. Each meter runs in its own process and thus owns its counters.
+static int64_t memory_allocated[MEMORY_COMPONENTS] = {0};
+
+
+/**
+ * memory_account: Account an allocation (positive bytes) or a release (negative bytes) of a flow component.
+ */
+static void memory_account(uint8_t component, int64_t bytes) {
+  memory_allocated[component] += bytes;
+}
+
+
+/***************************************** Pool layer *****************************************************************/
+
+#define POOL_FLOW            0  // nf_flow structures.
+#define POOL_NDPI_ID         1  // Hosts: nDPI id structures (shared per endpoint when host table is enabled).
+#define POOL_SPLT            2  // SPLT arrays (a single block per flow).
+#define POOL_CLASSES         3
+#define POOL_STATS           4  // objects in use, mapped slabs, allocated slabs, released slabs.
+#define POOL_SLAB_SIZE       262144  // Slabs are mapped directly and thus returned to the system once released.
+#define POOL_ALIGNMENT       16  // Objects alignment, also size of slot header (owning slab reference).
+#define POOL_SLAB_HEADER     64
+
+typedef struct nf_slab {
+  struct nf_slab *prev, *next; // Pool list of slabs having free objects.
+  struct nf_pool *pool;
+  void *free_objects;          // Released objects, linked through their first bytes.
+  uint32_t free_count;         // Free objects (released and never used ones).
+  uint32_t unused;             // Never used objects, taken in order so that untouched pages are not resident.
+} nf_slab_t;
+
+typedef struct nf_pool {
+  struct nf_slab *slabs;       // Slabs having free objects.
+  uint32_t slot_size;          // Size class: slot header and aligned object size (set on first allocation).
+  uint32_t capacity;           // Objects per slab.
+  uint32_t empty_slabs;        // Fully free slabs, at most one is kept in order to absorb churn.
+  uint64_t objects;
+  uint64_t slabs_count;
+  uint64_t slabs_allocated;
+  uint64_t slabs_released;
+} nf_pool_t;
+
+// Per meter object pools: each meter runs in its own process and thus owns its pools.
+static struct nf_pool pools[POOL_CLASSES];
+
+
+/**
+ * pool_link: Add a slab to pool list of slabs having free objects.
+ */
+static void pool_link(struct nf_pool *pool, struct nf_slab *slab) {
+  slab->prev = NULL;
+  slab->next = pool->slabs;
+  if (pool->slabs) pool->slabs->prev = slab;
+  pool->slabs = slab;
+}
+
+
+/**
+ * pool_unlink: Remove a slab from pool list of slabs having free objects.
+ */
+static void pool_unlink(struct nf_pool *pool, struct nf_slab *slab) {
+  if (slab->prev) slab->prev->next = slab->next;
+  else pool->slabs = slab->next;
+  if (slab->next) slab->next->prev = slab->prev;
+  slab->prev = slab->next = NULL;
+}
+
+
+/**
+ * pool_slab_new: Map a new slab for pool.
+ */
+static struct nf_slab *pool_slab_new(struct nf_pool *pool) {
+  struct nf_slab *slab = (struct nf_slab *)mmap(NULL, POOL_SLAB_SIZE, PROT_READ | PROT_WRITE,
+                                                MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+  if (slab == MAP_FAILED) return NULL;
+  slab->pool = pool;
+  slab->free_objects = NULL;
+  slab->free_count = pool->capacity;
+  slab->unused = pool->capacity;
+  pool_link(pool, slab);
+  pool->empty_slabs++;
+  pool->slabs_count++;
+  pool->slabs_allocated++;
+  return slab;
+}
+
+
+/**
+ * pool_alloc: Allocate an object of size bytes from pool (NULL if size do not match pool size class).
+ */
+static void *pool_alloc(uint8_t pool_id, size_t size) {
+  struct nf_pool *pool = &pools[pool_id];
+  if (pool->slot_size == 0) {
+    pool->slot_size = POOL_ALIGNMENT + ((size + POOL_ALIGNMENT - 1) & ~((size_t)POOL_ALIGNMENT - 1));
+    pool->capacity = (POOL_SLAB_SIZE - POOL_SLAB_HEADER) / pool->slot_size;
+  }
+  if ((size + POOL_ALIGNMENT > pool->slot_size) || (pool->capacity == 0)) return NULL;
+  struct nf_slab *slab = pool->slabs;
+  if (slab == NULL) {
+    slab = pool_slab_new(pool);
+    if (slab == NULL) return NULL;
+  }
+  if (slab->free_count == pool->capacity) pool->empty_slabs--;
+  uint8_t *object;
+  if (slab->free_objects) {
+    object = (uint8_t *)slab->free_objects;
+    slab->free_objects = *(void **)object;
+  } else {
+    uint8_t *slot = (uint8_t *)slab + POOL_SLAB_HEADER + (pool->capacity - slab->unused) * pool->slot_size;
+    *(struct nf_slab **)slot = slab; // slot header: owning slab.
+    object = slot + POOL_ALIGNMENT;
+    slab->unused--;
+  }
+  slab->free_count--;
+  if (slab->free_count == 0) pool_unlink(pool, slab); // Full slab.
+  pool->objects++;
+  return object;
+}
+
+
+/**
+ * pool_free: Release an object to its slab. Empty slabs are unmapped except one kept for upcoming allocations.
+ */
+static void pool_free(void *object) {
+  struct nf_slab *slab = *(struct nf_slab **)((uint8_t *)object - POOL_ALIGNMENT);
+  struct nf_pool *pool = slab->pool;
+  *(void **)object = slab->free_objects;
+  slab->free_objects = object;
+  if (slab->free_count == 0) pool_link(pool, slab);
+  slab->free_count++;
+  pool->objects--;
+  if (slab->free_count == pool->capacity) {
+    if (pool->empty_slabs > 0) {
+      pool_unlink(pool, slab);
+      munmap(slab, POOL_SLAB_SIZE);
+      pool->slabs_count--;
+      pool->slabs_released++;
+    } else {
+      pool->empty_slabs++;
+    }
+  }
+}
+
+
+/***************************************** Service cache layer ********************************************************/
+
+#define SERVICE_CACHE_TTL       300000  // Cached detections are trusted for 5 minutes (ms), then dissected again.
+#define SERVICE_CACHE_STATS     4  // hits, misses, verified, mismatches.
+
+typedef struct nf_service {
+  uint8_t ip[16];
+  uint16_t port;
+  uint16_t vlan_id;
+  uint8_t protocol;
+  uint8_t used;
+  uint64_t time;                     // Last confident detection time (ms).
+  ndpi_protocol detected_protocol;
+} nf_service_t;
+
+// Per meter direct mapped cache of recent confident detections keyed by server address, port, protocol and vlan.
+static struct nf_service *services = NULL;
+static uint32_t services_size = 0;
+static uint8_t services_verify = 0;  // Cached detections are only compared to dissection results.
+static uint64_t services_stats[SERVICE_CACHE_STATS] = {0};
+
+
+/**
+ * service_cache_entry: Cache entry of a service (FNV-1a over service key).
+ */
+static struct nf_service *service_cache_entry(const uint8_t *ip, uint16_t port, uint8_t protocol, uint16_t vlan_id) {
+  uint64_t hash = 0xcbf29ce484222325ULL;
+  for (int i = 0; i < 16; i++) hash = (hash ^ ip[i]) * 0x100000001b3ULL;
+  hash = (hash ^ port) * 0x100000001b3ULL;
+  hash = (hash ^ protocol) * 0x100000001b3ULL;
+  hash = (hash ^ vlan_id) * 0x100000001b3ULL;
+  return &services[hash % services_size];
+}
+
+
+/**
+ * service_cache_lookup: Look for a recent confident detection of a service, return 1 on hit.
+ */
+static uint8_t service_cache_lookup(const uint8_t *ip, uint16_t port, uint8_t protocol, uint16_t vlan_id,
+                                    uint64_t time, ndpi_protocol *detected_protocol) {
+  if (services == NULL) return 0;
+  struct nf_service *entry = service_cache_entry(ip, port, protocol, vlan_id);
+  if (entry->used && (entry->port == port) && (entry->protocol == protocol) && (entry->vlan_id == vlan_id) &&
+      (memcmp(entry->ip, ip, 16) == 0) && (time < entry->time + SERVICE_CACHE_TTL)) {
+    services_stats[0]++;
+    *detected_protocol = entry->detected_protocol;
+    return 1;
+  }
+  services_stats[1]++;
+  return 0;
+}
+
+
+/**
+ * service_cache_insert: Record a confident detection of a service (replacing colliding entry).
+ */
+static void service_cache_insert(const uint8_t *ip, uint16_t port, uint8_t protocol, uint16_t vlan_id,
+                                 uint64_t time, ndpi_protocol detected_protocol) {
+  if (services == NULL) return;
+  struct nf_service *entry = service_cache_entry(ip, port, protocol, vlan_id);
+  memcpy(entry->ip, ip, 16);
+  entry->port = port;
+  entry->protocol = protocol;
+  entry->vlan_id = vlan_id;
+  entry->used = 1;
+  entry->time = time;
+  entry->detected_protocol = detected_protocol;
+}
+
+
+/***************************************** Host layer *****************************************************************/
+
+#define HOST_TABLE_STATS     4  // hosts, hits, misses, evictions.
+#define HOST_HEADER          ((sizeof(struct nf_host) + POOL_ALIGNMENT - 1) & ~((size_t)POOL_ALIGNMENT - 1))
+
+typedef struct nf_host {
+  uint8_t ip[16];
+  uint16_t vlan_id;
+  uint8_t indexed;                   // Host is part of host table (private id structure otherwise).
+  uint32_t refs;                     // Flows referencing host id structure.
+  struct nf_host *hash_next;         // Host table bucket chaining.
+  struct nf_host *prev, *next;       // LRU list of unreferenced hosts (most recently released first).
+} nf_host_t;                         // Followed by nDPI id structure.
+
+// Per meter bounded table of hosts, so that flows of an endpoint share nDPI host state as designed by nDPI.
+// Only unreferenced hosts are evicted. When table is full of referenced hosts, flows get private id structures.
+static struct nf_host **hosts = NULL;
+static uint32_t hosts_size = 0;
+static struct nf_host *hosts_lru_head = NULL, *hosts_lru_tail = NULL;
+static uint64_t hosts_stats[HOST_TABLE_STATS] = {0};
+
+
+/**
+ * host_id: nDPI id structure of a host.
+ */
+static struct ndpi_id_struct *host_id(struct nf_host *host) {
+  return (struct ndpi_id_struct *)((uint8_t *)host + HOST_HEADER);
+}
+
+
+/**
+ * host_of: Host owning an nDPI id structure.
+ */
+static struct nf_host *host_of(struct ndpi_id_struct *id) {
+  return (struct nf_host *)((uint8_t *)id - HOST_HEADER);
+}
+
+
+/**
+ * host_bucket: Host table bucket of an endpoint (FNV-1a over address and vlan).
+ */
+static struct nf_host **host_bucket(const uint8_t *ip, uint16_t vlan_id) {
+  uint64_t hash = 0xcbf29ce484222325ULL;
+  for (int i = 0; i < 16; i++) hash = (hash ^ ip[i]) * 0x100000001b3ULL;
+  hash = (hash ^ vlan_id) * 0x100000001b3ULL;
+  return &hosts[hash % hosts_size];
+}
+
+
+/**
+ * host_lru_unlink: Remove a host from LRU list of unreferenced hosts.
+ */
+static void host_lru_unlink(struct nf_host *host) {
+  if (host->prev) host->prev->next = host->next;
+  else hosts_lru_head = host->next;
+  if (host->next) host->next->prev = host->prev;
+  else hosts_lru_tail = host->prev;
+  host->prev = host->next = NULL;
+}
+
+
+/**
+ * host_new: Allocate a host with a zeroed nDPI id structure.
+ */
+static struct nf_host *host_new(const uint8_t *ip, uint16_t vlan_id, uint8_t indexed) {
+  struct nf_host *host = (struct nf_host *)pool_alloc(POOL_NDPI_ID, HOST_HEADER + SIZEOF_ID_STRUCT);
+  if (host == NULL) return NULL;
+  memset(host, 0, HOST_HEADER + SIZEOF_ID_STRUCT);
+  memcpy(host->ip, ip, 16);
+  host->vlan_id = vlan_id;
+  host->indexed = indexed;
+  host->refs = 1;
+  memory_account(MEMORY_NDPI_ID, HOST_HEADER + SIZEOF_ID_STRUCT);
+  return host;
+}
+
+
+/**
+ * host_delete: Release a host.
+ */
+static void host_delete(struct nf_host *host) {
+  pool_free(host);
+  memory_account(MEMORY_NDPI_ID, -(int64_t)(HOST_HEADER + SIZEOF_ID_STRUCT));
+}
+
+
+/**
+ * host_evict: Evict least recently released host from host table, return 0 if all hosts are referenced.
+ */
+static uint8_t host_evict(void) {
+  struct nf_host *host = hosts_lru_tail;
+  if (host == NULL) return 0;
+  host_lru_unlink(host);
+  struct nf_host **link = host_bucket(host->ip, host->vlan_id);
+  while (*link != host) link = &(*link)->hash_next;
+  *link = host->hash_next;
+  host_delete(host);
+  hosts_stats[0]--;
+  hosts_stats[3]++;
+  return 1;
+}
+
+
+/**
+ * host_acquire: Reference nDPI id structure of an endpoint (shared when host table is enabled).
+ */
+static struct ndpi_id_struct *host_acquire(const uint8_t *ip, uint16_t vlan_id) {
+  struct nf_host *host = NULL;
+  if (hosts == NULL) {
+    host = host_new(ip, vlan_id, 0);
+    return host ? host_id(host) : NULL;
+  }
+  for (host = *host_bucket(ip, vlan_id); host != NULL; host = host->hash_next) {
+    if ((host->vlan_id == vlan_id) && (memcmp(host->ip, ip, 16) == 0)) {
+      if (host->refs == 0) host_lru_unlink(host);
+      host->refs++;
+      hosts_stats[1]++;
+      return host_id(host);
+    }
+  }
+  hosts_stats[2]++;
+  if ((hosts_stats[0] >= hosts_size) && !host_evict()) { // Full of referenced hosts: private id structure.
+    host = host_new(ip, vlan_id, 0);
+    return host ? host_id(host) : NULL;
+  }
+  host = host_new(ip, vlan_id, 1);
+  if (host == NULL) return NULL;
+  struct nf_host **bucket = host_bucket(ip, vlan_id);
+  host->hash_next = *bucket;
+  *bucket = host;
+  hosts_stats[0]++;
+  return host_id(host);
+}
+
+
+/**
+ * host_release: Release a reference on a host nDPI id structure. Unreferenced hosts stay in host table (LRU).
+ */
+static void host_release(struct ndpi_id_struct *id) {
+  struct nf_host *host = host_of(id);
+  host->refs--;
+  if (host->refs) return;
+  if (!host->indexed) {
+    host_delete(host);
+    return;
+  }
+  host->prev = NULL;
+  host->next = hosts_lru_head;
+  if (hosts_lru_head) hosts_lru_head->prev = host;
+  else hosts_lru_tail = host;
+  hosts_lru_head = host;
+}
+
+
+/***************************************** Timeout layer **************************************************************/
+
+#define TIMEOUT_POLICIES_MAX     64
+
+typedef struct nf_timeout_policy {
+  uint8_t protocol;                  // L4 protocol, 0 for any.
+  uint16_t port;                     // Source or destination port, 0 for any.
+  uint16_t application;              // nDPI master or application protocol id, 0 (unknown) for any.
+  uint64_t idle_timeout;
+  uint64_t active_timeout;
+} nf_timeout_policy_t;
+
+// Per meter timeout policies, the most specific matching policy applies (application, then port, then protocol).
+static struct nf_timeout_policy timeout_policies[TIMEOUT_POLICIES_MAX];
+static int timeout_policies_count = 0;
+
+
+/**
+ * timeout_policy_match: Most specific timeout policy index matching flow values, -1 if none.
+ */
+static int16_t timeout_policy_match(uint8_t protocol, uint16_t src_port, uint16_t dst_port, uint16_t master_protocol,
+                                    uint16_t app_protocol) {
+  int16_t matched = -1;
+  int matched_score = -1;
+  for (int i = 0; i < timeout_policies_count; i++) {
+    struct nf_timeout_policy *policy = &timeout_policies[i];
+    if (policy->protocol && (policy->protocol != protocol)) continue;
+    if (policy->port && (policy->port != src_port) && (policy->port != dst_port)) continue;
+    if (policy->application && (policy->application != master_protocol) && (policy->application != app_protocol))
+      continue;
+    int score = (policy->application ? 4 : 0) + (policy->port ? 2 : 0) + (policy->protocol ? 1 : 0);
+    if (score > matched_score) { // First policy wins on equal specificity.
+      matched = (int16_t)i;
+      matched_score = score;
+    }
+  }
+  return matched;
+}
+
+
 /***************************************** Flow layer *****************************************************************/
 
 
 // Flow main structure.
 typedef struct nf_flow {
-  char src_ip[48], src_mac[18], src_oui[9];
+  uint8_t src_ip[16], src_mac[6]; // Binary addresses, formatted on export.
   uint16_t src_port;
-  char dst_ip[48], dst_mac[18], dst_oui[9];
+  uint8_t dst_ip[16], dst_mac[6];
   uint16_t dst_port;
+  uint8_t has_mac;
   uint8_t protocol;
   uint8_t ip_version;
   uint16_t vlan_id;
@@ -1144,6 +1611,12 @@ typedef struct nf_flow {
   ndpi_protocol detected_protocol;
   uint8_t guessed;
   uint8_t detection_completed;
+  uint8_t service_cached;            // Flow service found in service cache.
+  ndpi_protocol cached_protocol;
+  uint8_t tcp_closing;               // TCP closing state flags.
+  uint64_t closed_ms;                // TCP connection closing time (both FINs or RST seen), 0 while open.
+  int16_t timeout_policy;            // Matching timeout policy index, -1 for streamer timeouts.
+  uint16_t timeout_application;      // Detected application when timeout policy was matched.
 } nf_flow_t;
 
 
@@ -1168,15 +1641,41 @@ uint8_t flow_is_ndpi_proto(struct nf_flow *flow, uint16_t id) {
 
 
 /**
- * flow_bidirectional_dissection_collect_info: Dissection info collector.
+ * flow_set_application_names: Set application and category names from detected protocol.
  */
-void flow_bidirectional_dissection_collect_info(struct ndpi_detection_module_struct *dissector, struct nf_flow *flow) {
-  // We copy useful information to fileds in our flow structure in order to release dissector references at early stage.
-  if (!flow->ndpi_flow) return;
+void flow_set_application_names(struct ndpi_detection_module_struct *dissector, struct nf_flow *flow) {
   // Application name (STUN.WhatsApp, TLS.Netflix, etc.).
   ndpi_protocol2name(dissector, flow->detected_protocol, flow->application_name, sizeof(flow->application_name));
   // Application category name (Streaming, SocialNetwork, etc.).
   memcpy(flow->category_name, ndpi_category_get_name(dissector, flow->detected_protocol.category), 24);
+}
+
+
+/**
+ * flow_service_cache_update: On detection completion, record confident detection and verify cached one if any.
+ */
+void flow_service_cache_update(struct nf_flow *flow) {
+  if (services == NULL) return;
+  if (flow->service_cached) { // Verification mode: cached detection is compared to dissection result.
+    services_stats[2]++;
+    if ((flow->cached_protocol.app_protocol != flow->detected_protocol.app_protocol) ||
+        (flow->cached_protocol.master_protocol != flow->detected_protocol.master_protocol)) services_stats[3]++;
+  }
+  if (flow->guessed || (flow->detected_protocol.app_protocol == NDPI_PROTOCOL_UNKNOWN)) return; // Not confident.
+  // DNS applications depend on queried names rather than on server (resolvers).
+  if (flow_is_ndpi_proto(flow, NDPI_PROTOCOL_DNS)) return;
+  service_cache_insert(flow->dst_ip, flow->dst_port, flow->protocol, flow->vlan_id, flow->bidirectional_last_seen_ms,
+                       flow->detected_protocol);
+}
+
+
+/**
+ * flow_bidirectional_dissection_collect_info: Dissection info collector.
+ */
+void flow_bidirectional_dissection_collect_info(struct ndpi_detection_module_struct *dissector, struct nf_flow *flow) {
+  // We copy useful information to fileds in our flow structure in order to release dissector references at early stage.
+  if (!flow->ndpi_flow) return;
+  flow_set_application_names(dissector, flow);
   // Requested server name: HTTP server, DNS, etc.
   snprintf(flow->requested_server_name, sizeof(flow->requested_server_name), "%s", flow->ndpi_flow->host_server_name);
   // DHCP: We put DHCP fingerprint in client side: this can be helpful for device identification approaches.
@@ -1217,19 +1716,33 @@ void flow_bidirectional_dissection_collect_info(struct ndpi_detection_module_str
  * flow_free_ndpi_data: nDPI references freer.
  */
 void flow_free_ndpi_data(struct nf_flow *flow) {
-  if (flow->ndpi_flow) { ndpi_flow_free(flow->ndpi_flow); flow->ndpi_flow = NULL; }
-  if (flow->ndpi_src) { ndpi_free(flow->ndpi_src); flow->ndpi_src = NULL; }
-  if (flow->ndpi_dst) { ndpi_free(flow->ndpi_dst); flow->ndpi_dst = NULL; }
+  if (flow->ndpi_flow) {
+    ndpi_flow_free(flow->ndpi_flow);
+    flow->ndpi_flow = NULL;
+    memory_account(MEMORY_NDPI_FLOW, -(int64_t)SIZEOF_FLOW_STRUCT);
+  }
+  if (flow->ndpi_src) {
+    host_release(flow->ndpi_src);
+    flow->ndpi_src = NULL;
+  }
+  if (flow->ndpi_dst) {
+    host_release(flow->ndpi_dst);
+    flow->ndpi_dst = NULL;
+  }
 }
 
 
 /**
  * flow_free_splt_data: SPLT fields freer.
  */
-void flow_free_splt_data(struct nf_flow *flow) {
-  if (flow->splt_direction) { ndpi_free(flow->splt_direction); flow->splt_direction = NULL; }
-  if (flow->splt_ps) { ndpi_free(flow->splt_ps); flow->splt_ps = NULL; }
-  if (flow->splt_piat_ms) { ndpi_free(flow->splt_piat_ms); flow->splt_piat_ms = NULL; }
+void flow_free_splt_data(struct nf_flow *flow, uint8_t splt) {
+  if (flow->splt_piat_ms) { // SPLT block start.
+    pool_free(flow->splt_piat_ms);
+    flow->splt_piat_ms = NULL;
+    flow->splt_ps = NULL;
+    flow->splt_direction = NULL;
+    memory_account(MEMORY_SPLT, -(int64_t)((sizeof(int64_t) + sizeof(int32_t) + sizeof(int8_t)) * splt));
+  }
   flow->splt_closed = 1;
 }
 
@@ -1283,38 +1796,55 @@ void flow_update_dst2src_tcp_flags(struct nf_flow *flow, struct nf_packet *packe
  * flow_expiration_handler: Flow expiration handler.
  */
 uint8_t flow_expiration_handler(struct nf_flow *flow, struct nf_packet *packet,
-                           uint64_t idle_timeout, uint64_t active_timeout) {
+                           uint64_t idle_timeout, uint64_t active_timeout, uint64_t tcp_linger) {
+  if (flow->timeout_policy >= 0) { // Flow protocol, port or application timeout policy.
+    idle_timeout = timeout_policies[flow->timeout_policy].idle_timeout;
+    active_timeout = timeout_policies[flow->timeout_policy].active_timeout;
+  }
   if ((packet->time - flow->bidirectional_last_seen_ms) >= idle_timeout) return 1; // Inactive expiration
   if ((packet->time - flow->bidirectional_first_seen_ms) >= active_timeout) return 2; // active expiration
-  // TCP natural expiration with id 3?
+  if (flow->closed_ms && ((packet->time - flow->closed_ms) >= tcp_linger)) return 3; // TCP natural expiration
   return 0;
 }
 
 
+/**
+ * flow_update_timeout_policy: Match flow timeout policy, again each time its detected application changes.
+ */
+void flow_update_timeout_policy(struct nf_flow *flow) {
+  flow->timeout_application = flow->detected_protocol.app_protocol;
+  flow->timeout_policy = timeout_policy_match(flow->protocol, flow->src_port, flow->dst_port,
+                                              flow->detected_protocol.master_protocol,
+                                              flow->detected_protocol.app_protocol);
+}
+
+
+/**
+ * flow_update_tcp_closing: Track TCP connection closing, closing time is set once both FINs or a RST are seen.
+ */
+void flow_update_tcp_closing(struct nf_flow *flow, struct nf_packet *packet) {
+  if ((flow->protocol != 6) || flow->closed_ms) return;
+  if (packet->rst) flow->tcp_closing |= TCP_CLOSING_RST;
+  if (packet->fin) flow->tcp_closing |= packet->direction ? TCP_CLOSING_DST2SRC_FIN : TCP_CLOSING_SRC2DST_FIN;
+  if ((flow->tcp_closing & TCP_CLOSING_RST) ||
+      (flow->tcp_closing == (TCP_CLOSING_SRC2DST_FIN | TCP_CLOSING_DST2SRC_FIN))) flow->closed_ms = packet->time;
+}
+
+
 /**
  * flow_init_splt: Flow SPLT structure initializer.
  */
 uint8_t flow_init_splt(struct nf_flow *flow, uint8_t splt, uint16_t packet_size) {
-  flow->splt_direction = (int8_t*)ndpi_malloc(sizeof(int8_t) * splt); // direction on int8 is more than sufficient.
-  if (flow->splt_direction == NULL) {
-    ndpi_free(flow);
-    return 0;
-  }
-  memset(flow->splt_direction, -1, sizeof(int8_t) * splt); // Fill it with -1 as missing data value.
-  // ps array allocation.
-  flow->splt_ps = (int32_t*)ndpi_malloc(sizeof(int32_t) * splt);
-  if (flow->splt_ps == NULL) {
-    ndpi_free(flow);
-    return 0;
-  }
-  memset(flow->splt_ps, -1, sizeof(int32_t) * splt); //-1 for missing values
-  // piat_ms array allocation
-  flow->splt_piat_ms = (int64_t*)ndpi_malloc(sizeof(int64_t) * splt); // int64 as time diff between two uint64.
-  if (flow->splt_piat_ms == NULL) {
-    ndpi_free(flow);
-    return 0;
-  }
-  memset(flow->splt_piat_ms, -1, sizeof(int64_t) * splt); // -1 for missing values
+  // SPLT arrays are allocated as a single pooled block: piat_ms (int64 as time diff between two uint64), ps (int32)
+  // and direction (int8 is more than sufficient).
+  size_t splt_size = (sizeof(int64_t) + sizeof(int32_t) + sizeof(int8_t)) * splt;
+  uint8_t *splt_block = (uint8_t *)pool_alloc(POOL_SPLT, splt_size);
+  if (splt_block == NULL) return 0;
+  memory_account(MEMORY_SPLT, splt_size);
+  flow->splt_piat_ms = (int64_t*)splt_block;
+  flow->splt_ps = (int32_t*)(splt_block + sizeof(int64_t) * splt);
+  flow->splt_direction = (int8_t*)(splt_block + (sizeof(int64_t) + sizeof(int32_t)) * splt);
+  memset(splt_block, -1, splt_size); // -1 for missing values
   // SPLT values initialization
   flow->splt_direction[0] = 0; // First packet always src->dst
   flow->splt_ps[0] = packet_size;
@@ -1345,7 +1875,7 @@ void flow_set_packet_direction(struct nf_flow *flow, struct nf_packet *packet) {
     packet->direction = 1;
   // Then IPs
   } else {
-    if ((memcmp(flow->src_ip, packet->src_ip_str, 48) != 0) || (memcmp(flow->dst_ip, packet->dst_ip_str, 48) != 0)) {
+    if ((memcmp(flow->src_ip, packet->src_ip, 16) != 0) || (memcmp(flow->dst_ip, packet->dst_ip, 16) != 0)) {
       packet->direction = 1;
     }
   }
@@ -1357,23 +1887,26 @@ void flow_set_packet_direction(struct nf_flow *flow, struct nf_packet *packet) {
  */
 uint8_t flow_init_bidirectional_dissection(struct ndpi_detection_module_struct *dissector, uint8_t n_dissections,
                                            struct nf_flow *flow, struct nf_packet *packet) {
+  // Server side (packet destination) recently detected: flow is classified without dissection (unless verifying).
+  flow->service_cached = service_cache_lookup(packet->dst_ip, packet->dst_port, packet->protocol, packet->vlan_id,
+                                              packet->time, &flow->cached_protocol);
+  if (flow->service_cached && !services_verify) {
+    flow->detected_protocol = flow->cached_protocol;
+    flow_set_application_names(dissector, flow);
+    flow->detection_completed = 1;
+    return 1;
+  }
+  // nDPI flow structure stays on nDPI allocator: ndpi_flow_free releases it along with its allocated members.
   flow->ndpi_flow = (struct ndpi_flow_struct *)ndpi_flow_malloc(SIZEOF_FLOW_STRUCT);
   if (flow->ndpi_flow == NULL) {
-    ndpi_free(flow);
     return 0;
   } else {
     memset(flow->ndpi_flow, 0, SIZEOF_FLOW_STRUCT);
+    memory_account(MEMORY_NDPI_FLOW, SIZEOF_FLOW_STRUCT);
   }
-  flow->ndpi_src = (struct ndpi_id_struct *)ndpi_calloc(1, SIZEOF_ID_STRUCT);
-  if (flow->ndpi_src == NULL)  {
-    ndpi_free(flow);
-    return 0;
-  }
-  flow->ndpi_dst = (struct ndpi_id_struct *)ndpi_calloc(1, SIZEOF_ID_STRUCT);
-  if (flow->ndpi_dst == NULL) {
-    ndpi_free(flow);
-    return 0;
-  }
+  flow->ndpi_src = host_acquire(packet->src_ip, packet->vlan_id);
+  flow->ndpi_dst = host_acquire(packet->dst_ip, packet->vlan_id);
+  if ((flow->ndpi_src == NULL) || (flow->ndpi_dst == NULL)) return 0;
   // First packet are dissected.
   flow->detected_protocol = ndpi_detection_process_packet(dissector, flow->ndpi_flow, packet->ip_content,
                                                           packet->ip_content_len, packet->time, flow->ndpi_src,
@@ -1384,6 +1917,7 @@ uint8_t flow_init_bidirectional_dissection(struct ndpi_detection_module_struct *
     flow->detected_protocol = ndpi_detection_giveup(dissector, flow->ndpi_flow, 1, &flow->guessed);
     flow_bidirectional_dissection_collect_info(dissector, flow); // Collect potentially guessed infos.
     flow->detection_completed = 1; // Close it.
+    flow_service_cache_update(flow);
     flow_free_ndpi_data(flow); // Release dissector references.
   }
   return 1;
@@ -1412,6 +1946,7 @@ void flow_update_bidirectional_dissection(struct ndpi_detection_module_struct *d
       }
       flow_bidirectional_dissection_collect_info(dissector, flow); // Collect information to flow structure.
     } else { // We are done -> Known and no extra dissection possible.
+      flow_service_cache_update(flow);
       // We release nDPI references as we are done.
       flow_free_ndpi_data(flow);
       flow->detection_completed = 1; // Detection end. (detection_completed is used to trigger copy on sync mode)
@@ -1423,6 +1958,7 @@ void flow_update_bidirectional_dissection(struct ndpi_detection_module_struct *d
         flow->detected_protocol = ndpi_detection_giveup(dissector, flow->ndpi_flow, 1, &flow->guessed);
         flow_bidirectional_dissection_collect_info(dissector, flow); // copy guessed infos if present.
       } // We reach it and detection is done, release references.
+      if (!flow->detection_completed) flow_service_cache_update(flow);
       flow_free_ndpi_data(flow);
       flow->detection_completed = 1;
     }
@@ -1576,24 +2112,31 @@ uint8_t flow_init_bidirectional(struct ndpi_detection_module_struct *dissector,
                                 struct nf_packet *packet) {
   if (splt) {
     uint8_t splt_init_success = flow_init_splt(flow, splt, packet_size);
-    if (!splt_init_success) return 0;
+    if (!splt_init_success) {
+      pool_free(flow);
+      return 0;
+    }
   }
 
   if (n_dissections) { // we are configured to dissect
     uint8_t init_bidirectional_dissection_success = flow_init_bidirectional_dissection(dissector, n_dissections,
                                                                                        flow, packet);
-    if (!init_bidirectional_dissection_success) return 0;
+    if (!init_bidirectional_dissection_success) { // Release what was initialized so far (SPLT block, nDPI data).
+      flow_free_ndpi_data(flow);
+      if (splt) flow_free_splt_data(flow, splt);
+      pool_free(flow);
+      return 0;
+    }
   }
   // Classical flow initialization.
   flow->bidirectional_first_seen_ms = packet->time;
   flow->bidirectional_last_seen_ms = packet->time;
-  memcpy(flow->src_ip, packet->src_ip_str, 48);
-  memcpy(flow->src_mac, packet->src_mac, 18);
-  memcpy(flow->src_oui, packet->src_oui, 9);
+  memcpy(flow->src_ip, packet->src_ip, 16);
+  memcpy(flow->src_mac, packet->src_mac, 6);
   flow->src_port = packet->src_port;
-  memcpy(flow->dst_ip, packet->dst_ip_str, 48);
-  memcpy(flow->dst_mac, packet->dst_mac, 18);
-  memcpy(flow->dst_oui, packet->dst_oui, 9);
+  memcpy(flow->dst_ip, packet->dst_ip, 16);
+  memcpy(flow->dst_mac, packet->dst_mac, 6);
+  flow->has_mac = packet->has_mac;
   flow->dst_port = packet->dst_port;
   flow->protocol = packet->protocol;
   flow->ip_version = packet->ip_version;
@@ -1692,83 +2235,1015 @@ void flow_update_dst2src(uint8_t statistics, uint16_t packet_size, struct nf_flo
 }
 
 
-/*
-------------------------------------------------------------------------------------------------------------------------
-                                           Engine APIs
-------------------------------------------------------------------------------------------------------------------------
-*/
+/***************************************** Anonymizer layer ***********************************************************/
 
 
-/***************************************** Capture APIs ***************************************************************/
+// Prefix preserving anonymization cache entry: original prefix and its computed one time pad bits.
+typedef struct nf_anonymizer_entry {
+  uint64_t prefix;
+  uint64_t pad;
+  uint8_t used;
+} nf_anonymizer_entry_t;
+
+
+// Prefix preserving (Crypto-PAn) anonymizer.
+typedef struct nf_anonymizer {
+  gcry_cipher_hd_t cipher;
+  uint8_t pad[16];
+  uint32_t cache_size;
+  struct nf_anonymizer_entry *ipv4_cache; // keyed by /24 prefixes.
+  struct nf_anonymizer_entry *ipv6_cache; // keyed by /64 prefixes.
+  uint64_t cache_hits;
+  uint64_t cache_misses;
+} nf_anonymizer_t;
 
 
 /**
- * capture_open: Open a pcap file or a specified device.
+ * anonymizer_hash: 64 bits mixer (splitmix64 finalizer) used to index prefix caches.
  */
-pcap_t * capture_open(const uint8_t * pcap_file, int mode, int root_idx) {
-  pcap_t * pcap_handle = NULL;
-  char pcap_error_buffer[PCAP_ERRBUF_SIZE];
-  if (mode == 0) {
-    pcap_handle = pcap_open_offline((char*)pcap_file, pcap_error_buffer);
-  }
-  if (mode == 1) {
-    pcap_handle = pcap_create((char*)pcap_file, pcap_error_buffer);
-  }
-  if (pcap_handle != NULL) {
-    return pcap_handle;
-  } else {
-    if (root_idx == 0) printf("ERROR: Unable to open source %s: %s\n", pcap_file, pcap_error_buffer);
-    return NULL;
-  }
+uint64_t anonymizer_hash(uint64_t x) {
+  x ^= x >> 30;
+  x *= 0xbf58476d1ce4e5b9ULL;
+  x ^= x >> 27;
+  x *= 0x94d049bb133111ebULL;
+  x ^= x >> 31;
+  return x;
 }
 
 
 /**
- * capture_set_fanout: Set fanout mode.
+ * anonymizer_pseudorandom_bits: Compute Crypto-PAn one time pad bits in [from_bit, to_bit[ range.
  */
-int capture_set_fanout(pcap_t * pcap_handle, int mode, int root_idx) {
-  int set_fanout = 0;
-  if (mode == 0) return set_fanout;
-  else {
-#ifdef __linux__
-    set_fanout = pcap_set_fanout_linux(pcap_handle, 1, 0x8000, 0);
-    if (set_fanout != 0) {
-      pcap_close(pcap_handle);
-      if (root_idx == 0) printf("ERROR: Unable to setup fanout mode.\n");
+void anonymizer_pseudorandom_bits(struct nf_anonymizer *anonymizer, const uint8_t *orig, uint16_t from_bit,
+                                  uint16_t to_bit, uint8_t *otp) {
+  uint8_t input[16], output[16];
+  for (uint16_t pos = from_bit; pos < to_bit; pos++) {
+    // Input block: first pos bits from original address, remaining ones from the secret pad.
+    uint16_t full_bytes = pos >> 3;
+    uint8_t remaining_bits = pos & 7;
+    memcpy(input, anonymizer->pad, 16);
+    memcpy(input, orig, full_bytes);
+    if (remaining_bits) {
+      uint8_t mask = (uint8_t)(0xFF << (8 - remaining_bits));
+      input[full_bytes] = (orig[full_bytes] & mask) | (anonymizer->pad[full_bytes] & ~mask);
     }
-#endif
-  return set_fanout;
+    gcry_cipher_encrypt(anonymizer->cipher, output, 16, input, 16);
+    // Most significant bit of the encrypted block is the pad bit for position pos.
+    if (output[0] & 0x80) otp[full_bytes] |= (uint8_t)(0x80 >> remaining_bits);
   }
 }
 
 
 /**
- * capture_activate: Activate capture.
+ * anonymizer_address: Prefix preserving anonymization of a binary address (network byte order) in place.
  */
-int capture_activate(pcap_t * pcap_handle, int mode, int root_idx) {
-  int set_activate = 0;
-  if (mode == 0) return set_activate;
-  else {
-    set_activate = pcap_activate(pcap_handle);
-    if (set_activate != 0) {
-      pcap_close(pcap_handle);
-      if (root_idx == 0) printf("ERROR: Unable to activate source.\n");
-    }
-  return set_activate;
+void anonymizer_address(struct nf_anonymizer *anonymizer, uint8_t *addr, uint8_t n_bytes) {
+  uint8_t otp[16] = {0};
+  uint8_t prefix_bytes = (n_bytes == 4) ? 3 : 8; // cache granularity: /24 for IPv4 and /64 for IPv6.
+  struct nf_anonymizer_entry *cache = (n_bytes == 4) ? anonymizer->ipv4_cache : anonymizer->ipv6_cache;
+  uint64_t prefix = 0;
+  for (uint8_t i = 0; i < prefix_bytes; i++) prefix = (prefix << 8) | addr[i];
+  struct nf_anonymizer_entry *entry = &cache[anonymizer_hash(prefix) % anonymizer->cache_size];
+  if (entry->used && (entry->prefix == prefix)) { // prefix pad bits already computed.
+    anonymizer->cache_hits++;
+    for (uint8_t i = 0; i < prefix_bytes; i++) otp[i] = (uint8_t)(entry->pad >> (8 * (prefix_bytes - 1 - i)));
+  } else {
+    anonymizer->cache_misses++;
+    anonymizer_pseudorandom_bits(anonymizer, addr, 0, prefix_bytes * 8, otp);
+    entry->prefix = prefix;
+    entry->pad = 0;
+    for (uint8_t i = 0; i < prefix_bytes; i++) entry->pad = (entry->pad << 8) | otp[i];
+    entry->used = 1;
   }
+  anonymizer_pseudorandom_bits(anonymizer, addr, prefix_bytes * 8, n_bytes * 8, otp);
+  for (uint8_t i = 0; i < n_bytes; i++) addr[i] ^= otp[i];
 }
 
 
+/***************************************** Window layer ***************************************************************/
+
+
+// Offline capture window of current process: packets timestamped out of [window_start, window_end) (ms) are skipped
+// or end the capture, packets recorded out of [chunk_start, chunk_end) offsets are parallel chunk lookback/overflow
+// ones and packets recorded from chunk_next offset are also read by next chunk meter as its lookback.
+static uint64_t window_start = 0, window_end = UINT64_MAX;
+static int64_t chunk_start = -1, chunk_end = -1, chunk_next = -1;
+
+
 /**
- * capture_set_timeout: Set buffer timeout.
+ * window_position: Packet position relative to capture time window (-1: before, 0: within, 1: after).
  */
-int capture_set_timeout(pcap_t * pcap_handle, int mode, int root_idx) {
-  int set_timeout = 0;
-  if (mode == 0) return set_timeout;
+int window_position(const struct pcap_pkthdr *header) {
+  uint64_t time = ((uint64_t) header->ts.tv_sec) * TICK_RESOLUTION + header->ts.tv_usec / (1000000 / TICK_RESOLUTION);
+  if (time < window_start) return -1;
+  if (time >= window_end) return 1;
+  return 0;
+}
+
+
+/**
+ * window_chunk_position: Record offset position relative to parallel chunk (1: within, 3: lookback, 4: overflow,
+ *                        5: within and next chunk lookback).
+ */
+int window_chunk_position(int64_t offset) {
+  if ((chunk_start < 0) || (offset < 0)) return 1;
+  if (offset < chunk_start) return 3;
+  if ((chunk_end >= 0) && (offset >= chunk_end)) return 4;
+  if ((chunk_next >= 0) && (offset >= chunk_next)) return 5;
+  return 1;
+}
+
+
+/***************************************** Replay layer ***************************************************************/
+
+
+#define REPLAY_TIMEOUT         1000000  // Replay buffer timeout (us), same as live capture one.
+#define REPLAY_BUFFER_SIZE     2097152  // Replay buffer size (bytes), same as libpcap default one.
+
+
+// Replayed packet stored in replay buffer.
+typedef struct nf_replay_packet {
+  struct pcap_pkthdr header;
+  struct nf_replay_packet *next;
+  uint8_t data[];
+} nf_replay_packet_t;
+
+
+// Real-time pcap replay state: packets arrive at recorded pace (divided by speed) in a bounded buffer.
+typedef struct nf_replay {
+  pcap_t *pcap_handle;
+  double speed;
+  uint64_t origin_ts;                // first packet timestamp (us).
+  uint64_t origin_wall;              // wall clock time at first packet read (us).
+  struct pcap_pkthdr *pending_hdr;   // next packet read from file and not yet arrived.
+  const uint8_t *pending_data;
+  int pending;                       // 1: pending packet, 0: none, -2: end of file.
+  struct nf_replay_packet *head, *tail, *current;
+  uint64_t buffered_bytes;
+  unsigned received, dropped;
+  struct nf_replay *next;
+} nf_replay_t;
+
+
+static struct nf_replay *replays = NULL; // Replay states of current process (one per replayed capture).
+
+
+/**
+ * replay_wall_clock: Current wall clock time in microseconds.
+ */
+uint64_t replay_wall_clock(void) {
+  struct timeval now;
+  gettimeofday(&now, NULL);
+  return ((uint64_t) now.tv_sec) * 1000000 + now.tv_usec;
+}
+
+
+/**
+ * replay_get: Get replay state of a capture handle.
+ */
+struct nf_replay *replay_get(pcap_t * pcap_handle) {
+  struct nf_replay *replay = replays;
+  while ((replay != NULL) && (replay->pcap_handle != pcap_handle)) replay = replay->next;
+  return replay;
+}
+
+
+/**
+ * replay_arrival: Wall clock arrival time of pending packet.
+ */
+uint64_t replay_arrival(struct nf_replay *replay) {
+  uint64_t ts = ((uint64_t) replay->pending_hdr->ts.tv_sec) * 1000000 + replay->pending_hdr->ts.tv_usec;
+  if (ts < replay->origin_ts) return replay->origin_wall; // Not time ordered capture.
+  return replay->origin_wall + (uint64_t)((ts - replay->origin_ts) / replay->speed);
+}
+
+
+/**
+ * replay_read: Read next packet from file as pending one.
+ */
+void replay_read(struct nf_replay *replay) {
+  int rv_handle = pcap_next_ex(replay->pcap_handle, &replay->pending_hdr, &replay->pending_data);
+  while ((rv_handle == 1) && (window_position(replay->pending_hdr) < 0)) { // Recorded before time window.
+    rv_handle = pcap_next_ex(replay->pcap_handle, &replay->pending_hdr, &replay->pending_data);
+  }
+  if ((rv_handle == 1) && (window_position(replay->pending_hdr) == 0)) {
+    if (replay->origin_wall == 0) { // First packet: replay timeline origin.
+      replay->origin_ts = ((uint64_t) replay->pending_hdr->ts.tv_sec) * 1000000 + replay->pending_hdr->ts.tv_usec;
+      replay->origin_wall = replay_wall_clock();
+    }
+    replay->pending = 1;
+  } else {
+    replay->pending = -2; // End of file, of time window (or read error).
+  }
+}
+
+
+/**
+ * replay_drop: Account pending packet drop. Each meter replays the whole capture, so a drop is accounted only by the
+ *              meter owning the packet (packets ignored by parsing by first meter): meters drops sum to lost packets.
+ */
+void replay_drop(struct nf_replay *replay, int decode_tunnels, int n_roots, int root_idx) {
+  struct nf_packet nf_pkt;
+  memset(&nf_pkt, 0, sizeof(struct nf_packet));
+  int rv_processor = packet_process(replay->pcap_handle, replay->pending_hdr, replay->pending_data, decode_tunnels,
+                                    &nf_pkt, n_roots, root_idx, 2);
+  if ((rv_processor == 1) || ((rv_processor == 0) && (root_idx == 0))) replay->dropped++;
+}
+
+
+/**
+ * replay_admit: Move arrived pending packet to replay buffer (dropped as in kernel when buffer is full).
+ */
+void replay_admit(struct nf_replay *replay, int decode_tunnels, int n_roots, int root_idx) {
+  uint64_t arrival = replay_arrival(replay);
+  uint32_t caplen = replay->pending_hdr->caplen;
+  replay->received++;
+  replay->pending = 0;
+  if (replay->buffered_bytes + caplen > REPLAY_BUFFER_SIZE) {
+    replay_drop(replay, decode_tunnels, n_roots, root_idx);
+    return;
+  }
+  struct nf_replay_packet *packet = (struct nf_replay_packet*)malloc(sizeof(struct nf_replay_packet) + caplen);
+  if (packet == NULL) {
+    replay_drop(replay, decode_tunnels, n_roots, root_idx);
+    return;
+  }
+  packet->header = *replay->pending_hdr;
+  packet->header.ts.tv_sec = arrival / 1000000; // Replayed packets are timestamped at their arrival.
+  packet->header.ts.tv_usec = arrival % 1000000;
+  packet->next = NULL;
+  memcpy(packet->data, replay->pending_data, caplen);
+  if (replay->tail != NULL) replay->tail->next = packet;
+  else replay->head = packet;
+  replay->tail = packet;
+  replay->buffered_bytes += caplen;
+}
+
+
+/**
+ * replay_next: Get next replayed packet. Return 1 on packet, 0 on buffer timeout and -2 at end of replay.
+ */
+int replay_next(struct nf_replay *replay, int decode_tunnels, int n_roots, int root_idx, struct pcap_pkthdr **hdr,
+                const uint8_t **data) {
+  if (replay->current != NULL) { // Previous packet is now processed.
+    free(replay->current);
+    replay->current = NULL;
+  }
+  uint64_t now = replay_wall_clock();
+  for (;;) { // Admit all packets arrived while meter was busy.
+    if (replay->pending == 0) replay_read(replay);
+    if ((replay->pending != 1) || (replay_arrival(replay) > now)) break;
+    replay_admit(replay, decode_tunnels, n_roots, root_idx);
+  }
+  if (replay->head == NULL) { // Empty buffer: wait for next packet arrival.
+    if (replay->pending != 1) return -2;
+    uint64_t arrival = replay_arrival(replay);
+    if (arrival - now > REPLAY_TIMEOUT) {
+      usleep(REPLAY_TIMEOUT);
+      return 0;
+    }
+    usleep(arrival - now);
+    replay_admit(replay, decode_tunnels, n_roots, root_idx);
+    if (replay->head == NULL) return 0;
+  }
+  replay->current = replay->head;
+  replay->head = replay->head->next;
+  if (replay->head == NULL) replay->tail = NULL;
+  replay->buffered_bytes -= replay->current->header.caplen;
+  *hdr = &replay->current->header;
+  *data = replay->current->data;
+  return 1;
+}
+
+
+/**
+ * replay_free: Release replay state of a capture handle.
+ */
+void replay_free(pcap_t * pcap_handle) {
+  struct nf_replay **link = &replays;
+  while ((*link != NULL) && ((*link)->pcap_handle != pcap_handle)) link = &(*link)->next;
+  struct nf_replay *replay = *link;
+  if (replay == NULL) return;
+  *link = replay->next;
+  if (replay->current != NULL) free(replay->current);
+  while (replay->head != NULL) {
+    struct nf_replay_packet *packet = replay->head;
+    replay->head = packet->next;
+    free(packet);
+  }
+  free(replay);
+}
+
+
+/***************************************** Ring layer *****************************************************************/
+
+#define CAPTURE_BACKEND_PCAP         0
+#define CAPTURE_BACKEND_PACKET_MMAP  1
+#define RING_BLOCK_SIZE              262144   // TPACKET_V3 block size (bytes), retired when full or on timeout.
+#define RING_FRAME_SIZE              2048
+#define RING_DEFAULT_SIZE            2097152  // Ring size (bytes) when no buffer size is set, same as libpcap one.
+#define RING_DATALINK                DLT_EN10MB
+#ifndef ETH_P_ALL
+#define ETH_P_ALL                    0x0003
+#endif
+#define FANOUT_FLAG_DEFRAG           0x8000
+#define FANOUT_FLAG_UNIQUEID         0x2000   // Kernel allocates an unused group id (first member of a new group).
+
+
+// Direct TPACKET_V3 capture state: a memory mapped ring shared with kernel, read without any copy.
+typedef struct nf_ring {
+  pcap_t *pcap_handle;               // Dead handle: capture identity, datalink and BPF compilation.
+  char device[64];
+  int fd;
+  uint8_t *map;
+  uint32_t block_count;
+  uint32_t current_block;
+  uint8_t *frame;                    // Next frame of current block (NULL when current block is not owned).
+  uint32_t remaining;                // Frames left in current block.
+  struct pcap_pkthdr header;
+  uint8_t *vlan_packet;              // Packet rebuilt with its VLAN tag (stripped by kernel).
+  int timeout, buffer_size, promisc, fanout_mode, group_id;
+  uint8_t nonblock;                  // Do not wait for blocks (captures multiplexed by capture_wait).
+  unsigned snaplen;
+  uint8_t immediate;
+  unsigned received, dropped;
+  struct nf_ring *next;
+} nf_ring_t;
+
+
+static struct nf_ring *rings = NULL; // Ring states of current process (one per live capture).
+
+
+/**
+ * ring_get: Get ring state of a capture handle (NULL for libpcap backed captures).
+ */
+struct nf_ring *ring_get(pcap_t * pcap_handle) {
+  struct nf_ring *ring = rings;
+  while ((ring != NULL) && (ring->pcap_handle != pcap_handle)) ring = ring->next;
+  return ring;
+}
+
+
+/**
+ * ring_open: Create ring state for a device. Returned dead handle stands for the capture handle.
+ */
+pcap_t *ring_open(const char *device) {
+#ifdef __linux__
+  if (strlen(device) >= sizeof(((struct nf_ring *)0)->device)) return NULL;
+  struct nf_ring *ring = (struct nf_ring*)calloc(1, sizeof(struct nf_ring));
+  if (ring == NULL) return NULL;
+  ring->pcap_handle = pcap_open_dead(RING_DATALINK, 65535);
+  if (ring->pcap_handle == NULL) {
+    free(ring);
+    return NULL;
+  }
+  strcpy(ring->device, device);
+  ring->fd = -1;
+  ring->timeout = 1000;
+  ring->snaplen = 65535;
+  ring->next = rings;
+  rings = ring;
+  return ring->pcap_handle;
+#else
+  return NULL;
+#endif
+}
+
+
+/**
+ * ring_activate: Bind a TPACKET_V3 socket to ring device, map its ring and join fanout group. Return 0 on success.
+ */
+int ring_activate(struct nf_ring *ring) {
+#ifdef __linux__
+  int version = TPACKET_V3;
+  uint32_t ring_size = ring->buffer_size ? (uint32_t)ring->buffer_size : RING_DEFAULT_SIZE;
+  struct tpacket_req3 req;
+  memset(&req, 0, sizeof(req));
+  req.tp_block_size = RING_BLOCK_SIZE;
+  req.tp_block_nr = ring_size / RING_BLOCK_SIZE > 1 ? ring_size / RING_BLOCK_SIZE : 2;
+  req.tp_frame_size = RING_FRAME_SIZE;
+  req.tp_frame_nr = (req.tp_block_size * req.tp_block_nr) / req.tp_frame_size;
+  req.tp_retire_blk_tov = ring->immediate ? 1 : ring->timeout; // Partially filled blocks are retired on timeout.
+  ring->vlan_packet = (uint8_t*)malloc(ring->snaplen + 4);
+  ring->fd = socket(AF_PACKET, SOCK_RAW, htons(ETH_P_ALL));
+  if ((ring->vlan_packet == NULL) || (ring->fd < 0)) return 1;
+  if (setsockopt(ring->fd, SOL_PACKET, PACKET_VERSION, &version, sizeof(version)) != 0) return 1;
+  if (setsockopt(ring->fd, SOL_PACKET, PACKET_RX_RING, &req, sizeof(req)) != 0) return 1;
+  ring->map = (uint8_t*)mmap(NULL, (size_t)req.tp_block_size * req.tp_block_nr, PROT_READ | PROT_WRITE,
+                             MAP_SHARED, ring->fd, 0);
+  if (ring->map == MAP_FAILED) {
+    ring->map = NULL;
+    return 1;
+  }
+  ring->block_count = req.tp_block_nr;
+  struct sockaddr_ll address;
+  memset(&address, 0, sizeof(address));
+  address.sll_family = AF_PACKET;
+  address.sll_protocol = htons(ETH_P_ALL);
+  address.sll_ifindex = if_nametoindex(ring->device);
+  if ((address.sll_ifindex == 0) || (bind(ring->fd, (struct sockaddr *)&address, sizeof(address)) != 0)) return 1;
+  if (ring->promisc) {
+    struct packet_mreq membership;
+    memset(&membership, 0, sizeof(membership));
+    membership.mr_ifindex = address.sll_ifindex;
+    membership.mr_type = PACKET_MR_PROMISC;
+    if (setsockopt(ring->fd, SOL_PACKET, PACKET_ADD_MEMBERSHIP, &membership, sizeof(membership)) != 0) return 1;
+  }
+  uint32_t fanout_flags = FANOUT_FLAG_DEFRAG | ((ring->group_id < 0) ? FANOUT_FLAG_UNIQUEID : 0);
+  uint32_t fanout = ((ring->group_id < 0) ? 0 : ((uint32_t)ring->group_id & 0xFFFF)) |
+                    ((fanout_flags | (uint32_t)ring->fanout_mode) << 16);
+  if (setsockopt(ring->fd, SOL_PACKET, PACKET_FANOUT, &fanout, sizeof(fanout)) != 0) return 1;
+  return 0;
+#else
+  return 1;
+#endif
+}
+
+
+/**
+ * ring_set_filter: Attach a compiled BPF filter to ring socket. Return 0 on success.
+ */
+int ring_set_filter(struct nf_ring *ring, struct bpf_program *fcode) {
+#ifdef __linux__
+  struct sock_fprog program;
+  program.len = fcode->bf_len;
+  program.filter = (struct sock_filter *)fcode->bf_insns;
+  return setsockopt(ring->fd, SOL_SOCKET, SO_ATTACH_FILTER, &program, sizeof(program)) != 0;
+#else
+  return 1;
+#endif
+}
+
+
+/**
+ * ring_next: Get next packet from ring. Return 1 on packet and 0 on timeout (or error).
+ */
+int ring_next(struct nf_ring *ring, struct pcap_pkthdr **hdr, const uint8_t **data) {
+#ifdef __linux__
+  for (;;) {
+    struct tpacket_block_desc *block = (struct tpacket_block_desc *)(ring->map + (size_t)ring->current_block *
+                                                                     RING_BLOCK_SIZE);
+    if (ring->frame == NULL) { // Wait for current block to be retired by kernel.
+      if (!(block->hdr.bh1.block_status & TP_STATUS_USER)) {
+        struct pollfd pfd;
+        pfd.fd = ring->fd;
+        pfd.events = POLLIN | POLLERR;
+        pfd.revents = 0;
+        if (poll(&pfd, 1, ring->nonblock ? 0 : ring->timeout) <= 0) return 0;
+        if (!(block->hdr.bh1.block_status & TP_STATUS_USER)) return 0;
+      }
+      ring->frame = (uint8_t *)block + block->hdr.bh1.offset_to_first_pkt;
+      ring->remaining = block->hdr.bh1.num_pkts;
+    }
+    if (ring->remaining == 0) { // Block consumed (and its last packet processed): give it back to kernel.
+      __sync_synchronize();
+      block->hdr.bh1.block_status = TP_STATUS_KERNEL;
+      ring->current_block = (ring->current_block + 1) % ring->block_count;
+      ring->frame = NULL;
+      continue;
+    }
+    struct tpacket3_hdr *frame = (struct tpacket3_hdr *)ring->frame;
+    ring->remaining--;
+    ring->frame += frame->tp_next_offset;
+    uint8_t *packet = (uint8_t *)frame + frame->tp_mac;
+    uint32_t caplen = frame->tp_snaplen < ring->snaplen ? frame->tp_snaplen : ring->snaplen;
+    ring->header.ts.tv_sec = frame->tp_sec;
+    ring->header.ts.tv_usec = frame->tp_nsec / 1000;
+    ring->header.len = frame->tp_len;
+    if ((frame->tp_status & TP_STATUS_VLAN_VALID) && (caplen >= 12)) { // Reinsert VLAN tag after MAC addresses.
+      uint16_t tpid = htons((frame->tp_status & TP_STATUS_VLAN_TPID_VALID) ? frame->hv1.tp_vlan_tpid : 0x8100);
+      uint16_t tci = htons(frame->hv1.tp_vlan_tci);
+      memcpy(ring->vlan_packet, packet, 12);
+      memcpy(ring->vlan_packet + 12, &tpid, 2);
+      memcpy(ring->vlan_packet + 14, &tci, 2);
+      memcpy(ring->vlan_packet + 16, packet + 12, caplen - 12);
+      packet = ring->vlan_packet;
+      caplen += 4;
+      ring->header.len += 4;
+    }
+    ring->header.caplen = caplen;
+    *hdr = &ring->header;
+    *data = packet;
+    return 1;
+  }
+#else
+  return 0;
+#endif
+}
+
+
+/**
+ * ring_stats: Update ring cumulative statistics (kernel counters are reset on each read).
+ */
+void ring_stats(struct nf_ring *ring) {
+#ifdef __linux__
+  struct tpacket_stats_v3 statistics;
+  socklen_t length = sizeof(statistics);
+  if ((ring->fd >= 0) && (getsockopt(ring->fd, SOL_PACKET, PACKET_STATISTICS, &statistics, &length) == 0)) {
+    ring->received += statistics.tp_packets;
+    ring->dropped += statistics.tp_drops;
+  }
+#endif
+}
+
+
+/**
+ * ring_free: Release ring state of a capture handle.
+ */
+void ring_free(pcap_t * pcap_handle) {
+  struct nf_ring **link = &rings;
+  while ((*link != NULL) && ((*link)->pcap_handle != pcap_handle)) link = &(*link)->next;
+  struct nf_ring *ring = *link;
+  if (ring == NULL) return;
+  *link = ring->next;
+  if (ring->map != NULL) munmap(ring->map, (size_t)ring->block_count * RING_BLOCK_SIZE);
+  if (ring->fd >= 0) close(ring->fd);
+  if (ring->vlan_packet != NULL) free(ring->vlan_packet);
+  free(ring);
+}
+
+
+/***************************************** Mmap layer *****************************************************************/
+
+#define PCAPNG_SECTION_HEADER_BLOCK      0x0A0D0D0A
+#define PCAPNG_INTERFACE_BLOCK           0x00000001
+#define PCAPNG_PACKET_BLOCK              0x00000002  // Obsolete packet block.
+#define PCAPNG_SIMPLE_PACKET_BLOCK       0x00000003
+#define PCAPNG_ENHANCED_PACKET_BLOCK     0x00000006
+#define PCAPNG_BYTE_ORDER_MAGIC          0x1A2B3C4D
+#define PCAPNG_OPTION_TSRESOL            9
+#define PCAPNG_OPTION_TSOFFSET           14
+#define MMAP_SNAPLEN                     262144
+#define LINKTYPE_RAW                     101         // Stored link-layer type of DLT_RAW (platform dependent value).
+
+
+// pcapng interface timestamps resolution (units per second) and offset (seconds).
+typedef struct nf_mmap_interface {
+  uint64_t tsresol;
+  int64_t tsoffset;
+} nf_mmap_interface_t;
+
+
+// Memory mapped pcap/pcapng file state: records are parsed in place and packets handed over without any copy.
+typedef struct nf_mmap {
+  pcap_t *pcap_handle;               // Dead handle: capture identity, datalink and BPF compilation.
+  char *path;
+  uint8_t *map;
+  size_t size;
+  size_t position;                   // Next record (or block) offset.
+  uint64_t records;                  // Packet records read so far.
+  pcap_t *fallback;                  // libpcap handle reading remaining records once an anomaly is met.
+  uint8_t pcapng;
+  uint8_t swapped;                   // File (or current section) byte order differs from host one.
+  uint32_t ts_divisor;               // Classic pcap timestamp fraction divisor to microseconds.
+  int linktype;
+  struct nf_mmap_interface *interfaces;
+  uint32_t n_interfaces, interfaces_size;
+  struct bpf_program filter;
+  uint8_t filtered;
+  struct pcap_pkthdr header;
+  struct nf_mmap *next;
+} nf_mmap_t;
+
+
+static struct nf_mmap *mmaps = NULL; // Memory mapped files of current process (one per offline capture).
+
+
+/**
+ * mmap_get: Get memory mapped state of a capture handle (NULL for libpcap backed captures).
+ */
+struct nf_mmap *mmap_get(pcap_t * pcap_handle) {
+  struct nf_mmap *mapped = mmaps;
+  while ((mapped != NULL) && (mapped->pcap_handle != pcap_handle)) mapped = mapped->next;
+  return mapped;
+}
+
+
+/**
+ * mmap_u16: Read a 16 bits field of memory mapped file in host byte order.
+ */
+uint16_t mmap_u16(struct nf_mmap *mapped, size_t offset) {
+  uint16_t value;
+  memcpy(&value, mapped->map + offset, sizeof(value));
+  return mapped->swapped ? (uint16_t)((value >> 8) | (value << 8)) : value;
+}
+
+
+/**
+ * mmap_u32: Read a 32 bits field of memory mapped file in host byte order.
+ */
+uint32_t mmap_u32(struct nf_mmap *mapped, size_t offset) {
+  uint32_t value;
+  memcpy(&value, mapped->map + offset, sizeof(value));
+  return mapped->swapped ? __builtin_bswap32(value) : value;
+}
+
+
+/**
+ * mmap_section: Parse a pcapng section header block (section byte order, interfaces reset). Return 0 on success.
+ */
+int mmap_section(struct nf_mmap *mapped, size_t offset) {
+  uint32_t magic;
+  if (offset + 12 > mapped->size) return 1;
+  memcpy(&magic, mapped->map + offset + 8, sizeof(magic));
+  if (magic == PCAPNG_BYTE_ORDER_MAGIC) mapped->swapped = 0;
+  else if (magic == __builtin_bswap32(PCAPNG_BYTE_ORDER_MAGIC)) mapped->swapped = 1;
+  else return 1;
+  mapped->n_interfaces = 0;
+  return 0;
+}
+
+
+/**
+ * mmap_interface: Parse a pcapng interface description block of length bytes. Return 0 on success.
+ */
+int mmap_interface(struct nf_mmap *mapped, size_t offset, uint32_t length) {
+  if (length < 20) return 1;
+  int linktype = (int)mmap_u16(mapped, offset + 8);
+  if ((mapped->linktype >= 0) && (linktype != mapped->linktype)) return 1; // Single datalink, as libpcap.
+  mapped->linktype = linktype;
+  if (mapped->n_interfaces == mapped->interfaces_size) {
+    uint32_t interfaces_size = mapped->interfaces_size ? mapped->interfaces_size * 2 : 4;
+    struct nf_mmap_interface *interfaces = (struct nf_mmap_interface*)realloc(mapped->interfaces,
+                                                                              interfaces_size *
+                                                                              sizeof(struct nf_mmap_interface));
+    if (interfaces == NULL) return 1;
+    mapped->interfaces = interfaces;
+    mapped->interfaces_size = interfaces_size;
+  }
+  struct nf_mmap_interface *interface = &mapped->interfaces[mapped->n_interfaces++];
+  interface->tsresol = 1000000;
+  interface->tsoffset = 0;
+  size_t option = offset + 16, end = offset + length - 4;
+  while (option + 4 <= end) {
+    uint16_t code = mmap_u16(mapped, option), option_length = mmap_u16(mapped, option + 2);
+    if ((code == 0) || (option + 4 + option_length > end)) break; // opt_endofopt or malformed.
+    if ((code == PCAPNG_OPTION_TSRESOL) && (option_length >= 1)) {
+      uint8_t tsresol = mapped->map[option + 4];
+      uint8_t exponent = tsresol & 0x7F;
+      if (exponent < ((tsresol & 0x80) ? 64 : 20)) { // Power of 2 (most significant bit set) or of 10.
+        interface->tsresol = 1;
+        for (uint8_t i = 0; i < exponent; i++) interface->tsresol *= (tsresol & 0x80) ? 2 : 10;
+      }
+    } else if ((code == PCAPNG_OPTION_TSOFFSET) && (option_length >= 8)) {
+      uint64_t tsoffset;
+      memcpy(&tsoffset, mapped->map + option + 4, sizeof(tsoffset));
+      interface->tsoffset = (int64_t)(mapped->swapped ? __builtin_bswap64(tsoffset) : tsoffset);
+    }
+    option += 4 + ((option_length + 3) & ~3);
+  }
+  return 0;
+}
+
+
+/**
+ * mmap_timestamp: Set packet header timestamp from a pcapng interface timestamp.
+ */
+void mmap_timestamp(struct nf_mmap *mapped, uint32_t interface_id, uint64_t ts) {
+  uint64_t tsresol = 1000000;
+  int64_t tsoffset = 0;
+  if (interface_id < mapped->n_interfaces) {
+    tsresol = mapped->interfaces[interface_id].tsresol;
+    tsoffset = mapped->interfaces[interface_id].tsoffset;
+  }
+  uint64_t fraction = ts % tsresol;
+  mapped->header.ts.tv_sec = (time_t)(ts / tsresol + tsoffset);
+  if (tsresol == 1000000) mapped->header.ts.tv_usec = (suseconds_t)fraction;
+  else if (tsresol % 1000000 == 0) mapped->header.ts.tv_usec = (suseconds_t)(fraction / (tsresol / 1000000));
+  else mapped->header.ts.tv_usec = (suseconds_t)((double)fraction * 1000000.0 / (double)tsresol);
+}
+
+
+/**
+ * mmap_open: Memory map a pcap or pcapng file. Returned dead handle stands for the capture handle (NULL when file
+ *            cannot be mapped, it is then read through libpcap).
+ */
+pcap_t *mmap_open(const char *path) {
+  struct stat file_stat;
+  // Anything but a regular file (e.g. a streamed source FIFO) is left unopened: opening a FIFO wakes up its writer.
+  if ((stat(path, &file_stat) != 0) || !S_ISREG(file_stat.st_mode)) return NULL;
+  int fd = open(path, O_RDONLY | O_NONBLOCK);
+  if (fd < 0) return NULL;
+  if ((fstat(fd, &file_stat) != 0) || !S_ISREG(file_stat.st_mode) || (file_stat.st_size < 24)) {
+    close(fd);
+    return NULL;
+  }
+  uint8_t *map = (uint8_t *)mmap(NULL, (size_t)file_stat.st_size, PROT_READ, MAP_SHARED, fd, 0);
+  close(fd); // Mapping holds its own reference to file.
+  if (map == MAP_FAILED) return NULL;
+  madvise(map, (size_t)file_stat.st_size, MADV_SEQUENTIAL); // Read ahead aggressively and drop consumed pages.
+  struct nf_mmap *mapped = (struct nf_mmap*)calloc(1, sizeof(struct nf_mmap));
+  if (mapped == NULL) {
+    munmap(map, (size_t)file_stat.st_size);
+    return NULL;
+  }
+  mapped->path = strdup(path);
+  if (mapped->path == NULL) {
+    munmap(map, (size_t)file_stat.st_size);
+    free(mapped);
+    return NULL;
+  }
+  mapped->map = map;
+  mapped->size = (size_t)file_stat.st_size;
+  mapped->linktype = -1;
+  uint32_t magic;
+  memcpy(&magic, map, sizeof(magic));
+  if ((magic == 0xa1b2c3d4) || (magic == 0xa1b23c4d) ||
+      (magic == 0xd4c3b2a1) || (magic == 0x4d3cb2a1)) { // Classic pcap, microsecond or nanosecond timestamps.
+    mapped->swapped = (magic == 0xd4c3b2a1) || (magic == 0x4d3cb2a1);
+    mapped->ts_divisor = ((magic == 0xa1b2c3d4) || (magic == 0xd4c3b2a1)) ? 1 : 1000;
+    mapped->linktype = (int)(mmap_u32(mapped, 20) & 0xFFFF); // Upper bits carry FCS information.
+    mapped->position = 24;
+  } else if ((magic == PCAPNG_SECTION_HEADER_BLOCK) && (mmap_section(mapped, 0) == 0)) {
+    mapped->pcapng = 1;
+    size_t offset = 0; // Datalink is the one of first interface.
+    while ((mapped->linktype < 0) && (offset + 12 <= mapped->size)) {
+      uint32_t type = mmap_u32(mapped, offset), length = mmap_u32(mapped, offset + 4);
+      if ((length < 12) || (offset + length > mapped->size)) break;
+      if ((type == PCAPNG_INTERFACE_BLOCK) && (length >= 20)) mapped->linktype = (int)mmap_u16(mapped, offset + 8);
+      offset += length;
+    }
+    if (mapped->linktype < 0) mapped->linktype = DLT_EN10MB; // No interface: no packets.
+  } else { // Not a capture file: libpcap reports it.
+    munmap(map, mapped->size);
+    free(mapped->path);
+    free(mapped);
+    return NULL;
+  }
+  // File link-layer type is mapped to its datalink as libpcap does (it differs only for raw IP).
+  mapped->pcap_handle = pcap_open_dead((mapped->linktype == LINKTYPE_RAW) ? DLT_RAW : mapped->linktype, MMAP_SNAPLEN);
+  if (mapped->pcap_handle == NULL) {
+    munmap(map, mapped->size);
+    free(mapped->path);
+    free(mapped);
+    return NULL;
+  }
+  mapped->next = mmaps;
+  mmaps = mapped;
+  return mapped->pcap_handle;
+}
+
+
+/**
+ * mmap_fallback: Hand remaining records over to libpcap once an anomaly (truncated or malformed record, unsupported
+ *                pcapng interface) is met, so that it is reported as for files read through libpcap. Return 0 on
+ *                success.
+ */
+int mmap_fallback(struct nf_mmap *mapped) {
+  char pcap_error_buffer[PCAP_ERRBUF_SIZE];
+  mapped->fallback = pcap_open_offline(mapped->path, pcap_error_buffer);
+  if (mapped->fallback == NULL) return 1;
+  int failed = 0;
+  if (!mapped->pcapng) { // Classic pcap: libpcap reads from anomaly record offset.
+    failed = fseeko(pcap_file(mapped->fallback), (off_t)mapped->position, SEEK_SET) != 0;
+  } else { // pcapng: packets read so far are read again so that libpcap knows their sections and interfaces.
+    struct pcap_pkthdr *hdr;
+    const uint8_t *data;
+    for (uint64_t i = 0; (i < mapped->records) && !failed; i++) {
+      failed = pcap_next_ex(mapped->fallback, &hdr, &data) != 1;
+    }
+  }
+  if (!failed && mapped->filtered) failed = pcap_setfilter(mapped->fallback, &mapped->filter) < 0;
+  if (failed) {
+    pcap_close(mapped->fallback);
+    mapped->fallback = NULL;
+    return 1;
+  }
+  return 0;
+}
+
+
+/**
+ * mmap_position: Next record offset of memory mapped file (or of its libpcap fallback).
+ */
+int64_t mmap_position(struct nf_mmap *mapped) {
+  if (mapped->fallback != NULL) return (int64_t)ftello(pcap_file(mapped->fallback));
+  return (int64_t)mapped->position;
+}
+
+
+/**
+ * mmap_next: Get next packet of memory mapped file, pointing into mapping (or read by libpcap after an anomaly).
+ *            Return 1 on success, -2 on end of file and libpcap return values after an anomaly.
+ */
+int mmap_next(struct nf_mmap *mapped, struct pcap_pkthdr **hdr, const uint8_t **data) {
+  struct pcap_pkthdr *header = &mapped->header;
+  for (;;) {
+    if (mapped->fallback != NULL) return pcap_next_ex(mapped->fallback, hdr, data);
+    size_t position = mapped->position;
+    if (!mapped->pcapng) {
+      if (position == mapped->size) return -2;
+      if (position + 16 > mapped->size) { // Truncated record header.
+        if (mmap_fallback(mapped) == 0) continue;
+        return -2;
+      }
+      header->caplen = mmap_u32(mapped, position + 8);
+      if ((header->caplen > MMAP_SNAPLEN) || (position + 16 + header->caplen > mapped->size)) { // Malformed record.
+        if (mmap_fallback(mapped) == 0) continue;
+        return -2;
+      }
+      header->ts.tv_sec = (time_t)mmap_u32(mapped, position);
+      header->ts.tv_usec = (suseconds_t)(mmap_u32(mapped, position + 4) / mapped->ts_divisor);
+      header->len = mmap_u32(mapped, position + 12);
+      *data = mapped->map + position + 16;
+      mapped->position = position + 16 + header->caplen;
+    } else {
+      if (position == mapped->size) return -2;
+      if (position + 12 > mapped->size) { // Truncated block header.
+        if (mmap_fallback(mapped) == 0) continue;
+        return -2;
+      }
+      uint32_t type = mmap_u32(mapped, position), length = mmap_u32(mapped, position + 4);
+      int malformed = 0;
+      if (type == PCAPNG_SECTION_HEADER_BLOCK) { // New section may change byte order.
+        malformed = mmap_section(mapped, position) != 0;
+        length = mmap_u32(mapped, position + 4);
+      }
+      malformed = malformed || (length < 12) || (length & 3) || (position + length > mapped->size);
+      if (!malformed && (type == PCAPNG_INTERFACE_BLOCK)) malformed = mmap_interface(mapped, position, length) != 0;
+      if (!malformed && ((type == PCAPNG_ENHANCED_PACKET_BLOCK) || (type == PCAPNG_PACKET_BLOCK))) {
+        malformed = (length < 32) || (mmap_u32(mapped, position + 20) > length - 32);
+      }
+      if (malformed) { // Including interfaces of another link-layer type, reported by libpcap.
+        if (mmap_fallback(mapped) == 0) continue;
+        return -2;
+      }
+      mapped->position = position + length;
+      if (type == PCAPNG_INTERFACE_BLOCK) {
+        continue;
+      } else if ((type == PCAPNG_ENHANCED_PACKET_BLOCK) || (type == PCAPNG_PACKET_BLOCK)) {
+        uint32_t interface_id = (type == PCAPNG_ENHANCED_PACKET_BLOCK) ? mmap_u32(mapped, position + 8) :
+                                                                         mmap_u16(mapped, position + 8);
+        header->caplen = mmap_u32(mapped, position + 20);
+        header->len = mmap_u32(mapped, position + 24);
+        mmap_timestamp(mapped, interface_id,
+                       ((uint64_t)mmap_u32(mapped, position + 12) << 32) | mmap_u32(mapped, position + 16));
+        *data = mapped->map + position + 28;
+      } else if ((type == PCAPNG_SIMPLE_PACKET_BLOCK) && (length >= 16)) {
+        header->len = mmap_u32(mapped, position + 8);
+        header->caplen = (header->len < length - 16) ? header->len : length - 16;
+        header->ts.tv_sec = 0; // Simple packet blocks are not timestamped.
+        header->ts.tv_usec = 0;
+        *data = mapped->map + position + 12;
+      } else {
+        continue; // Statistics, name resolution and custom blocks.
+      }
+    }
+    mapped->records++;
+    if (mapped->filtered && !pcap_offline_filter(&mapped->filter, header, *data)) continue;
+    *hdr = header;
+    return 1;
+  }
+}
+
+
+/**
+ * mmap_free: Release memory mapped state of a capture handle.
+ */
+void mmap_free(pcap_t * pcap_handle) {
+  struct nf_mmap **link = &mmaps;
+  while ((*link != NULL) && ((*link)->pcap_handle != pcap_handle)) link = &(*link)->next;
+  struct nf_mmap *mapped = *link;
+  if (mapped == NULL) return;
+  *link = mapped->next;
+  munmap(mapped->map, mapped->size);
+  if (mapped->fallback != NULL) pcap_close(mapped->fallback);
+  free(mapped->path);
+  if (mapped->filtered) pcap_freecode(&mapped->filter);
+  if (mapped->interfaces != NULL) free(mapped->interfaces);
+  free(mapped);
+}
+
+
+/*
+------------------------------------------------------------------------------------------------------------------------
+                                           Engine APIs
+------------------------------------------------------------------------------------------------------------------------
+*/
+
+
+/***************************************** Capture APIs ***************************************************************/
+
+
+/**
+ * capture_release: Release a capture handle along with its replay, ring and memory mapped states.
+ */
+void capture_release(pcap_t * pcap_handle) {
+  replay_free(pcap_handle);
+  ring_free(pcap_handle);
+  mmap_free(pcap_handle);
+  pcap_close(pcap_handle);
+}
+
+
+/**
+ * capture_open: Open a pcap file (memory mapped or through libpcap) or a specified device (through libpcap or a direct
+ *               TPACKET_V3 ring).
+ */
+pcap_t * capture_open(const uint8_t * pcap_file, int mode, int root_idx, int backend, int memory_map) {
+  pcap_t * pcap_handle = NULL;
+  char pcap_error_buffer[PCAP_ERRBUF_SIZE];
+  if ((mode == 0) && memory_map) pcap_handle = mmap_open((const char*)pcap_file); // NULL for FIFOs.
+  if (((mode == 0) && (pcap_handle == NULL)) || (mode == 2)) { // Offline or replayed file.
+    pcap_handle = pcap_open_offline((char*)pcap_file, pcap_error_buffer);
+  }
+  if ((mode == 1) && (backend == CAPTURE_BACKEND_PACKET_MMAP)) {
+    pcap_handle = ring_open((const char*)pcap_file);
+    snprintf(pcap_error_buffer, PCAP_ERRBUF_SIZE, "packet_mmap backend unavailable");
+  } else if (mode == 1) {
+    pcap_handle = pcap_create((char*)pcap_file, pcap_error_buffer);
+  }
+  if (pcap_handle != NULL) {
+    return pcap_handle;
+  } else {
+    if (root_idx == 0) printf("ERROR: Unable to open source %s: %s\n", pcap_file, pcap_error_buffer);
+    return NULL;
+  }
+}
+
+
+/**
+ * capture_set_fanout: Set fanout mode (kernel fanout on Linux live capture, software hash otherwise).
+ *                     Kernel fanout mode is a PACKET_FANOUT_* value, always defragmenting, within group_id
+ *                     (negative group_id: new group with a kernel allocated id, see capture_fanout_group).
+ */
+int capture_set_fanout(pcap_t * pcap_handle, int mode, int root_idx, int hash, int fanout_mode, int group_id) {
+  int set_fanout = 0;
+  fanout_hash = (uint8_t)hash;
+  if (mode != 1) return set_fanout;
+  struct nf_ring *ring = ring_get(pcap_handle);
+  if (ring != NULL) { // Ring joins its fanout group once bound.
+    ring->fanout_mode = fanout_mode;
+    ring->group_id = group_id;
+    return set_fanout;
+  } else {
+#ifdef __linux__
+    if (group_id < 0) set_fanout = pcap_set_fanout_linux(pcap_handle, 1, FANOUT_FLAG_DEFRAG | FANOUT_FLAG_UNIQUEID |
+                                                                         fanout_mode, 0);
+    else set_fanout = pcap_set_fanout_linux(pcap_handle, 1, FANOUT_FLAG_DEFRAG | fanout_mode, group_id);
+    if (set_fanout != 0) {
+      capture_release(pcap_handle);
+      if (root_idx == 0) printf("ERROR: Unable to setup fanout mode.\n");
+    }
+#endif
+  return set_fanout;
+  }
+}
+
+
+/**
+ * capture_fanout_group: Kernel fanout group id joined by an activated live capture, -1 on failure.
+ */
+int capture_fanout_group(pcap_t * pcap_handle) {
+#ifdef __linux__
+  struct nf_ring *ring = ring_get(pcap_handle);
+  int fd = (ring != NULL) ? ring->fd : pcap_fileno(pcap_handle);
+  uint32_t fanout = 0;
+  socklen_t fanout_size = sizeof(fanout);
+  if ((fd < 0) || (getsockopt(fd, SOL_PACKET, PACKET_FANOUT, &fanout, &fanout_size) != 0) || (fanout == 0)) return -1;
+  return (int)(fanout & 0xFFFF);
+#else
+  return -1;
+#endif
+}
+
+
+/**
+ * capture_activate: Activate capture.
+ */
+int capture_activate(pcap_t * pcap_handle, int mode, int root_idx) {
+  int set_activate = 0;
+  if (mode != 1) return set_activate;
   else {
-    set_timeout = pcap_set_timeout(pcap_handle, 1000);
+    struct nf_ring *ring = ring_get(pcap_handle);
+    if (ring != NULL) {
+      set_activate = ring_activate(ring);
+    } else {
+      set_activate = pcap_activate(pcap_handle);
+    }
+    if (set_activate != 0) {
+      capture_release(pcap_handle);
+      if (root_idx == 0) printf("ERROR: Unable to activate source.\n");
+    }
+  return set_activate;
+  }
+}
+
+
+/**
+ * capture_set_timeout: Set buffer timeout (ms).
+ */
+int capture_set_timeout(pcap_t * pcap_handle, int mode, int root_idx, int timeout) {
+  int set_timeout = 0;
+  struct nf_ring *ring = ring_get(pcap_handle);
+  if (mode != 1) return set_timeout;
+  else if (ring != NULL) {
+    ring->timeout = timeout;
+    return set_timeout;
+  } else {
+    set_timeout = pcap_set_timeout(pcap_handle, timeout);
     if (set_timeout != 0) {
-      pcap_close(pcap_handle);
+      capture_release(pcap_handle);
       if (root_idx == 0) printf("ERROR: Unable to set buffer timeout.\n");
     }
   return set_timeout;
@@ -1776,16 +3251,62 @@ int capture_set_timeout(pcap_t * pcap_handle, int mode, int root_idx) {
 }
 
 
+/**
+ * capture_set_buffer_size: Set kernel ring buffer size (bytes, 0 keeps libpcap default).
+ */
+int capture_set_buffer_size(pcap_t * pcap_handle, int mode, int root_idx, int buffer_size) {
+  int set_buffer_size = 0;
+  struct nf_ring *ring = ring_get(pcap_handle);
+  if ((mode != 1) || (buffer_size == 0)) return set_buffer_size;
+  else if (ring != NULL) {
+    ring->buffer_size = buffer_size;
+    return set_buffer_size;
+  } else {
+    set_buffer_size = pcap_set_buffer_size(pcap_handle, buffer_size);
+    if (set_buffer_size != 0) {
+      capture_release(pcap_handle);
+      if (root_idx == 0) printf("ERROR: Unable to set buffer size.\n");
+    }
+  return set_buffer_size;
+  }
+}
+
+
+/**
+ * capture_set_immediate_mode: Set immediate mode (packets delivered as soon as they arrive, without buffering).
+ */
+int capture_set_immediate_mode(pcap_t * pcap_handle, int mode, int root_idx, int immediate) {
+  int set_immediate = 0;
+  struct nf_ring *ring = ring_get(pcap_handle);
+  if ((mode != 1) || (immediate == 0)) return set_immediate;
+  else if (ring != NULL) {
+    ring->immediate = (uint8_t)immediate;
+    return set_immediate;
+  } else {
+    set_immediate = pcap_set_immediate_mode(pcap_handle, immediate);
+    if (set_immediate != 0) {
+      capture_release(pcap_handle);
+      if (root_idx == 0) printf("ERROR: Unable to set immediate mode.\n");
+    }
+  return set_immediate;
+  }
+}
+
+
 /**
  * capture_set_promisc: Set promisc mode.
  */
 int capture_set_promisc(pcap_t * pcap_handle, int mode, int root_idx, int promisc) {
   int set_promisc = 0;
-  if (mode == 0) return set_promisc;
-  else {
+  struct nf_ring *ring = ring_get(pcap_handle);
+  if (mode != 1) return set_promisc;
+  else if (ring != NULL) {
+    ring->promisc = promisc;
+    return set_promisc;
+  } else {
     set_promisc = pcap_set_promisc(pcap_handle, promisc);
     if (set_promisc != 0) {
-      pcap_close(pcap_handle);
+      capture_release(pcap_handle);
       if (root_idx == 0) printf("ERROR: Unable to set promisc mode.\n");
     }
   return set_promisc;
@@ -1798,11 +3319,15 @@ int capture_set_promisc(pcap_t * pcap_handle, int mode, int root_idx, int promis
  */
 int capture_set_snaplen(pcap_t * pcap_handle, int mode, int root_idx, unsigned snaplen) {
   int set_snaplen = 0;
-  if (mode == 0) return set_snaplen;
-  else {
+  struct nf_ring *ring = ring_get(pcap_handle);
+  if (mode != 1) return set_snaplen;
+  else if (ring != NULL) {
+    ring->snaplen = snaplen;
+    return set_snaplen;
+  } else {
     set_snaplen = pcap_set_snaplen(pcap_handle, snaplen);
     if (set_snaplen != 0) {
-      pcap_close(pcap_handle);
+      capture_release(pcap_handle);
       if (root_idx == 0) printf("ERROR: Unable to set snaplen.\n");
     }
   return set_snaplen;
@@ -1810,6 +3335,88 @@ int capture_set_snaplen(pcap_t * pcap_handle, int mode, int root_idx, unsigned s
 }
 
 
+/**
+ * capture_set_nonblock: Set non blocking mode (several live captures multiplexed by a meter).
+ */
+int capture_set_nonblock(pcap_t * pcap_handle, int mode, int root_idx) {
+  int set_nonblock = 0;
+  char pcap_error_buffer[PCAP_ERRBUF_SIZE];
+  struct nf_ring *ring = ring_get(pcap_handle);
+  if (mode != 1) return set_nonblock;
+  else if (ring != NULL) {
+    ring->nonblock = 1;
+    return set_nonblock;
+  } else {
+    set_nonblock = (pcap_setnonblock(pcap_handle, 1, pcap_error_buffer) != 0);
+    if (set_nonblock != 0) {
+      capture_release(pcap_handle);
+      if (root_idx == 0) printf("ERROR: Unable to set non blocking mode: %s\n", pcap_error_buffer);
+    }
+  return set_nonblock;
+  }
+}
+
+
+/**
+ * capture_wait: Wait up to timeout (ms) for packets on any of several non blocking live captures.
+ */
+int capture_wait(pcap_t ** pcap_handles, int count, int timeout) {
+  struct pollfd pfds[count];
+  for (int i = 0; i < count; i++) {
+    struct nf_ring *ring = ring_get(pcap_handles[i]);
+    pfds[i].fd = (ring != NULL) ? ring->fd : pcap_get_selectable_fd(pcap_handles[i]);
+    pfds[i].events = POLLIN;
+    pfds[i].revents = 0;
+  }
+  return poll(pfds, count, timeout);
+}
+
+
+/**
+ * capture_set_replay: Setup real-time replay of an opened pcap file at recorded pace multiplied by speed.
+ */
+int capture_set_replay(pcap_t * pcap_handle, int mode, int root_idx, double speed) {
+  if (mode != 2) return 0;
+  struct nf_replay *replay = (struct nf_replay*)calloc(1, sizeof(struct nf_replay));
+  if ((replay == NULL) || (speed <= 0)) {
+    if (replay != NULL) free(replay);
+    capture_release(pcap_handle);
+    if (root_idx == 0) printf("ERROR: Unable to setup replay.\n");
+    return 1;
+  }
+  replay->pcap_handle = pcap_handle;
+  replay->speed = speed;
+  replay->next = replays;
+  replays = replay;
+  return 0;
+}
+
+
+/**
+ * capture_set_window: Seek an opened pcap file to a record offset (from its offset index), then restrict it to
+ *                     [start, end) time window (ms) and [chunk_from, chunk_to) parallel chunk whose next chunk
+ *                     lookback starts at next_from (-1 disables).
+ */
+int capture_set_window(pcap_t * pcap_handle, int mode, int root_idx, int64_t offset, uint64_t start, uint64_t end,
+                       int64_t chunk_from, int64_t chunk_to, int64_t next_from) {
+  if ((mode != 0) && (mode != 2)) return 0;
+  struct nf_mmap *mapped = (mode == 0) ? mmap_get(pcap_handle) : NULL;
+  FILE *file = (mapped == NULL) ? pcap_file(pcap_handle) : NULL;
+  if (mapped != NULL) mapped->position = (size_t)offset;
+  else if ((file == NULL) || (fseeko(file, (off_t)offset, SEEK_SET) != 0)) {
+    capture_release(pcap_handle);
+    if (root_idx == 0) printf("ERROR: Unable to seek source.\n");
+    return 1;
+  }
+  window_start = start;
+  window_end = end;
+  chunk_start = chunk_from;
+  chunk_end = chunk_to;
+  chunk_next = next_from;
+  return 0;
+}
+
+
 /**
  * capture_set_filter: Configure pcap_t with specified bpf_filter.
  */
@@ -1818,12 +3425,22 @@ int capture_set_filter(pcap_t * pcap_handle, char * bpf_filter, int root_idx) {
     struct bpf_program fcode;
     if (pcap_compile(pcap_handle, &fcode, bpf_filter, 1, 0xFFFFFF00) < 0) {
       if (root_idx == 0) printf("ERROR: Unable to compile BPF filter.\n");
-      pcap_close(pcap_handle);
+      capture_release(pcap_handle);
       return 1;
     } else {
-      if (pcap_setfilter(pcap_handle, &fcode) < 0) {
-	    if (root_idx == 0) printf("ERROR: Unable to compile BPF filter.\n");
-	    pcap_close(pcap_handle);
+      struct nf_ring *ring = ring_get(pcap_handle);
+      struct nf_mmap *mapped = mmap_get(pcap_handle);
+      int set_filter = 0;
+      if (mapped != NULL) { // Memory mapped packets are filtered in userland, as libpcap does for files.
+        mapped->filter = fcode;
+        mapped->filtered = 1;
+      } else {
+        set_filter = (ring != NULL) ? ring_set_filter(ring, &fcode) : (pcap_setfilter(pcap_handle, &fcode) < 0);
+      }
+      if (set_filter) {
+        if (mapped == NULL) pcap_freecode(&fcode);
+	    if (root_idx == 0) printf("ERROR: Unable to set BPF filter.\n");
+	    capture_release(pcap_handle);
 	    return 1;
       } else {
 	    return 0;
@@ -1842,13 +3459,31 @@ int capture_next(pcap_t * pcap_handle, struct nf_packet *nf_pkt, int decode_tunn
                  int mode) {
   struct pcap_pkthdr *hdr = NULL;
   const uint8_t *data = NULL;
-  int rv_handle = pcap_next_ex(pcap_handle, &hdr, &data);
+  int rv_handle;
+  int64_t offset = -1;
+  struct nf_ring *ring = (mode == 1) ? ring_get(pcap_handle) : NULL;
+  struct nf_mmap *mapped = (mode == 0) ? mmap_get(pcap_handle) : NULL;
+  if (mode == 2) rv_handle = replay_next(replay_get(pcap_handle), decode_tunnels, n_roots, root_idx, &hdr, &data);
+  else if (ring != NULL) rv_handle = ring_next(ring, &hdr, &data);
+  else if (mapped != NULL) {
+    if (chunk_start >= 0) offset = mmap_position(mapped); // Next record offset.
+    rv_handle = mmap_next(mapped, &hdr, &data);
+  } else {
+    if ((mode == 0) && (chunk_start >= 0)) offset = (int64_t)ftello(pcap_file(pcap_handle)); // Next record offset.
+    rv_handle = pcap_next_ex(pcap_handle, &hdr, &data);
+  }
   if (rv_handle == 1) { // Everything is OK.
+    if (mode == 0) { // Offline time window (replayed packets are checked at read as they are then retimestamped).
+      int position = window_position(hdr);
+      if (position < 0) return -1; // Before time window: skipped.
+      if (position > 0) return -2; // After time window: end of capture.
+    }
     int rv_processor = packet_process(pcap_handle, hdr, data, decode_tunnels, nf_pkt, n_roots, root_idx, mode);
     if (rv_processor == 0) {
+        if (nf_pkt->parse_error == 0) nf_pkt->parse_error = PARSE_ERROR_MALFORMED;
         return 0; // Packet ignored due to parsing
-    } else if (rv_processor == 1) { // Packet parsed correctly and match root_idx
-        return 1;
+    } else if (rv_processor == 1) { // Packet parsed correctly and match root_idx (or chunk lookback/overflow)
+        return window_chunk_position(offset);
     } else { // Packet parsed correctly and do not match root_idx, will use it as time ticker
         return 2;
     }
@@ -1862,6 +3497,7 @@ int capture_next(pcap_t * pcap_handle, struct nf_packet *nf_pkt, int decode_tunn
       } else { // packet read at buffer timeout
         int rv_processor = packet_process(pcap_handle, hdr, data, decode_tunnels, nf_pkt, n_roots, root_idx, mode);
         if (rv_processor == 0) {
+          if (nf_pkt->parse_error == 0) nf_pkt->parse_error = PARSE_ERROR_MALFORMED;
           return 0; // Packet ignored due to parsing
         } else if (rv_processor == 1) { // Packet parsed correctly and match root_idx
           return 1;
@@ -1883,7 +3519,18 @@ int capture_next(pcap_t * pcap_handle, struct nf_packet *nf_pkt, int decode_tunn
  */
 void capture_stats(pcap_t * pcap_handle, struct nf_stat *nf_statistics, unsigned mode) {
   if (mode == 0) return;
-  else {
+  else if (mode == 2) { // Replay buffer drops emulate kernel ones.
+    struct nf_replay *replay = replay_get(pcap_handle);
+    nf_statistics->received = replay->received;
+    nf_statistics->dropped = replay->dropped;
+    nf_statistics->dropped_by_interface = 0;
+  } else if (ring_get(pcap_handle) != NULL) {
+    struct nf_ring *ring = ring_get(pcap_handle);
+    ring_stats(ring);
+    nf_statistics->received = ring->received;
+    nf_statistics->dropped = ring->dropped;
+    nf_statistics->dropped_by_interface = 0;
+  } else {
     struct pcap_stat statistics;
     int ret = pcap_stats(pcap_handle, &statistics);
     if (ret == 0) {
@@ -1902,7 +3549,7 @@ void capture_stats(pcap_t * pcap_handle, struct nf_stat *nf_statistics, unsigned
  */
 void capture_close(pcap_t * pcap_handle) {
   pcap_breakloop(pcap_handle);
-  pcap_close(pcap_handle);
+  capture_release(pcap_handle);
 }
 
 
@@ -1932,14 +3579,48 @@ struct ndpi_detection_module_struct *dissector_init(struct dissector_checker *ch
 }
 
 /**
- * dissector_configure: Dissector initializer.
+ * dissector_protocols: Number of protocols supported by dissector.
+ */
+uint32_t dissector_protocols(struct ndpi_detection_module_struct *dissector) {
+  return ndpi_get_num_supported_protocols(dissector);
+}
+
+
+/**
+ * dissector_protocol_name: Name of a dissector protocol.
+ */
+const char *dissector_protocol_name(struct ndpi_detection_module_struct *dissector, uint16_t protocol_id) {
+  return ndpi_get_proto_name(dissector, protocol_id);
+}
+
+
+/**
+ * dissector_protocol_category: Category name of a dissector protocol.
+ */
+const char *dissector_protocol_category(struct ndpi_detection_module_struct *dissector, uint16_t protocol_id) {
+  ndpi_protocol protocol = { .master_protocol = NDPI_PROTOCOL_UNKNOWN, .app_protocol = protocol_id,
+                             .category = NDPI_PROTOCOL_CATEGORY_UNSPECIFIED };
+  return ndpi_category_get_name(dissector, ndpi_get_proto_category(dissector, protocol));
+}
+
+
+/**
+ * dissector_configure: Dissector initializer (selection: one byte per protocol id, NULL to enable all protocols).
  */
-void dissector_configure(struct ndpi_detection_module_struct *dissector) {
+void dissector_configure(struct ndpi_detection_module_struct *dissector, const uint8_t *selection) {
     if (dissector == NULL) {
       return;
     } else {
       NDPI_PROTOCOL_BITMASK protos;
-      NDPI_BITMASK_SET_ALL(protos); // Set bitmask for ALL protocols
+      if (selection == NULL) {
+        NDPI_BITMASK_SET_ALL(protos); // Set bitmask for ALL protocols
+      } else {
+        NDPI_BITMASK_RESET(protos);
+        uint32_t n_protocols = ndpi_get_num_supported_protocols(dissector);
+        for (uint32_t protocol_id = 0; protocol_id < n_protocols; protocol_id++) {
+          if (selection[protocol_id]) NDPI_ADD_PROTOCOL_TO_BITMASK(protos, protocol_id);
+        }
+      }
       ndpi_set_protocol_detection_bitmask2(dissector, &protos);
       ndpi_finalize_initalization(dissector);
     }
@@ -1963,16 +3644,22 @@ void dissector_cleanup(struct ndpi_detection_module_struct *dissector) {
 struct nf_flow *meter_initialize_flow(struct nf_packet *packet, uint8_t accounting_mode, uint8_t statistics,
                                       uint8_t splt, uint8_t n_dissections,
                                       struct ndpi_detection_module_struct *dissector) {
-  struct nf_flow *flow = (struct nf_flow*)ndpi_malloc(sizeof(struct nf_flow));
+  struct nf_flow *flow = (struct nf_flow*)pool_alloc(POOL_FLOW, sizeof(struct nf_flow));
   if (flow == NULL) return NULL; // not enough memory for flow.
   memset(flow, 0, sizeof(struct nf_flow));
+  memory_account(MEMORY_FLOW, sizeof(struct nf_flow));
   // All packet sizes and bytes related metrics are reported according to user specified mode.
   // This will allow us to provide a flexible choice without duplicating unnecessary information.
   uint16_t packet_size = flow_get_packet_size(packet, accounting_mode);
   uint8_t flow_init_bidirectional_success = flow_init_bidirectional(dissector, n_dissections, splt, statistics,
                                                                     packet_size, flow, packet);
-  if (!flow_init_bidirectional_success) return NULL;
+  if (!flow_init_bidirectional_success) { // flow structure was released by failing initializer.
+    memory_account(MEMORY_FLOW, -(int64_t)sizeof(struct nf_flow));
+    return NULL;
+  }
   flow_init_src2dst(statistics, packet_size, flow, packet);
+  flow_update_tcp_closing(flow, packet);
+  flow_update_timeout_policy(flow);
   return flow; // we return a pointer to the created flow in order to be cached by Python side.
 }
 
@@ -1981,15 +3668,18 @@ struct nf_flow *meter_initialize_flow(struct nf_packet *packet, uint8_t accounti
  * meter_update_flow: Check expiration state, and update flow based on packet values if case of active one.
  */
 uint8_t meter_update_flow(struct nf_flow *flow, struct nf_packet *packet, uint64_t idle_timeout, uint64_t active_timeout,
-                          uint8_t accounting_mode, uint8_t statistics, uint8_t splt, uint8_t n_dissections,
-                          struct ndpi_detection_module_struct *dissector) {
-  uint8_t expired = flow_expiration_handler(flow, packet, idle_timeout, active_timeout);
+                          uint64_t tcp_linger, uint8_t accounting_mode, uint8_t statistics, uint8_t splt,
+                          uint8_t n_dissections, struct ndpi_detection_module_struct *dissector) {
+  uint8_t expired = flow_expiration_handler(flow, packet, idle_timeout, active_timeout, tcp_linger);
   if (expired) return expired;
   flow_set_packet_direction(flow, packet);
   uint16_t packet_size = flow_get_packet_size(packet, accounting_mode);
   flow_update_bidirectional(dissector, n_dissections, splt, statistics, packet_size, flow, packet);
   if (packet->direction == 0) flow_update_src2dst(statistics, packet_size, flow, packet);
   else flow_update_dst2src(statistics, packet_size, flow, packet);
+  flow_update_tcp_closing(flow, packet);
+  if (timeout_policies_count && (flow->detected_protocol.app_protocol != flow->timeout_application))
+    flow_update_timeout_policy(flow);
   return 0; // Update done, we return 0.
 }
 
@@ -2004,6 +3694,7 @@ void meter_expire_flow(struct nf_flow *flow, uint8_t n_dissections, struct ndpi_
       flow_bidirectional_dissection_collect_info(dissector, flow);
     }
     if (!flow->detection_completed) {
+      flow_service_cache_update(flow);
       flow_free_ndpi_data(flow);
     }
     flow->detection_completed = 1; // IMPORTANT: This will force copy on non sync mode.
@@ -2017,10 +3708,147 @@ void meter_expire_flow(struct nf_flow *flow, uint8_t n_dissections, struct ndpi_
 void meter_free_flow(struct nf_flow *flow, uint8_t n_dissections, uint8_t splt, uint8_t full) {
   if (full) {
     if (n_dissections) flow_free_ndpi_data(flow);
-    if (splt) flow_free_splt_data(flow);
-    ndpi_free(flow);
+    if (splt) flow_free_splt_data(flow, splt);
+    pool_free(flow);
     flow = NULL;
+    memory_account(MEMORY_FLOW, -(int64_t)sizeof(struct nf_flow));
   } else { // SPLT only
-    flow_free_splt_data(flow);
+    flow_free_splt_data(flow, splt);
+  }
+}
+
+
+/**
+ * meter_memory: Copy bytes currently held by each flow component (nf_flow, nDPI flow, nDPI ids, SPLT).
+ */
+void meter_memory(uint64_t *memory) {
+  for (int i = 0; i < MEMORY_COMPONENTS; i++) memory[i] = (uint64_t)memory_allocated[i];
+}
+
+
+/**
+ * meter_service_cache: Enable per meter service cache (entries > 0) in classification or verification mode.
+ */
+int meter_service_cache(uint32_t size, uint8_t verify) {
+  if (services != NULL) ndpi_free(services);
+  services = (struct nf_service *)ndpi_calloc(size, sizeof(struct nf_service));
+  if (services == NULL) return 0;
+  services_size = size;
+  services_verify = verify;
+  return 1;
+}
+
+
+/**
+ * meter_service_cache_stats: Copy service cache statistics (hits, misses, verified, mismatches).
+ */
+void meter_service_cache_stats(uint64_t *stats) {
+  for (int i = 0; i < SERVICE_CACHE_STATS; i++) stats[i] = services_stats[i];
+}
+
+
+/**
+ * meter_host_table: Enable per meter host table (hosts > 0) sharing nDPI id structures across flows of an endpoint.
+ */
+int meter_host_table(uint32_t size) {
+  if (hosts != NULL) return 0;
+  hosts = (struct nf_host **)ndpi_calloc(size, sizeof(struct nf_host *));
+  if (hosts == NULL) return 0;
+  hosts_size = size;
+  return 1;
+}
+
+
+/**
+ * meter_timeout_policy: Add a meter timeout policy (0 matches any protocol, port or application), 0 if table is full.
+ */
+int meter_timeout_policy(uint8_t protocol, uint16_t port, uint16_t application, uint64_t idle_timeout,
+                         uint64_t active_timeout) {
+  if (timeout_policies_count == TIMEOUT_POLICIES_MAX) return 0;
+  struct nf_timeout_policy *policy = &timeout_policies[timeout_policies_count++];
+  policy->protocol = protocol;
+  policy->port = port;
+  policy->application = application;
+  policy->idle_timeout = idle_timeout;
+  policy->active_timeout = active_timeout;
+  return 1;
+}
+
+
+/**
+ * meter_host_table_stats: Copy host table statistics (hosts, hits, misses, evictions).
+ */
+void meter_host_table_stats(uint64_t *stats) {
+  for (int i = 0; i < HOST_TABLE_STATS; i++) stats[i] = hosts_stats[i];
+}
+
+
+/**
+ * meter_pools: Copy pools statistics (objects in use, mapped slabs, allocated slabs, released slabs) for each pool
+ *              (nf_flow, nDPI ids, SPLT).
+ */
+void meter_pools(uint64_t *stats) {
+  for (int i = 0; i < POOL_CLASSES; i++) {
+    stats[i * POOL_STATS] = pools[i].objects;
+    stats[i * POOL_STATS + 1] = pools[i].slabs_count;
+    stats[i * POOL_STATS + 2] = pools[i].slabs_allocated;
+    stats[i * POOL_STATS + 3] = pools[i].slabs_released;
+  }
+}
+
+
+/***************************************** Anonymizer APIs ************************************************************/
+
+
+/**
+ * anonymizer_init: Prefix preserving anonymizer initializer (key: 32 bytes, 16 for AES key and 16 for pad).
+ */
+struct nf_anonymizer *anonymizer_init(const uint8_t *key, uint32_t cache_size) {
+  if (cache_size == 0) return NULL;
+  struct nf_anonymizer *anonymizer = (struct nf_anonymizer*)ndpi_calloc(1, sizeof(struct nf_anonymizer));
+  if (anonymizer == NULL) return NULL;
+  anonymizer->cache_size = cache_size;
+  anonymizer->ipv4_cache = (struct nf_anonymizer_entry*)ndpi_calloc(cache_size, sizeof(struct nf_anonymizer_entry));
+  anonymizer->ipv6_cache = (struct nf_anonymizer_entry*)ndpi_calloc(cache_size, sizeof(struct nf_anonymizer_entry));
+  gcry_check_version(NULL);
+  if ((anonymizer->ipv4_cache == NULL) || (anonymizer->ipv6_cache == NULL) ||
+      gcry_cipher_open(&anonymizer->cipher, GCRY_CIPHER_AES128, GCRY_CIPHER_MODE_ECB, 0)) {
+    if (anonymizer->ipv4_cache) ndpi_free(anonymizer->ipv4_cache);
+    if (anonymizer->ipv6_cache) ndpi_free(anonymizer->ipv6_cache);
+    ndpi_free(anonymizer);
+    return NULL;
+  }
+  gcry_cipher_setkey(anonymizer->cipher, key, 16);
+  // Secret pad is the encryption of the second half of the key.
+  gcry_cipher_encrypt(anonymizer->cipher, anonymizer->pad, 16, key + 16, 16);
+  return anonymizer;
+}
+
+
+/**
+ * anonymizer_ip: Anonymize an IPv4/IPv6 address string. Return 0 if value is not a valid IP address.
+ */
+int anonymizer_ip(struct nf_anonymizer *anonymizer, const char *ip, char *anonymized, unsigned anonymized_len) {
+  uint8_t addr[16];
+  if (inet_pton(AF_INET, ip, addr) == 1) {
+    anonymizer_address(anonymizer, addr, 4);
+    return inet_ntop(AF_INET, addr, anonymized, anonymized_len) != NULL;
   }
+  if (inet_pton(AF_INET6, ip, addr) == 1) {
+    anonymizer_address(anonymizer, addr, 16);
+    return inet_ntop(AF_INET6, addr, anonymized, anonymized_len) != NULL;
+  }
+  return 0;
+}
+
+
+/**
+ * anonymizer_cleanup: Anonymizer cleaner.
+ */
+void anonymizer_cleanup(struct nf_anonymizer *anonymizer) {
+  if (anonymizer == NULL) return;
+  gcry_cipher_close(anonymizer->cipher);
+  ndpi_free(anonymizer->ipv4_cache);
+  ndpi_free(anonymizer->ipv6_cache);
+  ndpi_free(anonymizer);
 }
@@ -15,6 +15,7 @@ If not, see <http://www.gnu.org/licenses/>.
 
 from collections import namedtuple
 from math import sqrt
+from socket import inet_ntop, AF_INET, AF_INET6
 
 # When NFStream is extended with plugins, packer C structure is pythonized using the following namedtuple.
 nf_packet = namedtuple('NFPacket', ['time',
@@ -50,8 +51,24 @@ class UDPS(object):
     """ dummy class that add udps slot the flexibility required for extensions """
 
 
+def ip_string(address, ip_version, ffi):
+    """ Format a binary IP address (IPv4 addresses are stored on the first 4 bytes) """
+    if ip_version == 4:
+        return inet_ntop(AF_INET, ffi.buffer(address, 4)[:])
+    return inet_ntop(AF_INET6, ffi.buffer(address, 16)[:])
+
+
+def mac_string(mac, has_mac, ffi):
+    """ Format a binary MAC address (empty string when datalink do not carry MAC addresses) """
+    if has_mac:
+        return "%02x:%02x:%02x:%02x:%02x:%02x" % tuple(ffi.buffer(mac, 6)[:])
+    return ""
+
+
 def pythonize_packet(packet, ffi):
     """ convert a cdata packet to a namedtuple """
+    src_mac = mac_string(packet.src_mac, packet.has_mac, ffi)
+    dst_mac = mac_string(packet.dst_mac, packet.has_mac, ffi)
     return nf_packet(time=packet.time,
                      delta_time=packet.delta_time,
                      direction=packet.direction,
@@ -59,12 +76,12 @@ def pythonize_packet(packet, ffi):
                      ip_size=packet.ip_size,
                      transport_size=packet.transport_size,
                      payload_size=packet.payload_size,
-                     src_ip=ffi.string(packet.src_ip_str).decode('utf-8', errors='ignore'),
-                     src_mac=ffi.string(packet.src_mac).decode('utf-8', errors='ignore'),
-                     src_oui=ffi.string(packet.src_oui).decode('utf-8', errors='ignore'),
-                     dst_ip=ffi.string(packet.dst_ip_str).decode('utf-8', errors='ignore'),
-                     dst_mac=ffi.string(packet.dst_mac).decode('utf-8', errors='ignore'),
-                     dst_oui=ffi.string(packet.dst_oui).decode('utf-8', errors='ignore'),
+                     src_ip=ip_string(packet.src_ip, packet.ip_version, ffi),
+                     src_mac=src_mac,
+                     src_oui=src_mac[:8],
+                     dst_ip=ip_string(packet.dst_ip, packet.ip_version, ffi),
+                     dst_mac=dst_mac,
+                     dst_oui=dst_mac[:8],
                      src_port=packet.src_port,
                      dst_port=packet.dst_port,
                      protocol=packet.protocol,
@@ -189,13 +206,14 @@ class NFlow(object):
         if self._C == ffi.NULL:  # raise OSError in order to be handled by meter.
             raise OSError("Not enough memory for new flow creation.")
         # Here we go for the first copy in order to make defined slots available
-        self.src_ip = ffi.string(self._C.src_ip).decode('utf-8', errors='ignore')
-        self.src_mac = ffi.string(self._C.src_mac).decode('utf-8', errors='ignore')
-        self.src_oui = ffi.string(self._C.src_oui).decode('utf-8', errors='ignore')
+        # Addresses are stored in binary form by engine, string forms are produced once per flow.
+        self.src_ip = ip_string(self._C.src_ip, self._C.ip_version, ffi)
+        self.src_mac = mac_string(self._C.src_mac, self._C.has_mac, ffi)
+        self.src_oui = self.src_mac[:8]
         self.src_port = self._C.src_port
-        self.dst_ip = ffi.string(self._C.dst_ip).decode('utf-8', errors='ignore')
-        self.dst_mac = ffi.string(self._C.dst_mac).decode('utf-8', errors='ignore')
-        self.dst_oui = ffi.string(self._C.dst_oui).decode('utf-8', errors='ignore')
+        self.dst_ip = ip_string(self._C.dst_ip, self._C.ip_version, ffi)
+        self.dst_mac = mac_string(self._C.dst_mac, self._C.has_mac, ffi)
+        self.dst_oui = self.dst_mac[:8]
         self.dst_port = self._C.dst_port
         self.protocol = self._C.protocol
         self.ip_version = self._C.ip_version
@@ -282,13 +300,13 @@ class NFlow(object):
             for udp in udps:  # on_init entrypoint
                 udp.on_init(pythonize_packet(packet, ffi), self)
 
-    def update(self, packet, idle_timeout, active_timeout, ffi, lib, udps, sync, accounting_mode,
+    def update(self, packet, idle_timeout, active_timeout, tcp_linger, ffi, lib, udps, sync, accounting_mode,
                n_dissections, statistics, splt, dissector):
         """ NFlow update method """
         # First, we update internal C structure.
-        ret = lib.meter_update_flow(self._C, packet, idle_timeout, active_timeout, accounting_mode, statistics, splt,
-                                    n_dissections, dissector)
-        if ret > 0:  # If update done it will be zero, idle and active are matched to 1 and 2.
+        ret = lib.meter_update_flow(self._C, packet, idle_timeout, active_timeout, tcp_linger, accounting_mode,
+                                    statistics, splt, n_dissections, dissector)
+        if ret > 0:  # If update done it will be zero, idle, active and TCP natural are matched to 1, 2 and 3.
             self.expiration_id = ret - 1
             return self.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector)  # expire it.
         if sync:  # If running with Plugins
@@ -14,13 +14,61 @@ If not, see <http://www.gnu.org/licenses/>.
 """
 
 from collections import OrderedDict
+from itertools import islice
+from random import randrange
+from struct import Struct
+from sys import getsizeof, maxsize
+from time import sleep
+from .anonymizer import anonymize_ip
 from .engine import create_engine
 from .flow import NFlow
-from .utils import set_affinity
+from .profiler import NFProfiler, ProfiledChannel, METER_STAGES, PLUGIN_HOOKS, PROFILE_SLOTS, perf_counter_ns
+from .utils import set_affinity, ShardWriter, METER_METRICS, METRIC_INDEX, PARSE_ERROR_OFFSET, MEMORY_COMPONENTS, \
+    POOLS, FANOUT_HASHES, FANOUT_MODES, CAPTURE_BACKENDS
+
+# Expiration id to expired flows metric index.
+EXPIRATION_METRICS = {0: METRIC_INDEX["flows_expired_idle"],
+                      1: METRIC_INDEX["flows_expired_active"],
+                      2: METRIC_INDEX["flows_expired_closed"],
+                      3: METRIC_INDEX["flows_expired_evicted"],
+                      -1: METRIC_INDEX["flows_expired_custom"]}
+# Evicted flows expiration id (2 is kept for engine natural expiration, see flow_expiration_handler).
+EVICTION_ID = 3
+# Oldest idle and smallest flows are searched on a sample of cached flows.
+EVICTION_SAMPLES = 16
+# Closed TCP flows expiration id and linger value disabling their expiration.
+CLOSED_ID = 2
+NO_LINGER = 2 ** 64 - 1
+# Summary flows (scan protection) expiration id and staged flows protocols (TCP, UDP).
+SUMMARY_ID = 4
+STAGED_PROTOCOLS = (6, 17)
+# Staged flows not promoted within staging timeout (ms, or idle_timeout if shorter) are summarized, as well as oldest
+# ones once staging size (staged flows per meter, also bounding summaries) is reached.
+STAGING_TIMEOUT = 10000
+STAGING_SIZE = 65536
+# Staged first packet header fields: time, source IP key, source port, IP version, TCP flags, has MAC, source and
+# destination MACs, raw, IP, transport and payload sizes (destination is the other end of flow key).
+STAGED_PACKET = Struct("<QQQHBBB6s6sHHHH")
+STAGED_TIME = Struct("<Q")
+# Profiled meter stages indexes.
+CAPTURE_STAGE, FLOW_KEY_STAGE, CONSUME_STAGE, SCAN_STAGE, PUT_STAGE = range(len(METER_STAGES))
+# Engine accounted components: nf_flow, nDPI flow, nDPI ids and SPLT arrays.
+ENGINE_MEMORY_COMPONENTS = 4
+# Engine pools statistics: objects in use, mapped slabs, allocated slabs and released slabs per pool.
+POOL_STATS = 4
+# Service cache statistics: hits, misses, verified and mismatches.
+SERVICE_CACHE_METRICS = ("service_cache_hits", "service_cache_misses", "service_cache_verified",
+                         "service_cache_mismatches")
+# Host table statistics: hosts, hits, misses and evictions.
+HOST_TABLE_METRICS = ("host_table_hosts", "host_table_hits", "host_table_misses", "host_table_evictions")
+# Python side footprint is estimated on a sample of the most recently updated flows.
+MEMORY_SAMPLES = 16
 
 
 class NFCache(OrderedDict):
     """ Least recently updated dictionary """
+    buckets = None  # Expiry buckets (idle timeout -> NFCache of its flows) set with timeout policies.
+
     def __init__(self, *args, **kwds):
         super().__init__(*args, **kwds)
 
@@ -34,12 +82,90 @@ class NFCache(OrderedDict):
     def __eq__(self, other):
         return super().__eq__(other)
 
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        if self.buckets is not None:  # Deleted key leaves its expiry bucket too.
+            bucket_idle_timeout = self._bucketed.pop(key, None)
+            if bucket_idle_timeout is not None:
+                del self.buckets[bucket_idle_timeout][key]
+
     def get_lru_key(self):
         return next(iter(self))
 
+    def set_buckets(self, idle_timeouts):
+        """ Keep one least recently registered expiry bucket per idle timeout """
+        self.buckets = {idle_timeout: NFCache() for idle_timeout in sorted(idle_timeouts)}
+        self._bucketed = {}
+
+    def bucket(self, key, idle_timeout):
+        """ Register key in its idle timeout expiry bucket (moved at the end of another one when timeout changes) """
+        bucket_idle_timeout = self._bucketed.get(key)
+        if bucket_idle_timeout != idle_timeout:
+            if bucket_idle_timeout is not None:
+                del self.buckets[bucket_idle_timeout][key]
+            self.buckets[idle_timeout][key] = super().__getitem__(key)
+            self._bucketed[key] = idle_timeout
+
+
+class NFSampledCache(NFCache):
+    """ NFCache with uniform random sampling of its keys (kept in an array for random eviction policies) """
+    def __init__(self, *args, **kwds):
+        super().__init__(*args, **kwds)
+        self._keys = []
+        self._positions = {}
+
+    def __setitem__(self, key, value):
+        if key not in self._positions:
+            self._positions[key] = len(self._keys)
+            self._keys.append(key)
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        position = self._positions.pop(key)
+        last = self._keys.pop()
+        if position < len(self._keys):  # Last key takes the removed key slot.
+            self._keys[position] = last
+            self._positions[last] = position
+
+    def sample(self, n):
+        return [self._keys[randrange(len(self._keys))] for _ in range(n)]
+
+
+class NFPluginTimer(object):
+    """ Meter side plugin wrapper accounting time (ns) spent within plugin entrypoints """
+    def __init__(self, plugin, profiler=None, stage_idx=0):
+        self.plugin = plugin
+        self.elapsed = 0
+        self.profiler = profiler  # When profiling, each hook call latency is also recorded.
+        self.stage_idx = stage_idx  # on_init stage index, followed by on_update and on_expire ones.
+
+    def on_init(self, packet, flow):
+        start = perf_counter_ns()
+        self.plugin.on_init(packet, flow)
+        self.account(0, perf_counter_ns() - start)
+
+    def on_update(self, packet, flow):
+        start = perf_counter_ns()
+        self.plugin.on_update(packet, flow)
+        self.account(1, perf_counter_ns() - start)
+
+    def on_expire(self, flow):
+        start = perf_counter_ns()
+        self.plugin.on_expire(flow)
+        self.account(2, perf_counter_ns() - start)
+
+    def account(self, hook_idx, elapsed):
+        self.elapsed += elapsed
+        if self.profiler is not None:
+            self.profiler.record(self.stage_idx + hook_idx, elapsed)
+
 
 def meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections, statistics, splt, ffi, lib,
-               dissector):
+               dissector, metrics):
+    if cache.buckets is not None:  # Timeout policies: each expiry bucket is scanned with its own idle timeout.
+        return buckets_scan(meter_tick, cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib,
+                            dissector, metrics)
     remaining = True  # We suppose that there is something to expire
     scanned = 0
     while remaining and scanned < 1000:  # idle scan budget (each 10ms we scan 1000 as maximum)
@@ -51,6 +177,7 @@ def meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissectio
                 del cache[flow_key]
                 del flow
                 scanned += 1
+                metrics[EXPIRATION_METRICS[0]] += 1
             else:
                 remaining = False  # LRU flow is not yet idle.
         except StopIteration:  # Empty cache
@@ -58,24 +185,83 @@ def meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissectio
     return scanned
 
 
+def buckets_scan(meter_tick, cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector,
+                 metrics):
+    """ meter_scan of timeout policies expiry buckets, each one from its LRU flow and with its idle timeout """
+    scanned = 0
+    for bucket_idle_timeout, bucket in cache.buckets.items():
+        remaining = True
+        while remaining and scanned < 1000:  # same idle scan budget, shared by buckets.
+            try:
+                flow_key = bucket.get_lru_key()
+                flow = bucket[flow_key]
+                if flow.is_idle(meter_tick, bucket_idle_timeout):
+                    channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
+                    del cache[flow_key]  # and from its bucket.
+                    del flow
+                    scanned += 1
+                    metrics[EXPIRATION_METRICS[0]] += 1
+                else:
+                    remaining = False  # Bucket LRU flow is not yet idle.
+            except StopIteration:  # Empty bucket
+                remaining = False
+    return scanned
+
+
+def bucket_update(cache, flow_key, idle_timeout, policies_idle):
+    """ Keep flow registered in the expiry bucket of its timeout policy idle timeout """
+    flow = cache.get(flow_key)
+    if flow is not None:  # Policy is matched again when flow application is detected.
+        policy = flow._C.timeout_policy
+        cache.bucket(flow_key, policies_idle[policy] if policy >= 0 else idle_timeout)
+
+
+def profiled_meter_scan(profiler, meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections, statistics,
+                        splt, ffi, lib, dissector, metrics):
+    """ meter_scan with latency recording when profiling is enabled """
+    if profiler is None:
+        return meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections, statistics, splt, ffi,
+                          lib, dissector, metrics)
+    start = perf_counter_ns()
+    scanned = meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections, statistics, splt, ffi,
+                         lib, dissector, metrics)
+    profiler.record(SCAN_STAGE, perf_counter_ns() - start)
+    return scanned
+
+
+def idle_backlog(meter_tick, cache, idle_timeout):
+    """ Count idle flows waiting for expiration (idle flows are the least recently updated ones) """
+    if cache.buckets is not None:  # Timeout policies: idle flows are the least recently registered of each bucket.
+        return sum(idle_backlog(meter_tick, bucket, bucket_idle_timeout)
+                   for bucket_idle_timeout, bucket in cache.buckets.items())
+    backlog = 0
+    for flow in cache.values():
+        if not flow.is_idle(meter_tick, idle_timeout):
+            break
+        backlog += 1
+    return backlog
+
+
 def get_flow_key(packet, ffi):
-    """ Create flow key from packet information (6-tuple) """
-    src_ip = ffi.string(packet.src_ip_str).decode('utf-8', errors='ignore')
-    dst_ip = ffi.string(packet.dst_ip_str).decode('utf-8', errors='ignore')
+    """ Create flow key from packet information (6-tuple), addresses are keyed by their binary value """
+    src_ip, dst_ip = packet.src_ip_key, packet.dst_ip_key
+    src_ip = src_ip[0] << 64 | src_ip[1]
+    dst_ip = dst_ip[0] << 64 | dst_ip[1]
     return packet.protocol, packet.vlan_id, \
            min(src_ip, dst_ip), max(src_ip, dst_ip),\
            min(packet.src_port, packet.dst_port), max(packet.src_port, packet.dst_port)
 
 
-def consume(packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps, sync, accounting_mode, n_dissections,
-            statistics, splt, dissector):
+def consume(packet, cache, active_timeout, idle_timeout, tcp_linger, channel, ffi, lib, udps, sync, accounting_mode,
+            n_dissections, statistics, splt, dissector, metrics):
     """ consume a packet and produce flow """
     # We maintain state for active flows computation 1 for creation, 0 for update/cut, -1 for custom expire
     flow_key = get_flow_key(packet, ffi)
     try:  # update flow
-        flow = cache[flow_key].update(packet, idle_timeout, active_timeout, ffi, lib, udps, sync, accounting_mode,
-                                      n_dissections, statistics, splt, dissector)
+        flow = cache[flow_key].update(packet, idle_timeout, active_timeout, tcp_linger, ffi, lib, udps, sync,
+                                      accounting_mode, n_dissections, statistics, splt, dissector)
         if flow is not None:
+            metrics[EXPIRATION_METRICS[flow.expiration_id]] += 1
             if flow.expiration_id < 0:  # custom expiration
                 channel.put(flow)
                 del cache[flow_key]
@@ -98,6 +284,7 @@ def consume(packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps
             if sync:
                 flow = NFlow(packet, ffi, lib, udps, sync, accounting_mode, n_dissections, statistics, splt, dissector)
                 if flow.expiration_id == -1:  # A user Plugin forced expiration on the first packet
+                    metrics[EXPIRATION_METRICS[-1]] += 1
                     channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
                     del flow
                     state = 0
@@ -114,7 +301,115 @@ def consume(packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps
     return state
 
 
-def meter_cleanup(cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector):
+def ghost_alive(ghost, time, idle_timeout, active_timeout):
+    """ Check if a flow tracked from its timestamps (first seen, last seen) is not expired by a packet at time """
+    return time - ghost[1] < idle_timeout and time - ghost[0] < active_timeout
+
+
+def ghost_update(ghosts, flow_key, time, idle_timeout, active_timeout):
+    """ Track a chunk lookback packet flow: flows alive at chunk start are owned by previous chunk meter """
+    ghost = ghosts.get(flow_key)
+    if ghost is not None and ghost_alive(ghost, time, idle_timeout, active_timeout):
+        ghost[1] = time
+    else:
+        ghosts[flow_key] = [time, time]
+
+
+def ghost_owned(ghosts, flow_key, time, idle_timeout, active_timeout):
+    """ Check if a packet updates a flow owned by previous chunk meter (ownership ends with its tracked expiration) """
+    ghost = ghosts.get(flow_key)
+    if ghost is None:
+        return False
+    if ghost_alive(ghost, time, idle_timeout, active_timeout):
+        ghost[1] = time
+        return True
+    del ghosts[flow_key]
+    return False
+
+
+def ghost_prune(ghosts, time, idle_timeout, active_timeout):
+    """ Remove tracked flows expired at time """
+    for flow_key in [flow_key for flow_key, ghost in ghosts.items()
+                     if not ghost_alive(ghost, time, idle_timeout, active_timeout)]:
+        del ghosts[flow_key]
+
+
+def chunk_cut(cache, flow_key, time, idle_timeout, channel, udps, sync, n_dissections, statistics, splt, ffi, lib,
+              dissector, metrics):
+    """ Expire a flow whose packets are now owned by next chunk meter """
+    flow = cache[flow_key]
+    flow.expiration_id = 0 if time - flow._C.bidirectional_last_seen_ms >= idle_timeout else 1
+    channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
+    del cache[flow_key]
+    metrics[EXPIRATION_METRICS[flow.expiration_id]] += 1
+    del flow
+    return 1
+
+
+def closing_update(packet, cache, closing, tcp_linger, ffi):
+    """ Track a TCP flow closed by packet (both FINs or RST seen) for its expiration once linger elapsed """
+    flow_key = get_flow_key(packet, ffi)
+    flow = cache.get(flow_key)
+    if flow is not None and flow._C.closed_ms and closing.get(flow_key, (None,))[0] is not flow:
+        closing[flow_key] = flow, flow._C.closed_ms + tcp_linger
+
+
+def closing_scan(meter_tick, closing, cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector,
+                 metrics):
+    """ Expire closed TCP flows whose linger elapsed (closing is ordered by closing time) """
+    expired = 0
+    while len(closing) > 0:
+        flow_key = closing.get_lru_key()
+        flow, deadline = closing[flow_key]
+        if deadline > meter_tick:
+            break
+        del closing[flow_key]
+        if cache.get(flow_key) is flow:  # Flow was not expired meanwhile.
+            flow.expiration_id = CLOSED_ID
+            channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
+            del cache[flow_key]
+            metrics[EXPIRATION_METRICS[CLOSED_ID]] += 1
+            expired += 1
+        del flow
+    return expired
+
+
+def cache_limit(lib, memory, cache, metrics, max_flows, memory_budget):
+    """
+        Cache flows limit according to max_flows and memory_budget. As engine memory crosses FFI boundary, it is called
+        on scan ticks only: memory_budget is converted into flows using current bytes per flow (Python bytes per flow
+        are estimated on tracking) and cache is then checked against it on each packet.
+    """
+    limit = max_flows if max_flows > 0 else maxsize
+    n_flows = len(cache)
+    if memory_budget > 0 and n_flows > 0:
+        lib.meter_memory(memory)
+        python_bytes = metrics[METRIC_INDEX["memory_python_flow_bytes"]] + \
+            metrics[METRIC_INDEX["memory_cache_entry_bytes"]]
+        used = sum([memory[idx] for idx in range(ENGINE_MEMORY_COMPONENTS)]) + n_flows * python_bytes
+        if used > 0:
+            limit = min(limit, memory_budget * n_flows // used)
+    return limit
+
+
+def evict(cache, eviction_policy, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector, metrics):
+    """ Force expire a cached flow selected by eviction policy to make room for a new one """
+    if eviction_policy == "oldest_idle":  # Least recently seen of the least recently inserted flows.
+        flow_key = min(islice(cache, EVICTION_SAMPLES), key=lambda key: cache[key]._C.bidirectional_last_seen_ms)
+    elif eviction_policy == "smallest":  # Fewest packets of sampled flows.
+        flow_key = min(cache.sample(EVICTION_SAMPLES), key=lambda key: cache[key]._C.bidirectional_packets)
+    else:
+        flow_key = cache.sample(1)[0]
+    flow = cache[flow_key]
+    flow.expiration_id = EVICTION_ID
+    channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
+    del cache[flow_key]
+    metrics[EXPIRATION_METRICS[EVICTION_ID]] += 1
+    del flow
+    return 1
+
+
+def meter_cleanup(cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector, metrics):
     """ cleanup all entries in NFCache """
     for flow_key in list(cache.keys()):
         flow = cache[flow_key]
@@ -122,10 +417,160 @@ def meter_cleanup(cache, channel, udps, sync, n_dissections, statistics, splt, f
         channel.put(flow.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector))
         del cache[flow_key]
         del flow
+        metrics[METRIC_INDEX["flows_expired_end_of_capture"]] += 1
+
+
+def stage(packet, flow_key, staging, ffi, metrics):
+    """ Stage a flow first packet (its header fields only), return rebuilt first packet on promotion """
+    staged = staging.pop(flow_key, None)
+    if staged is None:
+        flags = packet.fin | packet.syn << 1 | packet.rst << 2 | packet.psh << 3 | packet.ack << 4 | packet.urg << 5 | \
+            packet.ece << 6 | packet.cwr << 7
+        staging[flow_key] = STAGED_PACKET.pack(packet.time, packet.src_ip_key[0], packet.src_ip_key[1], packet.src_port,
+                                               packet.ip_version, flags, packet.has_mac,
+                                               bytes(ffi.buffer(packet.src_mac)), bytes(ffi.buffer(packet.dst_mac)),
+                                               packet.raw_size, packet.ip_size, packet.transport_size,
+                                               packet.payload_size)
+        metrics[METRIC_INDEX["flows_staged"]] += 1
+        return None
+    metrics[METRIC_INDEX["flows_promoted"]] += 1  # Flow second packet: staged flow is promoted to a full flow.
+    return unstage(flow_key, staged, ffi)
+
+
+def unstage(flow_key, staged, ffi):
+    """ Rebuild a staged flow first packet from its flow key and staged header fields (its payload is not kept) """
+    time, src_ip_key_0, src_ip_key_1, src_port, ip_version, flags, has_mac, src_mac, dst_mac, raw_size, ip_size, \
+        transport_size, payload_size = STAGED_PACKET.unpack(staged)
+    src_ip = src_ip_key_0 << 64 | src_ip_key_1
+    dst_ip = flow_key[3] if src_ip == flow_key[2] else flow_key[2]
+    packet = ffi.new("struct nf_packet *")
+    packet.time = time
+    packet.protocol, packet.vlan_id = flow_key[0], flow_key[1]
+    packet.src_ip_key[0], packet.src_ip_key[1] = src_ip_key_0, src_ip_key_1
+    packet.dst_ip_key[0], packet.dst_ip_key[1] = dst_ip >> 64, dst_ip & 0xFFFFFFFFFFFFFFFF
+    packet.src_port = src_port
+    packet.dst_port = flow_key[5] if src_port == flow_key[4] else flow_key[4]
+    packet.ip_version, packet.has_mac = ip_version, has_mac
+    ffi.memmove(packet.src_mac, src_mac, 6)
+    ffi.memmove(packet.dst_mac, dst_mac, 6)
+    packet.fin, packet.syn, packet.rst, packet.psh = flags & 1, flags >> 1 & 1, flags >> 2 & 1, flags >> 3 & 1
+    packet.ack, packet.urg, packet.ece, packet.cwr = flags >> 4 & 1, flags >> 5 & 1, flags >> 6 & 1, flags >> 7
+    packet.raw_size, packet.ip_size, packet.transport_size = raw_size, ip_size, transport_size
+    packet.payload_size = payload_size
+    packet.ip_content = ffi.cast("uint8_t *", packet)  # No content: zero length, pointing to valid memory.
+    return packet
+
+
+def export_summary(summary, channel, metrics):
+    """ Push an expired summary flow on channel """
+    summary.expiration_id = SUMMARY_ID
+    channel.put(summary)
+    metrics[METRIC_INDEX["summary_flows"]] += 1
+
+
+def summarize(packet, summaries, idle_timeout, active_timeout, channel, ffi, lib, udps, sync, accounting_mode,
+              n_dissections, statistics, splt, dissector, metrics):
+    """ Fold a staged flow (never promoted) into its initiator summary flow: source port and destination zeroed """
+    packet.src_port, packet.dst_port = 0, 0
+    packet.dst_ip_key[0], packet.dst_ip_key[1] = 0, 0
+    summary_key = packet.protocol, packet.vlan_id, packet.src_ip_key[0], packet.src_ip_key[1]
+    metrics[METRIC_INDEX["flows_summarized"]] += 1
+    if summary_key not in summaries and len(summaries) >= STAGING_SIZE:  # Least recently updated summary is exported.
+        summary = summaries.pop(summaries.get_lru_key())
+        export_summary(summary.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector), channel,
+                       metrics)
+    if summary_key in summaries:  # Summaries are not connections: they are never closed.
+        summary = summaries[summary_key]
+        expired = summary.update(packet, idle_timeout, active_timeout, NO_LINGER, ffi, lib, udps, sync,
+                                 accounting_mode, n_dissections, statistics, splt, dissector)
+        if expired is None:
+            summaries[summary_key] = summary  # now this summary is the most recently updated
+            return
+        del summaries[summary_key]
+        custom = expired.expiration_id < 0  # A user Plugin forced expiration after packet update.
+        export_summary(expired, channel, metrics)
+        if custom:
+            return
+    try:  # Summary flow creation (or active/idle summary renewal).
+        summaries[summary_key] = NFlow(packet, ffi, lib, udps, sync, accounting_mode, n_dissections, statistics, splt,
+                                       dissector)
+    except OSError:
+        print("WARNING: Failed to allocate memory space for flow creation. Flow creation aborted.")
 
 
-def setup_dissector(ffi, lib, n_dissections):
-    """ Setup dissector according to dissections value """
+def staging_scan(meter_tick, staging, summaries, idle_timeout, active_timeout, channel, ffi, lib, udps, sync,
+                 accounting_mode, n_dissections, statistics, splt, dissector, metrics):
+    """ Summarize staged flows not promoted within staging timeout and export idle summaries """
+    staging_timeout = min(STAGING_TIMEOUT, idle_timeout)
+    scanned = 0
+    while len(staging) > 0 and scanned < 1000:  # same budget as idle scan
+        flow_key = staging.get_lru_key()
+        if STAGED_TIME.unpack_from(staging[flow_key])[0] > meter_tick - staging_timeout:
+            break  # Oldest staged flow is not yet timed out.
+        summarize(unstage(flow_key, staging.pop(flow_key), ffi), summaries, idle_timeout, active_timeout, channel, ffi,
+                  lib, udps, sync, accounting_mode, n_dissections, statistics, splt, dissector, metrics)
+        scanned += 1
+    while len(summaries) > 0:
+        summary_key = summaries.get_lru_key()
+        summary = summaries[summary_key]
+        if not summary.is_idle(meter_tick - idle_timeout, idle_timeout):
+            break
+        del summaries[summary_key]
+        export_summary(summary.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector), channel,
+                       metrics)
+
+
+def staging_trim(staging, summaries, idle_timeout, active_timeout, channel, ffi, lib, udps, sync, accounting_mode,
+                 n_dissections, statistics, splt, dissector, metrics):
+    """ Summarize oldest staged flows early once staging size is exceeded """
+    while len(staging) > STAGING_SIZE:
+        flow_key = staging.get_lru_key()
+        summarize(unstage(flow_key, staging.pop(flow_key), ffi), summaries, idle_timeout, active_timeout, channel, ffi,
+                  lib, udps, sync, accounting_mode, n_dissections, statistics, splt, dissector, metrics)
+
+
+def staging_cleanup(staging, summaries, idle_timeout, active_timeout, channel, ffi, lib, udps, sync, accounting_mode,
+                    n_dissections, statistics, splt, dissector, metrics):
+    """ Summarize all remaining staged flows and export all summaries """
+    for flow_key in list(staging.keys()):
+        summarize(unstage(flow_key, staging.pop(flow_key), ffi), summaries, idle_timeout, active_timeout, channel, ffi,
+                  lib, udps, sync, accounting_mode, n_dissections, statistics, splt, dissector, metrics)
+    for summary_key in list(summaries.keys()):
+        summary = summaries.pop(summary_key)
+        export_summary(summary.expire(udps, sync, n_dissections, statistics, splt, ffi, lib, dissector), channel,
+                       metrics)
+
+
+def dissector_selection(ffi, lib, dissector, dissected_protocols):
+    """
+        Build dissector protocols selection (one byte per protocol id) from protocols or categories names.
+        Listed names are enabled (all protocols if only exclusions are listed) and names prefixed by "-" are disabled.
+    """
+    n_protocols = lib.dissector_protocols(dissector)
+    protocols_ids = {}  # lower case protocol or category name: protocols ids
+    for protocol_id in range(n_protocols):
+        for name in (lib.dissector_protocol_name(dissector, protocol_id),
+                     lib.dissector_protocol_category(dissector, protocol_id)):
+            if name != ffi.NULL:
+                protocols_ids.setdefault(ffi.string(name).decode('utf-8', errors='ignore').lower(),
+                                         []).append(protocol_id)
+    enabled = [name.lower() for name in dissected_protocols if not name.startswith("-")]
+    disabled = [name[1:].lower() for name in dissected_protocols if name.startswith("-")]
+    unknown = [name for name in enabled + disabled if name not in protocols_ids]
+    if unknown:
+        raise ValueError("Unknown dissected protocols or categories: {}.".format(", ".join(unknown)))
+    selection = ffi.new("uint8_t[]", [0 if enabled else 1] * n_protocols)
+    for name in enabled:
+        for protocol_id in protocols_ids[name]:
+            selection[protocol_id] = 1
+    for name in disabled:
+        for protocol_id in protocols_ids[name]:
+            selection[protocol_id] = 0
+    return selection
+
+
+def setup_dissector(ffi, lib, n_dissections, dissected_protocols=None):
+    """ Setup dissector according to dissections value and dissected protocols selection """
     if n_dissections:  # Dissection activated
         # Check that headers and loaded library match and initiate dissector.
         checker = ffi.new("struct dissector_checker *")
@@ -136,24 +581,140 @@ def setup_dissector(ffi, lib, n_dissections):
         dissector = lib.dissector_init(checker)
         if dissector == ffi.NULL:
             raise ValueError("Error while initializing dissector.")
-        # Configure it (activate bitmask to all protocols)
-        lib.dissector_configure(dissector)
+        # Configure it (activate bitmask to selected protocols, all by default)
+        selection = ffi.NULL
+        if dissected_protocols is not None:
+            try:
+                selection = dissector_selection(ffi, lib, dissector, dissected_protocols)
+            except ValueError:
+                lib.dissector_cleanup(dissector)
+                raise
+        lib.dissector_configure(dissector, selection)
     else:  # No dissection configured
         dissector = ffi.NULL
     return dissector
 
 
-def setup_capture(ffi, lib, root_idx, source, snaplen, promisc, mode):
+def dissector_applications(ffi, lib, dissector):
+    """ Dissector protocols ids by lower case protocol name (unknown protocol excluded) """
+    applications = {}
+    for protocol_id in range(1, lib.dissector_protocols(dissector)):
+        name = lib.dissector_protocol_name(dissector, protocol_id)
+        if name != ffi.NULL:
+            applications.setdefault(ffi.string(name).decode('utf-8', errors='ignore').lower(), protocol_id)
+    return applications
+
+
+def setup_timeout_policies(ffi, lib, dissector, timeout_policies, idle_timeout, active_timeout):
+    """ Setup meter timeout policies, return their idle timeouts (ms) by policy index or None without policies """
+    if timeout_policies is None:
+        return None
+    applications = dissector_applications(ffi, lib, dissector) if dissector != ffi.NULL else {}
+    policies_idle = []
+    for policy in timeout_policies:
+        application = 0  # any
+        if "application" in policy:
+            application = applications.get(policy["application"].lower())
+            if application is None:
+                raise ValueError("Unknown timeout policy application: {}.".format(policy["application"]))
+        # Unset timeouts are streamer ones.
+        policy_idle = policy["idle_timeout"] * 1000 if "idle_timeout" in policy else idle_timeout
+        policy_active = policy["active_timeout"] * 1000 if "active_timeout" in policy else active_timeout
+        if not lib.meter_timeout_policy(policy.get("protocol", 0), policy.get("port", 0), application, policy_idle,
+                                        policy_active):
+            raise ValueError("Too many timeout policies.")
+        policies_idle.append(policy_idle)
+    return policies_idle
+
+
+def validate_timeout_applications(applications):
+    """ Check timeout policies applications names against engine dissector (raise ValueError on unknown names) """
+    ffi, lib = create_engine()
+    try:
+        dissector = setup_dissector(ffi, lib, 1)
+        known = dissector_applications(ffi, lib, dissector)
+        lib.dissector_cleanup(dissector)
+    finally:
+        ffi.dlclose(lib)
+    unknown = [application for application in applications if application.lower() not in known]
+    if unknown:
+        raise ValueError("Unknown timeout policies applications: {}.".format(", ".join(unknown)))
+
+
+def setup_service_cache(lib, n_dissections, service_cache_size, service_cache_verify):
+    """ Setup meter service cache of recent confident detections """
+    if n_dissections and service_cache_size > 0:
+        if not lib.meter_service_cache(service_cache_size, int(service_cache_verify)):
+            raise OSError("Not enough memory for service cache creation.")
+
+
+def setup_host_table(lib, n_dissections, host_table_size):
+    """ Setup meter host table sharing nDPI id structures across flows of an endpoint """
+    if n_dissections and host_table_size > 0:
+        if not lib.meter_host_table(host_table_size):
+            raise OSError("Not enough memory for host table creation.")
+
+
+def validate_dissected_protocols(dissected_protocols):
+    """ Check dissected protocols names against engine dissector (raise ValueError on unknown names) """
+    ffi, lib = create_engine()
+    try:
+        lib.dissector_cleanup(setup_dissector(ffi, lib, 1, dissected_protocols))
+    finally:
+        ffi.dlclose(lib)
+
+
+def setup_ip_anonymizer(ffi, lib, ip_anonymization_key):
+    """ Setup prefix preserving IP anonymizer according to ip_anonymization_key value """
+    if ip_anonymization_key is not None:
+        ip_anonymizer = lib.anonymizer_init(ip_anonymization_key, 65536)
+        if ip_anonymizer == ffi.NULL:
+            raise ValueError("Error while initializing IP anonymizer.")
+    else:  # No IP anonymization configured
+        ip_anonymizer = ffi.NULL
+    return ip_anonymizer
+
+
+class IPAnonymizerChannel(object):
+    """ Meter side channel wrapper: anonymize flows IP addresses (prefix preserving) before pushing them """
+    def __init__(self, ffi, lib, ip_anonymizer, channel):
+        self.ffi = ffi
+        self.lib = lib
+        self.ip_anonymizer = ip_anonymizer
+        self.channel = channel
+
+    def put(self, flow):
+        if flow is not None:
+            for attr in ("src_ip", "dst_ip"):
+                anonymized = anonymize_ip(self.ffi, self.lib, self.ip_anonymizer, getattr(flow, attr))
+                if anonymized is not None:
+                    setattr(flow, attr, anonymized)
+        self.channel.put(flow)
+
+
+def setup_capture(ffi, lib, root_idx, source, snaplen, promisc, mode, replay_speed, buffer_size, immediate_mode,
+                  poll_timeout, capture_backend, window, memory_map):
     """ Setup capture options """
-    capture = lib.capture_open(bytes(source, 'utf-8'), mode, root_idx)
+    capture = lib.capture_open(bytes(source, 'utf-8'), mode, root_idx, CAPTURE_BACKENDS.index(capture_backend),
+                               int(memory_map))
     if capture == ffi.NULL:
         return
-    fanout_set_failed = lib.capture_set_fanout(capture, mode, root_idx)
-    if fanout_set_failed:
+    if window is not None:  # Indexed pcap time window or parallel chunk.
+        window_set_failed = lib.capture_set_window(capture, mode, root_idx, *window)
+        if window_set_failed:
+            return
+    replay_set_failed = lib.capture_set_replay(capture, mode, root_idx, replay_speed)
+    if replay_set_failed:
         return
-    timeout_set_failed = lib.capture_set_timeout(capture, mode, root_idx)
+    timeout_set_failed = lib.capture_set_timeout(capture, mode, root_idx, poll_timeout)
     if timeout_set_failed:
         return
+    buffer_size_set_failed = lib.capture_set_buffer_size(capture, mode, root_idx, buffer_size)
+    if buffer_size_set_failed:
+        return
+    immediate_mode_set_failed = lib.capture_set_immediate_mode(capture, mode, root_idx, int(immediate_mode))
+    if immediate_mode_set_failed:
+        return
     promisc_set_failed = lib.capture_set_promisc(capture, mode, root_idx, int(promisc))
     if promisc_set_failed:
         return
@@ -172,8 +733,12 @@ def setup_filter(capture, lib, root_idx, bpf_filter):
     return True
 
 
-def activate_capture(capture, lib, root_idx, bpf_filter, mode):
-    """ Capture activation function """
+def activate_capture(capture, lib, root_idx, bpf_filter, mode, fanout_hash, fanout_mode, fanout_group_id):
+    """ Capture activation function (capture joins its fanout group, a new kernel allocated one if negative) """
+    fanout_set_failed = lib.capture_set_fanout(capture, mode, root_idx, FANOUT_HASHES.index(fanout_hash),
+                                               FANOUT_MODES.index(fanout_mode), fanout_group_id)
+    if fanout_set_failed:
+        return False
     activation_failed = lib.capture_activate(capture, mode, root_idx)
     if activation_failed:
         return False
@@ -181,35 +746,242 @@ def activate_capture(capture, lib, root_idx, bpf_filter, mode):
         return setup_filter(capture, lib, root_idx, bpf_filter)
 
 
-def track(lib, capture, mode, interface_stats, tracker, processed, ignored):
+def setup_captures(ffi, lib, root_idx, sources, snaplen, promisc, mode, replay_speed, buffer_size, immediate_mode,
+                   poll_timeout, capture_backend, window, memory_map):
+    """ Setup one capture per source """
+    captures = []
+    for idx, source in enumerate(sources):
+        capture = setup_capture(ffi, lib, root_idx, source, snaplen, promisc, mode, replay_speed, buffer_size,
+                                immediate_mode, poll_timeout, capture_backend, window, memory_map)
+        if capture is None:  # Failing capture is released by engine.
+            for opened in captures:
+                lib.capture_close(opened)
+            return
+        captures.append(capture)
+    return captures
+
+
+def activation_turns(n_captures, mode, fanout_group_id):
+    """ Meters activate their captures in turn with several interfaces or kernel allocated fanout groups """
+    return n_captures > 1 or (mode == 1 and fanout_group_id is None)
+
+
+def end_activation_turn(activations):
+    """ Let next meter activate its captures """
+    with activations.get_lock():
+        activations.value += 1
+
+
+def activate_captures(captures, lib, root_idx, bpf_filter, mode, activations, fanout_hash, fanout_mode,
+                      fanout_group_id, fanout_groups):
+    """ Captures activation function. With several interfaces, meters join each interface fanout group in meters
+        order: kernel then dispatches both directions of a flow (seen on different interfaces) to the same meter.
+        Unset fanout group ids are allocated by kernel (unique on the host) to meter 0 captures and shared with
+        following meters through fanout_groups. """
+    multiple = len(captures) > 1
+    turns = activation_turns(len(captures), mode, fanout_group_id)
+    if turns:
+        while activations.value < root_idx:
+            sleep(0.001)
+    if fanout_group_id is not None:
+        groups = [(fanout_group_id + idx) % 65536 for idx in range(len(captures))]
+    elif root_idx == 0:
+        groups = [-1] * len(captures)
+    else:
+        groups = fanout_groups[:len(captures)]
+    failed = None
+    if mode == 1 and min(groups) < 0 < root_idx:  # Meter 0 failed to create the groups we should join.
+        failed = -1
+    else:
+        for idx, capture in enumerate(captures):
+            if not activate_capture(capture, lib, root_idx, bpf_filter, mode, fanout_hash, fanout_mode, groups[idx]) \
+                    or (multiple and lib.capture_set_nonblock(capture, mode, root_idx)):
+                failed = idx  # Failing capture is released by engine.
+                break
+            if mode == 1 and groups[idx] < 0:
+                fanout_groups[idx] = lib.capture_fanout_group(capture)
+    if turns:
+        end_activation_turn(activations)
+    if failed is not None:
+        for idx, capture in enumerate(captures):
+            if idx != failed:
+                lib.capture_close(capture)
+        return False
+    return True
+
+
+def captures_next(lib, captures, cursor, nf_packet, decode_tunnels, n_roots, root_idx, mode, poll_timeout):
+    """ Next packet of several non blocking captures, read in turn. Wait on all of them once they are all empty """
+    for _ in range(len(captures)):
+        ret = lib.capture_next(captures[cursor[0]], nf_packet, decode_tunnels, n_roots, root_idx, mode)
+        cursor[0] = (cursor[0] + 1) % len(captures)
+        if ret != -1:
+            return ret
+    lib.capture_wait(captures, len(captures), poll_timeout)
+    return -1
+
+
+def object_footprint(value):
+    """ Shallow object size including its direct items for containers """
+    size = getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum([getsizeof(item) for item in value])
+    elif isinstance(value, dict):
+        size += sum([getsizeof(key) + getsizeof(item) for key, item in value.items()])
+    return size
+
+
+def flow_footprint(flow):
+    """ Estimate Python side bytes of a cached NFlow (object, attributes values and udps namespace) """
+    size = getsizeof(flow)
+    for name in NFlow.__slots__:
+        value = getattr(flow, name, None)
+        if value is not None:
+            size += object_footprint(value)
+    udps = getattr(flow, "udps", None)
+    if udps is not None:
+        size += object_footprint(vars(udps))
+    return size
+
+
+def memory_footprint(lib, memory, cache, metrics):
+    """
+        Update memory metrics. Engine components are exactly accounted while Python ones (NFlow and cache entry) are
+        estimated on a sample of the most recently updated flows. Bytes per flow are kept from the last tracking with
+        active flows.
+    """
+    lib.meter_memory(memory)
+    n_flows = len(cache)
+    engine_bytes = sum([memory[idx] for idx in range(ENGINE_MEMORY_COMPONENTS)])
+    python_bytes = 0
+    if n_flows:
+        keys = list(islice(reversed(cache), MEMORY_SAMPLES))
+        python_flow = sum([flow_footprint(cache[key]) for key in keys]) // len(keys)
+        cache_entry = getsizeof(cache) // n_flows + sum([object_footprint(key) for key in keys]) // len(keys)
+        for idx in range(ENGINE_MEMORY_COMPONENTS):
+            metrics[METRIC_INDEX[MEMORY_COMPONENTS[idx]]] = memory[idx] // n_flows
+        metrics[METRIC_INDEX["memory_python_flow_bytes"]] = python_flow
+        metrics[METRIC_INDEX["memory_cache_entry_bytes"]] = cache_entry
+        python_bytes = n_flows * (python_flow + cache_entry)
+    metrics[METRIC_INDEX["memory_active_flows_bytes"]] = engine_bytes + python_bytes
+    metrics[METRIC_INDEX["memory_peak_bytes"]] = max(metrics[METRIC_INDEX["memory_peak_bytes"]],
+                                                     engine_bytes + python_bytes)
+    metrics[METRIC_INDEX["active_flows_peak"]] = max(metrics[METRIC_INDEX["active_flows_peak"]], n_flows)
+
+
+def pools_usage(lib, pools, metrics):
+    """ Update engine object pools metrics """
+    lib.meter_pools(pools)
+    allocated, released = 0, 0
+    for idx, pool in enumerate(POOLS):
+        metrics[METRIC_INDEX["pool_{}_objects".format(pool)]] = pools[idx * POOL_STATS]
+        metrics[METRIC_INDEX["pool_{}_slabs".format(pool)]] = pools[idx * POOL_STATS + 1]
+        allocated += pools[idx * POOL_STATS + 2]
+        released += pools[idx * POOL_STATS + 3]
+    metrics[METRIC_INDEX["pool_slabs_allocated"]] = allocated
+    metrics[METRIC_INDEX["pool_slabs_released"]] = released
+
+
+def service_cache_usage(lib, services, metrics):
+    """ Update service cache metrics """
+    lib.meter_service_cache_stats(services)
+    for idx, name in enumerate(SERVICE_CACHE_METRICS):
+        metrics[METRIC_INDEX[name]] = services[idx]
+
+
+def host_table_usage(lib, hosts, metrics):
+    """ Update host table metrics """
+    lib.meter_host_table_stats(hosts)
+    for idx, name in enumerate(HOST_TABLE_METRICS):
+        metrics[METRIC_INDEX[name]] = hosts[idx]
+
+
+def track(lib, captures, mode, interface_stats, tracker, metrics, active_flows, backlog, udps, memory, pools,
+          services, hosts, cache, staged_flows):
     """ Update shared performance values """
-    lib.capture_stats(capture, interface_stats, mode)
-    tracker[0].value = interface_stats.dropped
-    tracker[1].value = processed
-    tracker[2].value = ignored
+    dropped = 0
+    for capture in captures:
+        lib.capture_stats(capture, interface_stats, mode)
+        dropped += interface_stats.dropped
+    metrics[METRIC_INDEX["packets_dropped_filtered_by_kernel"]] = dropped
+    metrics[METRIC_INDEX["active_flows"]] = active_flows
+    metrics[METRIC_INDEX["staged_flows"]] = staged_flows
+    metrics[METRIC_INDEX["flows_created"]] = active_flows + sum([metrics[idx] for idx in EXPIRATION_METRICS.values()])\
+        + metrics[METRIC_INDEX["flows_expired_end_of_capture"]]
+    metrics[METRIC_INDEX["idle_scan_backlog"]] = backlog
+    metrics[METRIC_INDEX["plugins_time_us"]] = sum([udp.elapsed for udp in udps]) // 1000
+    memory_footprint(lib, memory, cache, metrics)
+    pools_usage(lib, pools, metrics)
+    service_cache_usage(lib, services, metrics)
+    host_table_usage(lib, hosts, metrics)
+    tracker[:] = metrics
 
 
 def meter_workflow(source, snaplen, decode_tunnels, bpf_filter, promisc, n_roots, root_idx, mode,
                    idle_timeout, active_timeout, accounting_mode, udps, n_dissections, statistics, splt,
-                   channel, tracker, lock):
+                   channel, tracker, lock, activations, shards_path, anonymizer, ip_anonymization_key, profiling,
+                   profile_tracker, replay_speed, dissected_protocols, service_cache_size, service_cache_verify,
+                   host_table_size, fanout_hash, fanout_mode, fanout_group_id, fanout_groups, buffer_size,
+                   immediate_mode, poll_timeout, capture_backend, window, memory_map, max_flows, memory_budget,
+                   eviction_policy, scan_protection, tcp_linger, timeout_policies):
     """ Metering workflow """
     set_affinity(root_idx+1)
+    if shards_path is not None:  # Sharded export: meter writes its own flows and channel is used for coordination.
+        channel = ShardWriter(shards_path, root_idx, anonymizer, channel)
     ffi, lib = create_engine()
-    capture = setup_capture(ffi, lib, root_idx, source, snaplen, promisc, mode)
-    if capture is None:
+    sources = source if isinstance(source, tuple) else (source,)  # Several interfaces metered as one source.
+    captures = setup_captures(ffi, lib, root_idx, sources, snaplen, promisc, mode, replay_speed, buffer_size,
+                              immediate_mode, poll_timeout, capture_backend, window, memory_map)
+    if captures is None:
+        if activation_turns(len(sources), mode, fanout_group_id):
+            end_activation_turn(activations)
         ffi.dlclose(lib)
         channel.put(None)
         return
+    capture, cursor = captures[0], [0]
+    capture_roots, capture_idx = n_roots, root_idx
+    # Parallel chunk: flows owned by previous chunk meter and flows owned by us as seen by next chunk meter, both
+    # tracked from their (first seen, last seen) over lookbacks so that each packet is processed by a single meter.
+    ghosts, next_ghosts = {}, {}
+    if window is not None and window[3] >= 0:  # Parallel chunk: meter owns all flows started within its chunk.
+        capture_roots, capture_idx = 1, 0
     meter_tick, meter_scan_tick, meter_track_tick = 0, 0, 0  # meter, idle scan and perf track timelines
     meter_scan_interval, meter_track_interval = 10, 1000  # we scan each 10 msecs and update perf each sec.
-    cache = NFCache()
-    dissector = setup_dissector(ffi, lib, n_dissections)
-    active_flows, ignored_packets, processed_packets = 0, 0, 0
+    cache_bounded = max_flows > 0 or memory_budget > 0  # Flows are evicted to make room for new ones.
+    cache = NFSampledCache() if cache_bounded and eviction_policy != "oldest_idle" else NFCache()
+    # Scan protection: TCP and UDP flows first packets wait in staging until a second packet promotes them to cache.
+    staging, summaries = (NFCache(), NFCache()) if scan_protection else (None, None)
+    # Closed TCP flows are expired once tcp_linger elapsed (trailing packets are accounted meanwhile).
+    closing = NFCache() if tcp_linger is not None else None
+    tcp_linger = tcp_linger if tcp_linger is not None else NO_LINGER
+    dissector = setup_dissector(ffi, lib, n_dissections, dissected_protocols)
+    setup_service_cache(lib, n_dissections, service_cache_size, service_cache_verify)
+    setup_host_table(lib, n_dissections, host_table_size)
+    policies_idle = setup_timeout_policies(ffi, lib, dissector, timeout_policies, idle_timeout, active_timeout)
+    if policies_idle is not None:  # Flows idle timeouts differ: one expiry bucket per distinct idle timeout.
+        cache.set_buckets(set(policies_idle) | {idle_timeout})
+    ip_anonymizer = setup_ip_anonymizer(ffi, lib, ip_anonymization_key)
+    if ip_anonymizer != ffi.NULL:  # Flows leave the meter with anonymized addresses.
+        channel = IPAnonymizerChannel(ffi, lib, ip_anonymizer, channel)
+    profiler = None
+    if profiling > 0:  # Opt-in stages profiling: one packet out of profiling value is profiled.
+        profiler = NFProfiler(len(profile_tracker) // PROFILE_SLOTS, profiling)
+        channel = ProfiledChannel(profiler, PUT_STAGE, channel)
+    active_flows = 0
+    metrics = [0] * len(METER_METRICS)  # meter local metrics, pushed to shared tracker on each performance tracking.
+    processed_idx, ignored_idx = METRIC_INDEX["packets_processed"], METRIC_INDEX["packets_ignored"]
     sync = False
     if len(udps) > 0:  # streamer started with udps: sync internal structures on update.
         sync = True
+        udps = tuple(NFPluginTimer(udp, profiler, len(METER_STAGES) + idx * len(PLUGIN_HOOKS))
+                     for idx, udp in enumerate(udps))
     remaining_packets = True
     interface_stats = ffi.new("struct nf_stat *")
+    memory = ffi.new("uint64_t[]", ENGINE_MEMORY_COMPONENTS)
+    flows_limit = cache_limit(lib, memory, cache, metrics, max_flows, memory_budget)  # Updated on scan ticks.
+    pools = ffi.new("uint64_t[]", len(POOLS) * POOL_STATS)
+    services = ffi.new("uint64_t[]", len(SERVICE_CACHE_METRICS))
+    hosts = ffi.new("uint64_t[]", len(HOST_TABLE_METRICS))
     # We ensure that processes start at the same time
     if root_idx == n_roots - 1:
         lock.release()
@@ -217,54 +989,161 @@ def meter_workflow(source, snaplen, decode_tunnels, bpf_filter, promisc, n_roots
         lock.acquire()
         lock.release()
     # Here the last operation, BPF filtering setup and activation.
-    if not activate_capture(capture, lib, root_idx, bpf_filter, mode):
+    if not activate_captures(captures, lib, root_idx, bpf_filter, mode, activations, fanout_hash, fanout_mode,
+                             fanout_group_id, fanout_groups):
+        lib.dissector_cleanup(dissector)
+        if ip_anonymizer != ffi.NULL:
+            lib.anonymizer_cleanup(ip_anonymizer)
         ffi.dlclose(lib)
         channel.put(None)
         return
     while remaining_packets:
         nf_packet = ffi.new("struct nf_packet *")
-        ret = lib.capture_next(capture, nf_packet, decode_tunnels, n_roots, root_idx, mode)
+        profiled = profiler is not None and profiler.sample()
+        if profiled:
+            stage_start = perf_counter_ns()
+        if len(captures) > 1:
+            ret = captures_next(lib, captures, cursor, nf_packet, decode_tunnels, n_roots, root_idx, mode,
+                                poll_timeout)
+        else:
+            ret = lib.capture_next(capture, nf_packet, decode_tunnels, capture_roots, capture_idx, mode)
+        if profiled:
+            profiler.record(CAPTURE_STAGE, perf_counter_ns() - stage_start)
         if ret > 0:  # Valid must be processed by meter
             packet_time = nf_packet.time
             if packet_time > meter_tick:
                 meter_tick = packet_time
             else:
                 nf_packet.time = meter_tick  # Force time order
+            if ret == 3:  # Parallel chunk lookback: flows alive at chunk start are owned by previous chunk meter.
+                ghost_update(ghosts, get_flow_key(nf_packet, ffi), packet_time, idle_timeout, active_timeout)
+                ret = 2
+            elif ret == 4:  # Parallel chunk overflow: our flows are followed as long as next chunk meter skips them.
+                flow_key = get_flow_key(nf_packet, ffi)
+                if len(cache) == 0 and len(next_ghosts) == 0:
+                    remaining_packets = False
+                    ret = 2
+                elif ghost_owned(next_ghosts, flow_key, packet_time, idle_timeout, active_timeout):
+                    ret = 1
+                else:
+                    ret = 2
+                    if staging is not None and flow_key in staging:  # Staged flow is cut as its one packet flow.
+                        active_flows += consume(unstage(flow_key, staging.pop(flow_key), ffi), cache, active_timeout,
+                                                idle_timeout, tcp_linger, channel, ffi, lib, udps, sync,
+                                                accounting_mode, n_dissections, statistics, splt, dissector, metrics)
+                    if flow_key in cache:
+                        active_flows -= chunk_cut(cache, flow_key, meter_tick, idle_timeout, channel, udps, sync,
+                                                  n_dissections, statistics, splt, ffi, lib, dissector, metrics)
+            else:
+                if ret == 5:  # Parallel chunk packet also read by next chunk meter as its lookback.
+                    ghost_update(next_ghosts, get_flow_key(nf_packet, ffi), packet_time, idle_timeout, active_timeout)
+                    ret = 1
+                if ret == 1 and ghosts and ghost_owned(ghosts, get_flow_key(nf_packet, ffi), packet_time,
+                                                       idle_timeout, active_timeout):
+                    ret = 2
             if ret == 1:  # Must be processed
-                processed_packets += 1
+                metrics[processed_idx] += 1
                 go_scan = False
                 if meter_tick - meter_scan_tick >= meter_scan_interval:
                     go_scan = True  # Activate scan
                     meter_scan_tick = meter_tick
-                # Consume packet and return diff
-                diff = consume(nf_packet, cache, active_timeout, idle_timeout, channel, ffi, lib, udps, sync,
-                               accounting_mode, n_dissections, statistics, splt, dissector)
+                    if cache_bounded:
+                        flows_limit = cache_limit(lib, memory, cache, metrics, max_flows, memory_budget)
+                if profiled:  # Flow key is computed again by consume, so its latency is timed separately.
+                    stage_start = perf_counter_ns()
+                    get_flow_key(nf_packet, ffi)
+                    profiler.record(FLOW_KEY_STAGE, perf_counter_ns() - stage_start)
+                    stage_start = perf_counter_ns()
+                staged, promoted = False, None
+                if staging is not None and nf_packet.protocol in STAGED_PROTOCOLS:
+                    flow_key = get_flow_key(nf_packet, ffi)
+                    if flow_key not in cache:
+                        promoted = stage(nf_packet, flow_key, staging, ffi, metrics)
+                        staged = promoted is None
+                        if staged and len(staging) > STAGING_SIZE:
+                            staging_trim(staging, summaries, idle_timeout, active_timeout, channel, ffi, lib, udps,
+                                         sync, accounting_mode, n_dissections, statistics, splt, dissector, metrics)
+                diff = 0
+                if not staged:
+                    if cache_bounded and len(cache) >= flows_limit and get_flow_key(nf_packet, ffi) not in cache:
+                        active_flows -= evict(cache, eviction_policy, channel, udps, sync, n_dissections, statistics,
+                                              splt, ffi, lib, dissector, metrics)
+                    if promoted is not None:  # Promoted flow is created from its rebuilt first packet.
+                        diff = consume(promoted, cache, active_timeout, idle_timeout, tcp_linger, channel, ffi,
+                                       lib, udps, sync, accounting_mode, n_dissections, statistics, splt, dissector,
+                                       metrics)
+                    # Consume packet and return diff
+                    diff += consume(nf_packet, cache, active_timeout, idle_timeout, tcp_linger, channel, ffi, lib,
+                                    udps, sync, accounting_mode, n_dissections, statistics, splt, dissector, metrics)
+                    if policies_idle is not None:
+                        bucket_update(cache, get_flow_key(nf_packet, ffi), idle_timeout, policies_idle)
+                    if closing is not None and nf_packet.protocol == 6 and (nf_packet.fin or nf_packet.rst):
+                        closing_update(nf_packet, cache, closing, tcp_linger, ffi)
+                if profiled:
+                    profiler.record(CONSUME_STAGE, perf_counter_ns() - stage_start)
                 active_flows += diff
                 if go_scan:
-                    idles = meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections,
-                                       statistics, splt, ffi, lib, dissector)
-                    active_flows -= idles
+                    active_flows -= profiled_meter_scan(profiler, meter_tick, cache, idle_timeout, channel, udps,
+                                                        sync, n_dissections, statistics, splt, ffi, lib, dissector,
+                                                        metrics)
+                    if closing is not None:
+                        active_flows -= closing_scan(meter_tick, closing, cache, channel, udps, sync, n_dissections,
+                                                     statistics, splt, ffi, lib, dissector, metrics)
+                    if staging is not None:
+                        staging_scan(meter_tick, staging, summaries, idle_timeout, active_timeout, channel, ffi, lib,
+                                     udps, sync, accounting_mode, n_dissections, statistics, splt, dissector, metrics)
             else:  # time ticker
                 if meter_tick - meter_scan_tick >= meter_scan_interval:
-                    idles = meter_scan(meter_tick, cache, idle_timeout, channel, udps, sync, n_dissections,
-                                       statistics, splt, ffi, lib, dissector)
-                    active_flows -= idles
+                    active_flows -= profiled_meter_scan(profiler, meter_tick, cache, idle_timeout, channel, udps,
+                                                        sync, n_dissections, statistics, splt, ffi, lib, dissector,
+                                                        metrics)
+                    if closing is not None:
+                        active_flows -= closing_scan(meter_tick, closing, cache, channel, udps, sync, n_dissections,
+                                                     statistics, splt, ffi, lib, dissector, metrics)
+                    if staging is not None:
+                        staging_scan(meter_tick, staging, summaries, idle_timeout, active_timeout, channel, ffi, lib,
+                                     udps, sync, accounting_mode, n_dissections, statistics, splt, dissector, metrics)
                     meter_scan_tick = meter_tick
+                    if cache_bounded:
+                        flows_limit = cache_limit(lib, memory, cache, metrics, max_flows, memory_budget)
         elif ret == 0:  # Ignored packet
-            ignored_packets += 1
+            metrics[ignored_idx] += 1
+            metrics[PARSE_ERROR_OFFSET + nf_packet.parse_error] += 1
         elif ret == -1:  # Read error or empty buffer
             pass
         else:  # End of file
             remaining_packets = False  # end of loop
         if meter_tick - meter_track_tick >= meter_track_interval:  # Performance tracking
-            track(lib, capture, mode, interface_stats, tracker, processed_packets, ignored_packets)
+            track(lib, captures, mode, interface_stats, tracker, metrics, active_flows,
+                  idle_backlog(meter_tick, cache, idle_timeout), udps, memory, pools, services, hosts, cache,
+                  len(staging) if staging is not None else 0)
+            if profiler is not None:
+                profiler.push(profile_tracker)
+            ghost_prune(ghosts, meter_tick, idle_timeout, active_timeout)
+            ghost_prune(next_ghosts, meter_tick, idle_timeout, active_timeout)
             meter_track_tick = meter_tick
+    # Remaining flows footprint is accounted before their expiration.
+    track(lib, captures, mode, interface_stats, tracker, metrics, active_flows,
+          idle_backlog(meter_tick, cache, idle_timeout), udps, memory, pools, services, hosts, cache,
+          len(staging) if staging is not None else 0)
     # Expire all remaining flows in the cache.
-    meter_cleanup(cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector)
-    # Close capture
-    lib.capture_close(capture)
+    meter_cleanup(cache, channel, udps, sync, n_dissections, statistics, splt, ffi, lib, dissector, metrics)
+    if staging is not None:  # Remaining staged flows are summarized.
+        staging_cleanup(staging, summaries, idle_timeout, active_timeout, channel, ffi, lib, udps, sync,
+                        accounting_mode, n_dissections, statistics, splt, dissector, metrics)
+    # Final metrics.
+    track(lib, captures, mode, interface_stats, tracker, metrics, 0, 0, udps, memory, pools, services, hosts, cache,
+          0)
+    if profiler is not None:
+        profiler.push(profile_tracker)
+    # Close captures
+    for capture in captures:
+        lib.capture_close(capture)
     # Clean dissector
     lib.dissector_cleanup(dissector)
+    # Clean IP anonymizer
+    if ip_anonymizer != ffi.NULL:
+        lib.anonymizer_cleanup(ip_anonymizer)
     # Release engine library
     ffi.dlclose(lib)
     channel.put(None)
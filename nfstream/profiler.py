@@ -0,0 +1,136 @@
+"""
+------------------------------------------------------------------------------------------------------------------------
+profiler.py
+Copyright (C) 2019-20 - NFStream Developers
+This file is part of NFStream, a Flexible Network Data Analysis Framework (https://www.nfstream.org/).
+NFStream is free software: you can redistribute it and/or modify it under the terms of the GNU Lesser General Public
+License as published by the Free Software Foundation, either version 3 of the License, or (at your option) any later
+version.
+NFStream is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the implied warranty
+of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more details.
+You should have received a copy of the GNU Lesser General Public License along with NFStream.
+If not, see <http://www.gnu.org/licenses/>.
+------------------------------------------------------------------------------------------------------------------------
+"""
+
+
+try:
+    from time import perf_counter_ns
+except ImportError:  # Python 3.6: nanoseconds from float seconds counter.
+    from time import perf_counter
+
+    def perf_counter_ns():
+        return int(perf_counter() * 1000000000)
+
+# Latencies histograms use log2 buckets of nanoseconds: bucket i counts latencies in [2^(i-1), 2^i[ ns.
+PROFILE_BUCKETS = 40
+# Per stage shared layout: samples count, cumulative latency (ns) then buckets.
+PROFILE_SLOTS = PROFILE_BUCKETS + 2
+# Meter hot path stages. consume latency includes get_flow_key one.
+METER_STAGES = ("capture_next", "get_flow_key", "consume", "meter_scan", "channel_put")
+PLUGIN_HOOKS = ("on_init", "on_update", "on_expire")
+
+
+def profile_stages(udps):
+    """ Profiled stages names: meter stages then each plugin hook (plugin_idx.PluginClass.hook) """
+    stages = list(METER_STAGES)
+    for idx, udp in enumerate(udps):
+        for hook in PLUGIN_HOOKS:
+            stages.append("{}.{}.{}".format(idx, type(udp).__name__, hook))
+    return tuple(stages)
+
+
+class NFProfiler(object):
+    """
+        NFProfiler: meter side latencies profiler.
+        Hot path stages are timed on one packet out of sampling_rate, while meter_scan, channel_put and plugins hooks
+        are timed on each call. Histograms are local to the meter and pushed to shared memory on performance tracking.
+    """
+    __slots__ = ('sampling_rate',
+                 'histograms',
+                 '_countdown')
+
+    def __init__(self, n_stages, sampling_rate):
+        self.sampling_rate = sampling_rate
+        self.histograms = [0] * (n_stages * PROFILE_SLOTS)
+        self._countdown = sampling_rate
+
+    def sample(self):
+        """ Return True when current packet must be profiled """
+        self._countdown -= 1
+        if self._countdown == 0:
+            self._countdown = self.sampling_rate
+            return True
+        return False
+
+    def record(self, stage_idx, elapsed):
+        offset = stage_idx * PROFILE_SLOTS
+        self.histograms[offset] += 1
+        self.histograms[offset + 1] += elapsed
+        self.histograms[offset + 2 + min(elapsed.bit_length(), PROFILE_BUCKETS - 1)] += 1
+
+    def push(self, shared):
+        shared[:] = self.histograms
+
+
+class ProfiledChannel(object):
+    """ Meter side channel wrapper timing each put (backpressure from streamer appears here) """
+    def __init__(self, profiler, stage_idx, channel):
+        self.profiler = profiler
+        self.stage_idx = stage_idx
+        self.channel = channel
+
+    def put(self, flow):
+        start = perf_counter_ns()
+        self.channel.put(flow)
+        self.profiler.record(self.stage_idx, perf_counter_ns() - start)
+
+
+def histogram_quantile(buckets, count, q):
+    """ Estimate quantile q from log2 buckets (upper bound of the matching bucket, in microseconds) """
+    rank, seen = q * count, 0
+    for idx, bucket in enumerate(buckets):
+        seen += bucket
+        if seen >= rank:
+            return (1 << idx) / 1000
+    return (1 << (len(buckets) - 1)) / 1000
+
+
+def profiling_snapshot(stages, shared_histograms):
+    """ Aggregate meters histograms per stage: samples count, mean and quantiles (us) and raw buckets """
+    profiling = {}
+    for stage_idx, stage in enumerate(stages):
+        offset = stage_idx * PROFILE_SLOTS
+        count, total, buckets = 0, 0, [0] * PROFILE_BUCKETS
+        for shared in shared_histograms:
+            values = shared[offset:offset + PROFILE_SLOTS]
+            count += values[0]
+            total += values[1]
+            buckets = [b + v for b, v in zip(buckets, values[2:])]
+        if count == 0:
+            continue
+        profiling[stage] = {"samples": count,
+                            "mean_us": total / count / 1000,
+                            "p50_us": histogram_quantile(buckets, count, 0.5),
+                            "p90_us": histogram_quantile(buckets, count, 0.9),
+                            "p99_us": histogram_quantile(buckets, count, 0.99),
+                            "buckets": buckets}
+    return profiling
+
+
+def profiling_exposition(profiling):
+    """ Render stages latencies as Prometheus histograms (seconds) """
+    lines = ["# TYPE nfstream_stage_latency_seconds histogram"]
+    for stage, stats in profiling.items():
+        cumulative = 0
+        for idx, bucket in enumerate(stats["buckets"]):
+            cumulative += bucket
+            lines.append('nfstream_stage_latency_seconds_bucket{{stage="{}",le="{}"}} {}'.format(stage,
+                                                                                               (1 << idx) / 1e9,
+                                                                                               cumulative))
+        lines.append('nfstream_stage_latency_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(stage,
+                                                                                              stats["samples"]))
+        lines.append('nfstream_stage_latency_seconds_sum{{stage="{}"}} {}'.format(stage, stats["mean_us"] *
+                                                                                  stats["samples"] / 1e6))
+        lines.append('nfstream_stage_latency_seconds_count{{stage="{}"}} {}'.format(stage, stats["samples"]))
+    return lines
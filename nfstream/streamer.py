@@ -19,13 +19,20 @@ import time as tm
 import os
 import platform
 from collections.abc import Iterable
+from importlib.util import find_spec
 from psutil import net_if_addrs, cpu_count
 from os.path import isfile
-from .meter import meter_workflow
+from .meter import meter_workflow, validate_dissected_protocols, validate_timeout_applications
 from .anonymizer import NFAnonymizer
 from.plugin import NFPlugin
-from .utils import csv_converter, open_file, RepeatedTimer, update_performances, set_affinity, validate_flows_per_file
-from .utils import create_csv_file_path
+from .utils import open_file, RepeatedTimer, update_performances, set_affinity, validate_flows_per_file
+from .utils import write_batch, EXPORT_BATCH
+from .utils import validate_shard_per_meter, create_csv_file_path, create_manifest_file_path, write_manifest
+from .utils import METER_METRICS, metrics_snapshot, update_metrics, validate_metrics_address, MetricsServer
+from .utils import FANOUT_HASHES, FANOUT_MODES, CAPTURE_BACKENDS, is_capture_file, is_stream_source, StreamFeeder
+from .utils import pcap_format, load_pcap_index, pcap_windows, EVICTION_POLICIES
+from .utils import valid_timeout_policy, TIMEOUT_POLICIES_MAX
+from .profiler import profile_stages, profiling_snapshot, PROFILE_SLOTS
 
 # Set fork as method to avoid issues on macos with spawn default value
 mp.set_start_method("fork")
@@ -48,10 +55,36 @@ class NFStreamer(object):
                  statistical_analysis=False,
                  splt_analysis=0,
                  n_meters=0,
-                 performance_report=0):
+                 performance_report=0,
+                 ip_anonymization_key=None,
+                 metrics_callback=None,
+                 metrics_address=None,
+                 profiling=0,
+                 replay_speed=0,
+                 dissected_protocols=None,
+                 service_cache_size=0,
+                 service_cache_verify=False,
+                 host_table_size=0,
+                 fanout_hash="symmetric",
+                 fanout_mode="hash",
+                 fanout_group_id=None,
+                 buffer_size=0,
+                 immediate_mode=False,
+                 poll_timeout=1000,
+                 capture_backend="pcap",
+                 time_window=None,
+                 parallel_chunks=False,
+                 memory_map=False,
+                 max_flows=0,
+                 memory_budget=0,
+                 eviction_policy="oldest_idle",
+                 scan_protection=False,
+                 tcp_linger=None,
+                 timeout_policies=None):
         NFStreamer.streamer_id += 1
         self._mode = 0
         self.source = source
+        self.replay_speed = replay_speed
         self.decode_tunnels = decode_tunnels
         self.bpf_filter = bpf_filter
         self.promiscuous_mode = promiscuous_mode
@@ -65,6 +98,32 @@ class NFStreamer(object):
         self.splt_analysis = splt_analysis
         self.n_meters = n_meters
         self.performance_report = performance_report
+        self.ip_anonymization_key = ip_anonymization_key
+        self.metrics_callback = metrics_callback
+        self.metrics_address = metrics_address
+        self.profiling = profiling
+        self.dissected_protocols = dissected_protocols
+        self.service_cache_size = service_cache_size
+        self.service_cache_verify = service_cache_verify
+        self.host_table_size = host_table_size
+        self.fanout_hash = fanout_hash
+        self.fanout_mode = fanout_mode
+        self.fanout_group_id = fanout_group_id
+        self.buffer_size = buffer_size
+        self.immediate_mode = immediate_mode
+        self.poll_timeout = poll_timeout
+        self.capture_backend = capture_backend
+        self.time_window = time_window
+        self.parallel_chunks = parallel_chunks
+        self.memory_map = memory_map
+        self.max_flows = max_flows
+        self.memory_budget = memory_budget
+        self.eviction_policy = eviction_policy
+        self.scan_protection = scan_protection
+        self.tcp_linger = tcp_linger
+        self.timeout_policies = timeout_policies
+        self._performances, self._channel, self._flows_count = [], None, None  # Running workflow metrics sources.
+        self._profiles = []
 
     @property
     def source(self):
@@ -72,19 +131,54 @@ class NFStreamer(object):
 
     @source.setter
     def source(self, value):
+        available_interfaces = net_if_addrs().keys()
+        if isinstance(value, (list, tuple)):  # Several interfaces metered as a single source.
+            if len(value) == 0 or len(set(value)) != len(value) or \
+                    not all([isinstance(name, str) and name in available_interfaces for name in value]):
+                raise ValueError("Please specify a list of distinct valid network interfaces names as source.")
+            if getattr(self, "_replay_speed", 0) > 0:
+                raise ValueError("replay_speed is available only for pcap file source.")
+            self._mode = 1
+            self._stream = False
+            self._source = tuple(value) if len(value) > 1 else value[0]
+            return
         try:
             value = str(os.fspath(value))
         except TypeError:
             raise ValueError("Please specify a pcap file path or a valid network interface name as source.")
-        available_interfaces = net_if_addrs().keys()
+        self._stream = False
         if value in available_interfaces:
+            if getattr(self, "_replay_speed", 0) > 0:
+                raise ValueError("replay_speed is available only for pcap file source.")
             self._mode = 1
-        elif ".pcap" in value[-5:] and isfile(value):
-            self._mode = 0
+        elif is_stream_source(value):  # stdin ("-"), FIFO or compressed capture file, decompressed on the fly.
+            if value.endswith(".zst") and find_spec("zstandard") is None:
+                raise ValueError("zstandard package is required for .zst compressed source.")
+            self._mode = 2 if getattr(self, "_replay_speed", 0) > 0 else 0
+            self._stream = True
+        elif is_capture_file(value, False) and isfile(value):
+            self._mode = 2 if getattr(self, "_replay_speed", 0) > 0 else 0  # Offline or real-time replay.
         else:
             raise ValueError("Please specify a pcap file path or a valid network interface name as source.")
         self._source = value
 
+    @property
+    def replay_speed(self):
+        return self._replay_speed
+
+    @replay_speed.setter
+    def replay_speed(self, value):
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+            raise ValueError("Please specify a valid replay_speed parameter (>0 for replaying pcap file at recorded "
+                             "pace multiplied by value or 0 to disable).")
+        if value > 0:
+            if self._mode == 1:
+                raise ValueError("replay_speed is available only for pcap file source.")
+            self._mode = 2
+        elif self._mode == 2:
+            self._mode = 0
+        self._replay_speed = value
+
     @property
     def decode_tunnels(self):
         return self._decode_tunnels
@@ -254,23 +348,335 @@ class NFStreamer(object):
                              " or 0 to disaable). [Available only for Live capture]")
         self._performance_report = value
 
+    @property
+    def ip_anonymization_key(self):
+        return self._ip_anonymization_key
+
+    @ip_anonymization_key.setter
+    def ip_anonymization_key(self, value):
+        if value is not None and (not isinstance(value, bytes) or len(value) != 32):
+            raise ValueError("Please specify a valid ip_anonymization_key parameter (32 bytes key or None to "
+                             "disable).")
+        self._ip_anonymization_key = value
+
+    @property
+    def metrics_callback(self):
+        return self._metrics_callback
+
+    @metrics_callback.setter
+    def metrics_callback(self, value):
+        if value is not None and not callable(value):
+            raise ValueError("Please specify a valid metrics_callback parameter (callable taking metrics snapshot as "
+                             "argument or None to disable).")
+        self._metrics_callback = value
+
+    @property
+    def metrics_address(self):
+        return self._metrics_address
+
+    @metrics_address.setter
+    def metrics_address(self, value):
+        if value is not None:
+            validate_metrics_address(value)
+        self._metrics_address = value
+
+    @property
+    def profiling(self):
+        return self._profiling
+
+    @profiling.setter
+    def profiling(self, value):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError("Please specify a valid profiling parameter (>=1 for profiling one packet out of value "
+                             "or 0 to disable).")
+        self._profiling = value
+
+    @property
+    def dissected_protocols(self):
+        return self._dissected_protocols
+
+    @dissected_protocols.setter
+    def dissected_protocols(self, value):
+        if value is not None:
+            if not isinstance(value, (list, tuple)) or len(value) == 0 or \
+                    not all([isinstance(name, str) and len(name.lstrip("-")) > 0 for name in value]):
+                raise ValueError("Please specify a valid dissected_protocols parameter (list of nDPI protocols or "
+                                 "categories names to enable, names prefixed by - to disable).")
+            if self.n_dissections > 0:
+                validate_dissected_protocols(value)
+            value = tuple(value)
+        self._dissected_protocols = value
+
+    @property
+    def service_cache_size(self):
+        return self._service_cache_size
+
+    @service_cache_size.setter
+    def service_cache_size(self, value):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0 or value > 2**32 - 1:
+            raise ValueError("Please specify a valid service_cache_size parameter (number of cached services or 0 to "
+                             "disable).")
+        self._service_cache_size = value
+
+    @property
+    def service_cache_verify(self):
+        return self._service_cache_verify
+
+    @service_cache_verify.setter
+    def service_cache_verify(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid service_cache_verify parameter (possible values: True, False).")
+        self._service_cache_verify = value
+
+    @property
+    def host_table_size(self):
+        return self._host_table_size
+
+    @host_table_size.setter
+    def host_table_size(self, value):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0 or value > 2**32 - 1:
+            raise ValueError("Please specify a valid host_table_size parameter (number of shared hosts or 0 to "
+                             "disable).")
+        self._host_table_size = value
+
+    @property
+    def fanout_hash(self):
+        return self._fanout_hash
+
+    @fanout_hash.setter
+    def fanout_hash(self, value):
+        if value not in FANOUT_HASHES:
+            raise ValueError("Please specify a valid fanout_hash parameter (possible values: {}).".format(
+                ", ".join(FANOUT_HASHES)))
+        self._fanout_hash = value
+
+    @property
+    def fanout_mode(self):
+        return self._fanout_mode
+
+    @fanout_mode.setter
+    def fanout_mode(self, value):
+        if value not in FANOUT_MODES:
+            raise ValueError("Please specify a valid fanout_mode parameter (possible values: {}).".format(
+                ", ".join(FANOUT_MODES)))
+        self._fanout_mode = value
+
+    @property
+    def fanout_group_id(self):
+        return self._fanout_group_id
+
+    @fanout_group_id.setter
+    def fanout_group_id(self, value):
+        # None: groups ids are allocated by kernel, so that streamers on the same host never join each other groups.
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0 or value > 65535):
+            raise ValueError("Please specify a valid fanout_group_id parameter (possible values: [0,...,65535] or None "
+                             "for a streamer unique group).")
+        self._fanout_group_id = value
+
+    @property
+    def buffer_size(self):
+        return self._buffer_size
+
+    @buffer_size.setter
+    def buffer_size(self, value):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0 or value > 2**31 - 1:
+            raise ValueError("Please specify a valid buffer_size parameter (kernel buffer size in bytes or 0 for "
+                             "default).")
+        self._buffer_size = value
+
+    @property
+    def immediate_mode(self):
+        return self._immediate_mode
+
+    @immediate_mode.setter
+    def immediate_mode(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid immediate_mode parameter (possible values: True, False).")
+        self._immediate_mode = value
+
+    @property
+    def poll_timeout(self):
+        return self._poll_timeout
+
+    @poll_timeout.setter
+    def poll_timeout(self, value):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1 or value > 2**31 - 1:
+            raise ValueError("Please specify a valid poll_timeout parameter (capture buffer timeout in ms, >= 1).")
+        self._poll_timeout = value
+
+    @property
+    def capture_backend(self):
+        return self._capture_backend
+
+    @capture_backend.setter
+    def capture_backend(self, value):
+        if value not in CAPTURE_BACKENDS:
+            raise ValueError("Please specify a valid capture_backend parameter (possible values: {}).".format(
+                ", ".join(CAPTURE_BACKENDS)))
+        if value == "packet_mmap" and platform.system() != "Linux":
+            raise ValueError("packet_mmap capture_backend is available only on Linux.")
+        self._capture_backend = value
+
+    @property
+    def time_window(self):
+        return self._time_window
+
+    @time_window.setter
+    def time_window(self, value):
+        if value is not None:
+            if not isinstance(value, (list, tuple)) or len(value) != 2 or \
+                    not all([bound is None or (isinstance(bound, (int, float)) and not isinstance(bound, bool) and
+                                               bound >= 0) for bound in value]) or \
+                    (value[0] is not None and value[1] is not None and value[0] >= value[1]):
+                raise ValueError("Please specify a valid time_window parameter ((start, end) seconds since epoch, "
+                                 "None for an open bound).")
+            if self._mode == 1 or self._stream or pcap_format(self.source) is None:
+                raise ValueError("time_window is available only for pcap (not pcapng) file source.")
+            value = tuple(value)
+        self._time_window = value
+
+    @property
+    def parallel_chunks(self):
+        return self._parallel_chunks
+
+    @parallel_chunks.setter
+    def parallel_chunks(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid parallel_chunks parameter (possible values: True, False).")
+        if value and (self._mode != 0 or self._stream or pcap_format(self.source) is None):
+            raise ValueError("parallel_chunks is available only for pcap (not pcapng) file source without replay.")
+        self._parallel_chunks = value
+
+    @property
+    def memory_map(self):
+        return self._memory_map
+
+    @memory_map.setter
+    def memory_map(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid memory_map parameter (possible values: True, False).")
+        self._memory_map = value
+
+    @property
+    def max_flows(self):
+        return self._max_flows
+
+    @max_flows.setter
+    def max_flows(self, value):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError("Please specify a valid max_flows parameter (>= 0, flows per meter, 0 for unbounded).")
+        self._max_flows = value
+
+    @property
+    def memory_budget(self):
+        return self._memory_budget
+
+    @memory_budget.setter
+    def memory_budget(self, value):
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise ValueError("Please specify a valid memory_budget parameter (>= 0, flows bytes per meter, 0 for "
+                             "unbounded).")
+        self._memory_budget = value
+
+    @property
+    def eviction_policy(self):
+        return self._eviction_policy
+
+    @eviction_policy.setter
+    def eviction_policy(self, value):
+        if value not in EVICTION_POLICIES:
+            raise ValueError("Please specify a valid eviction_policy parameter (possible values: {}).".format(
+                ", ".join(EVICTION_POLICIES)))
+        self._eviction_policy = value
+
+    @property
+    def scan_protection(self):
+        return self._scan_protection
+
+    @scan_protection.setter
+    def scan_protection(self, value):
+        if not isinstance(value, bool):
+            raise ValueError("Please specify a valid scan_protection parameter (possible values: True, False).")
+        self._scan_protection = value
+
+    @property
+    def tcp_linger(self):
+        return self._tcp_linger
+
+    @tcp_linger.setter
+    def tcp_linger(self, value):
+        if value is not None and (not isinstance(value, int) or isinstance(value, bool) or value < 0 or
+                                  (value*1000) > 18446744073709551615):  # max uint64_t
+            raise ValueError("Please specify a valid tcp_linger parameter (positive integer in seconds or None to "
+                             "disable closed TCP flows expiration).")
+        self._tcp_linger = value
+
+    @property
+    def timeout_policies(self):
+        return self._timeout_policies
+
+    @timeout_policies.setter
+    def timeout_policies(self, value):
+        if value is not None:
+            if not isinstance(value, (list, tuple)) or len(value) == 0 or len(value) > TIMEOUT_POLICIES_MAX or \
+                    not all([valid_timeout_policy(policy) for policy in value]):
+                raise ValueError("Please specify a valid timeout_policies parameter (list of up to {} dicts matching "
+                                 "protocol, port and/or application with idle_timeout and/or active_timeout in "
+                                 "seconds).".format(TIMEOUT_POLICIES_MAX))
+            applications = [policy["application"] for policy in value if "application" in policy]
+            if applications:
+                if self.n_dissections == 0:
+                    raise ValueError("Please specify n_dissections > 0 for application timeout policies.")
+                validate_timeout_applications(applications)
+            value = tuple([dict(policy) for policy in value])
+        self._timeout_policies = value
+
+    def metrics(self):
+        """ Structured metrics snapshot of the current (or last) workflow """
+        snapshot = metrics_snapshot(self._performances, self._channel, self._flows_count)
+        if self.profiling > 0:
+            snapshot["profiling"] = profiling_snapshot(profile_stages(self.udps), self._profiles)
+        return snapshot
+
     def __iter__(self):
+        return self._workflow()
+
+    def _workflow(self, shards_path=None, anonymizer=None):
+        """ Streamer workflow: start meters and collect their flows (or shards descriptions on sharded export) """
         set_affinity(0) # we pin streamer to core 0 as it's the less intensive task and several services runs
                         # by default on this core.
         lock = mp.Lock()
         lock.acquire()
+        activations = mp.Value('i', 0)  # Meters activating captures in turn (several interfaces source).
+        # Kernel allocated fanout groups ids (one per interface), created by meter 0 and joined by following meters.
+        fanout_groups = mp.Array('i', [-1] * (len(self.source) if isinstance(self.source, tuple) else 1))
+        feeder = None
         meters = []
         performances = []
+        profiles = []
         n_terminated = 0
-        rt = None
+        rt, mt, ms = None, None, None
         channel = mp.Queue(maxsize=32767)  # Backpressure strategy.
         # We set it to (2^15-1) to cope with OSX maximum semaphore value.
         n_meters = self.n_meters
+        windows = [None] * n_meters
+        self._performances, self._channel, self._flows_count = performances, channel, None
+        self._profiles = profiles
         try:
+            if self.metrics_address is not None:  # Prometheus scraping endpoint
+                ms = MetricsServer(validate_metrics_address(self.metrics_address), self.metrics)
+            if self._stream:  # Streamed source is read once and fed to each meter.
+                feeder = StreamFeeder(self.source, n_meters)
+            if self.time_window is not None or self.parallel_chunks:  # Indexed pcap: meters seek their window.
+                start, end = self.time_window if self.time_window is not None else (None, None)
+                windows = pcap_windows(load_pcap_index(self.source), n_meters, start, end, self.parallel_chunks,
+                                       max(self.idle_timeout, self.active_timeout) * 1000)
             for i in range(n_meters):
-                performances.append([mp.Value('I', 0), mp.Value('I', 0), mp.Value('I', 0)])
+                performances.append(mp.Array('Q', len(METER_METRICS)))
+                profiles.append(mp.Array('Q', len(profile_stages(self.udps)) * PROFILE_SLOTS) if self.profiling > 0
+                                else None)
                 meters.append(mp.Process(target=meter_workflow,
-                                         args=(self.source,
+                                         args=(feeder.paths[i] if feeder is not None else self.source,
                                                self.snapshot_length,
                                                self.decode_tunnels,
                                                self.bpf_filter,
@@ -287,15 +693,47 @@ class NFStreamer(object):
                                                self.splt_analysis,
                                                channel,
                                                performances[i],
-                                               lock,)))
+                                               lock,
+                                               activations,
+                                               shards_path,
+                                               anonymizer,
+                                               self.ip_anonymization_key,
+                                               self.profiling,
+                                               profiles[i],
+                                               float(self.replay_speed),
+                                               self.dissected_protocols,
+                                               self.service_cache_size,
+                                               self.service_cache_verify,
+                                               self.host_table_size,
+                                               self.fanout_hash,
+                                               self.fanout_mode,
+                                               self.fanout_group_id,
+                                               fanout_groups,
+                                               self.buffer_size,
+                                               self.immediate_mode,
+                                               self.poll_timeout,
+                                               self.capture_backend,
+                                               windows[i],
+                                               self.memory_map,
+                                               self.max_flows,
+                                               self.memory_budget,
+                                               self.eviction_policy,
+                                               self.scan_protection,
+                                               self.tcp_linger*1000 if self.tcp_linger is not None else None,
+                                               self.timeout_policies,)))
                 meters[i].daemon = True  # demonize meter
                 meters[i].start()
+            if feeder is not None:
+                feeder.start(meters)
             idx_generator = mp.Value('i', 0)
-            if self._mode == 1 and self.performance_report > 0:
-                if platform.system() == "Linux":
+            self._flows_count = idx_generator
+            if self._mode != 0 and self.performance_report > 0:  # Live capture or real-time replay.
+                if platform.system() == "Linux" and self._mode == 1:
                     rt = RepeatedTimer(self.performance_report, update_performances, performances, True, idx_generator)
                 else:
                     rt = RepeatedTimer(self.performance_report, update_performances, performances, False, idx_generator)
+            if self.metrics_callback is not None and self.performance_report > 0:
+                mt = RepeatedTimer(self.performance_report, update_metrics, self.metrics_callback, self.metrics)
             while True:
                 try:
                     recv = channel.get()
@@ -304,8 +742,9 @@ class NFStreamer(object):
                         if n_terminated == n_meters:
                             break  # We finish up when all metering jobs are terminated
                     else:
-                        recv.id = idx_generator.value  # Unify ID
-                        idx_generator.value = idx_generator.value + 1
+                        if shards_path is None:
+                            recv.id = idx_generator.value  # Unify ID
+                            idx_generator.value = idx_generator.value + 1
                         yield recv
                 except KeyboardInterrupt:
                     for i in range(n_meters):  # We break workflow loop
@@ -313,51 +752,81 @@ class NFStreamer(object):
                     break
             for i in range(n_meters):
                 meters[i].join()  # Join metring jobs
-            if self._mode == 1 and self.performance_report > 0:
+            if self._mode != 0 and self.performance_report > 0:
                 rt.stop()
+            if mt is not None:
+                mt.stop()
+            if ms is not None:
+                ms.stop()
+            if feeder is not None:
+                feeder.stop()
+            if self.metrics_callback is not None:  # Final snapshot
+                update_metrics(self.metrics_callback, self.metrics)
+            self._channel = None
             channel.close()  # We close the queue
             channel.join_thread()  # and we join its thread
         except ValueError as observer_error: # job initiation failed due to some bad observer parameters.
             raise ValueError(observer_error)
 
-    def to_csv(self, path=None, columns_to_anonymize=(), flows_per_file=0):
+    def to_csv(self, path=None, columns_to_anonymize=(), flows_per_file=0, shard_per_meter=False,
+               anonymization_digest_size=64, anonymization_prefix_preserving=False):
         validate_flows_per_file(flows_per_file)
+        validate_shard_per_meter(shard_per_meter, flows_per_file)
         chunked, chunk_idx = True, -1
         if flows_per_file == 0:
             chunked = False
         output_path = create_csv_file_path(path, self.source)
         total_flows, chunk_flows = 0, 0
-        anon = NFAnonymizer(cols_names=columns_to_anonymize)
+        anon = NFAnonymizer(cols_names=columns_to_anonymize, digest_size=anonymization_digest_size,
+                            prefix_preserving=anonymization_prefix_preserving)
+        if shard_per_meter:
+            return self._to_csv_shards(output_path, anon)
         f = None
+        batch = []
         for flow in self:
             try:
                 if total_flows == 0 or (chunked and (chunk_flows > flows_per_file)):  # header creation
                     if f is not None:
+                        write_batch(f, anon, batch)  # Pending flows belong to previous chunk.
+                        batch = []
                         f.close()
                     chunk_flows = 1
                     chunk_idx += 1
                     f = open_file(output_path, chunked, chunk_idx)
                     header = ','.join([str(i) for i in flow.keys()]) + "\n"
                     f.write(header.encode('utf-8'))
-                values = anon.process(flow)
-                csv_converter(values)
-                to_export = ','.join([str(i) for i in values]) + "\n"
-                f.write(to_export.encode('utf-8'))
+                batch.append(flow)
+                if len(batch) == EXPORT_BATCH:
+                    write_batch(f, anon, batch)
+                    batch = []
                 total_flows = total_flows + 1
                 chunk_flows += 1
             except KeyboardInterrupt:
                 pass
         if f is not None:
             if not f.closed:
+                write_batch(f, anon, batch)
                 f.close()
         return total_flows
 
-    def to_pandas(self, columns_to_anonymize=()):
+    def _to_csv_shards(self, output_path, anon):
+        """ Sharded export: each meter writes its own CSV shard, streamer only writes the manifest """
+        shards = []
+        try:
+            for shard in self._workflow(shards_path=output_path, anonymizer=anon):
+                shards.append(shard)
+        except KeyboardInterrupt:
+            pass
+        return write_manifest(create_manifest_file_path(output_path), self.source, shards)
+
+    def to_pandas(self, columns_to_anonymize=(), anonymization_digest_size=64, anonymization_prefix_preserving=False):
         """ streamer to pandas function """
         temp_file_path = "nfstream-{pid}-{iid}-{ts}?csv".format(pid=os.getpid(),
                                                                 iid=NFStreamer.streamer_id,
                                                                 ts=tm.time())
-        total_flows = self.to_csv(path=temp_file_path, columns_to_anonymize=columns_to_anonymize, flows_per_file=0)
+        total_flows = self.to_csv(path=temp_file_path, columns_to_anonymize=columns_to_anonymize, flows_per_file=0,
+                                  anonymization_digest_size=anonymization_digest_size,
+                                  anonymization_prefix_preserving=anonymization_prefix_preserving)
         if total_flows > 0: # If there is flows, return Dataframe else return None.
             df = pd.read_csv(temp_file_path)
             if total_flows != df.shape[0]:
@@ -13,10 +13,26 @@ If not, see <http://www.gnu.org/licenses/>.
 ------------------------------------------------------------------------------------------------------------------------
 """
 
+import bz2
+import errno
+import gzip
 import json
+import lzma
+import os
 import platform
 import psutil
-from threading import Timer
+import shutil
+import socket
+import stat
+import struct
+import sys
+import tempfile
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from threading import Thread, Timer
+from time import monotonic, sleep
+from .profiler import profiling_exposition
 
 
 def validate_flows_per_file(n):
@@ -25,13 +41,48 @@ def validate_flows_per_file(n):
         raise ValueError("Please specify a valid flows_per_file parameter (>= 0).")
 
 
+def validate_shard_per_meter(shard_per_meter, flows_per_file):
+    """ simple parameter validator """
+    if not isinstance(shard_per_meter, bool):
+        raise ValueError("Please specify a valid shard_per_meter parameter (possible values: True, False).")
+    if shard_per_meter and flows_per_file > 0:
+        raise ValueError("flows_per_file is not supported on sharded export (shard_per_meter=True).")
+
+
+def validate_metrics_address(address):
+    """ metrics endpoint address validator: "host:port" -> (host, port) """
+    try:
+        host, port = address.rsplit(":", 1)
+        port = int(port)
+        if port < 0 or port > 65535:
+            raise ValueError
+    except (AttributeError, ValueError):
+        raise ValueError("Please specify a valid metrics_address parameter (\"host:port\" or None to disable).")
+    return host.strip("[]"), port
+
+
 def create_csv_file_path(path, source):
     """ file path creator """
     if path is None:
+        if isinstance(source, tuple):  # Several interfaces source.
+            return "+".join(source) + '.csv'
+        if source == "-":
+            return 'stdin.csv'
         return str(source) + '.csv'
     return path
 
 
+def create_shard_file_path(path, shard_idx):
+    """ shard file path creator: flows.csv -> flows.{shard_idx}.csv """
+    root, ext = os.path.splitext(path)
+    return "{}.{}{}".format(root, shard_idx, ext)
+
+
+def create_manifest_file_path(path):
+    """ manifest file path creator: flows.csv -> flows.manifest.json """
+    return os.path.splitext(path)[0] + ".manifest.json"
+
+
 def csv_converter(values):
     """ convert non numeric values to using their __str__ method and ensure quoting """
     for idx, value in enumerate(values):
@@ -44,6 +95,15 @@ def csv_converter(values):
                 values[idx] = "\"" + values[idx] + "\""
 
 
+def write_batch(f, anonymizer, flows):
+    """ Anonymize (column wise) and write a batch of flows as CSV rows """
+    if len(flows) > 0:
+        rows = anonymizer.process_batch(flows)
+        for values in rows:
+            csv_converter(values)
+        f.write(''.join([','.join([str(i) for i in values]) + "\n" for values in rows]).encode('utf-8'))
+
+
 def open_file(path, chunked, chunk_idx):
     """ File opener taking ckunk mode into consideration"""
     if not chunked:
@@ -51,6 +111,179 @@ def open_file(path, chunked, chunk_idx):
     return open(path.replace("csv", "{}.csv".format(chunk_idx)), 'wb')
 
 
+def write_manifest(path, source, shards):
+    """ Write shards manifest (schema and per meter shard description) and return total exported flows """
+    shards = sorted([shard for shard in shards if shard["flows"] > 0], key=lambda shard: shard["meter"])
+    columns = shards[0]["columns"] if len(shards) > 0 else []
+    total_flows = sum([shard["flows"] for shard in shards])
+    manifest = {"source": source,
+                "format": "csv",
+                "columns": columns,
+                "flows": total_flows,
+                "shards": [{"meter": shard["meter"], "path": shard["path"], "flows": shard["flows"]}
+                           for shard in shards]}
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return total_flows
+
+
+# Exported flows are anonymized and written by batches.
+EXPORT_BATCH = 1024
+
+
+class ShardWriter(object):
+    """
+        Meter side CSV writer used on sharded export.
+        It replaces the streamer channel within a meter: flows are written to the meter own shard instead of being
+        pickled to the streamer. Termination is forwarded to the real channel with a shard description.
+    """
+    def __init__(self, path, shard_idx, anonymizer, channel):
+        self.path = create_shard_file_path(path, shard_idx)
+        self.shard_idx = shard_idx
+        self.anonymizer = anonymizer
+        self.channel = channel
+        self.columns = []
+        self.flows = 0
+        self._f = None
+        self._batch = []
+
+    def put(self, flow):
+        if flow is None:  # meter termination
+            if self._f is not None:
+                write_batch(self._f, self.anonymizer, self._batch)
+                self._batch = []
+                self._f.close()
+            self.channel.put({"meter": self.shard_idx,
+                              "path": self.path,
+                              "flows": self.flows,
+                              "columns": self.columns})
+            self.channel.put(None)
+        else:
+            if self._f is None:  # first flow, shard and header creation
+                self._f = open(self.path, 'wb')
+                self.columns = flow.keys()
+                self._f.write((','.join([str(i) for i in self.columns]) + "\n").encode('utf-8'))
+            flow.id = self.flows  # shard local ID
+            self._batch.append(flow)
+            if len(self._batch) == EXPORT_BATCH:
+                write_batch(self._f, self.anonymizer, self._batch)
+                self._batch = []
+            self.flows += 1
+
+
+# Per meter shared metrics layout (kernel drops, processed and ignored packets first for performance report).
+METER_METRICS = ("packets_dropped_filtered_by_kernel",
+                 "packets_processed",
+                 "packets_ignored",
+                 "active_flows",
+                 "flows_created",
+                 "flows_expired_idle",
+                 "flows_expired_active",
+                 "flows_expired_closed",
+                 "flows_expired_custom",
+                 "flows_expired_end_of_capture",
+                 "flows_expired_evicted",
+                 "flows_staged",
+                 "flows_promoted",
+                 "flows_summarized",
+                 "summary_flows",
+                 "staged_flows",
+                 "idle_scan_backlog",
+                 "parse_errors_truncated",
+                 "parse_errors_unsupported_datalink",
+                 "parse_errors_not_ip",
+                 "parse_errors_fragmented",
+                 "parse_errors_malformed",
+                 "plugins_time_us",
+                 "active_flows_peak",
+                 "memory_c_flow_bytes",
+                 "memory_ndpi_flow_bytes",
+                 "memory_ndpi_ids_bytes",
+                 "memory_splt_bytes",
+                 "memory_python_flow_bytes",
+                 "memory_cache_entry_bytes",
+                 "memory_active_flows_bytes",
+                 "memory_peak_bytes",
+                 "pool_flow_objects",
+                 "pool_flow_slabs",
+                 "pool_ndpi_id_objects",
+                 "pool_ndpi_id_slabs",
+                 "pool_splt_objects",
+                 "pool_splt_slabs",
+                 "pool_slabs_allocated",
+                 "pool_slabs_released",
+                 "service_cache_hits",
+                 "service_cache_misses",
+                 "service_cache_verified",
+                 "service_cache_mismatches",
+                 "host_table_hosts",
+                 "host_table_hits",
+                 "host_table_misses",
+                 "host_table_evictions")
+METRIC_INDEX = {name: idx for idx, name in enumerate(METER_METRICS)}
+# Engine parse_error codes (1 to 5) are mapped to consecutive parse errors metrics.
+PARSE_ERROR_OFFSET = METRIC_INDEX["parse_errors_truncated"] - 1
+# Bytes per active flow by component (engine accounted components first, in engine accounting order).
+MEMORY_COMPONENTS = ("memory_c_flow_bytes",
+                     "memory_ndpi_flow_bytes",
+                     "memory_ndpi_ids_bytes",
+                     "memory_splt_bytes",
+                     "memory_python_flow_bytes",
+                     "memory_cache_entry_bytes")
+# Engine object pools (in engine order), each reporting objects in use and mapped slabs.
+POOLS = ("flow", "ndpi_id", "splt")
+# Software fanout hashes (in engine order): symmetric mixed hash over full addresses or legacy 6-tuple sum.
+FANOUT_HASHES = ("symmetric", "legacy")
+# Linux kernel fanout modes (index is PACKET_FANOUT_* value).
+FANOUT_MODES = ("hash", "load_balance", "cpu", "rollover", "random", "queue_mapping")
+# Live capture backends (in engine order): libpcap or direct TPACKET_V3 memory mapped ring (Linux).
+CAPTURE_BACKENDS = ("pcap", "packet_mmap")
+
+EVICTION_POLICIES = ("oldest_idle", "smallest", "random")
+# Timeout policies match keys and timeouts keys (seconds), up to engine timeout policies table size.
+TIMEOUT_POLICY_MATCHES = ("protocol", "port", "application")
+TIMEOUT_POLICY_TIMEOUTS = ("idle_timeout", "active_timeout")
+TIMEOUT_POLICIES_MAX = 64
+
+
+def valid_timeout_policy(policy):
+    """ Check a timeout policy: protocol, port and/or application match with idle and/or active timeout """
+    def integer(value, low, high):
+        return isinstance(value, int) and not isinstance(value, bool) and low <= value <= high
+    if not isinstance(policy, dict) or not set(policy).issubset(TIMEOUT_POLICY_MATCHES + TIMEOUT_POLICY_TIMEOUTS):
+        return False
+    if not any([key in policy for key in TIMEOUT_POLICY_MATCHES]) or \
+            not any([key in policy for key in TIMEOUT_POLICY_TIMEOUTS]):
+        return False
+    if "protocol" in policy and not integer(policy["protocol"], 1, 255):
+        return False
+    if "port" in policy and not integer(policy["port"], 1, 65535):
+        return False
+    if "application" in policy and not (isinstance(policy["application"], str) and len(policy["application"]) > 0):
+        return False
+    return all([integer(policy[key], 0, 18446744073709551) for key in TIMEOUT_POLICY_TIMEOUTS if key in policy])
+
+
+def processing_imbalance(processed):
+    """ Most loaded meter processed packets over mean processed packets (1.0 means balanced) """
+    return max(processed) * len(processed) / sum(processed) if sum(processed) > 0 else 1.0
+
+
+def metrics_snapshot(trackers, channel, flows_count):
+    """ Build structured metrics snapshot from meters shared metrics """
+    try:
+        queue_depth = channel.qsize() if channel is not None else 0
+    except NotImplementedError:  # macOS: sem_getvalue() not implemented.
+        queue_depth = None
+    meters = []
+    for tracker in trackers:
+        meters.append(dict(zip(METER_METRICS, tracker[:])))
+    return {"flows_expired": flows_count.value if flows_count is not None else 0,
+            "queue_depth": queue_depth,
+            "processing_imbalance": processing_imbalance([meter["packets_processed"] for meter in meters]),
+            "meters": meters}
+
+
 def update_performances(performances, is_linux, flows_count):
     """ Update performance report and check platform for consistency """
     drops = 0
@@ -59,18 +292,103 @@ def update_performances(performances, is_linux, flows_count):
     load = []
     for meter in performances:
         if is_linux:
-            drops += meter[0].value
-            ignored += meter[2].value
+            drops += meter[0]
+            ignored += meter[2]
         else:
-            drops = max(meter[0].value, drops)
-            ignored = max(meter[2].value, ignored)
-        processed += meter[1].value
-        load.append(meter[1].value)
+            drops = max(meter[0], drops)
+            ignored = max(meter[2], ignored)
+        processed += meter[1]
+        load.append(meter[1])
     print(json.dumps({"flows_expired": flows_count.value,
                       "packets_processed": processed,
                       "packets_ignored": ignored,
                       "packets_dropped_filtered_by_kernel": drops,
-                      "meters_packets_processing_balance": load}))
+                      "meters_packets_processing_balance": load,
+                      "meters_packets_processing_imbalance": processing_imbalance(load)}))
+
+
+def update_metrics(callback, snapshot):
+    """ Push a metrics snapshot to user callback """
+    callback(snapshot())
+
+
+# Gauges (all other meters metrics are cumulative counters).
+METER_GAUGES = ("active_flows", "staged_flows", "idle_scan_backlog", "active_flows_peak", "memory_active_flows_bytes",
+                "memory_peak_bytes", "host_table_hosts") + MEMORY_COMPONENTS + \
+    tuple(["pool_{}_{}".format(pool, stat) for pool in POOLS for stat in ("objects", "slabs")])
+
+
+def prometheus_exposition(snapshot):
+    """ Render a metrics snapshot in Prometheus text exposition format (aggregated and per meter families) """
+    lines = []
+
+    def family(name, kind, samples):
+        lines.append("# TYPE {} {}".format(name, kind))
+        for labels, value in samples:
+            lines.append("{}{} {}".format(name, labels, value))
+
+    meters = snapshot["meters"]
+    family("nfstream_flows_expired_total", "counter", [("", snapshot["flows_expired"])])
+    if snapshot["queue_depth"] is not None:
+        family("nfstream_queue_depth", "gauge", [("", snapshot["queue_depth"])])
+    family("nfstream_meters", "gauge", [("", len(meters))])
+    for metric in METER_METRICS:
+        if metric in METER_GAUGES:
+            kind, suffix = "gauge", ""
+        else:
+            kind, suffix = "counter", "_total"
+        family("nfstream_{}{}".format(metric, suffix), kind, [("", sum([meter[metric] for meter in meters]))])
+        family("nfstream_meter_{}{}".format(metric, suffix), kind,
+               [('{{meter="{}"}}'.format(idx), meter[metric]) for idx, meter in enumerate(meters)])
+    family("nfstream_meters_processing_imbalance", "gauge", [("", snapshot["processing_imbalance"])])
+    if "profiling" in snapshot:
+        lines.extend(profiling_exposition(snapshot["profiling"]))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Prometheus scraping handler: serve /metrics only """
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = prometheus_exposition(self.server.snapshot()).encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # Scrapes must not pollute streamer output.
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """ Threading HTTP server (http.server.ThreadingHTTPServer is not available on Python 3.6) """
+    daemon_threads = True
+
+
+class ThreadingHTTPServerV6(ThreadingHTTPServer):
+    address_family = socket.AF_INET6
+
+
+class MetricsServer(object):
+    """ Metrics endpoint: stdlib HTTP server running within a daemon thread """
+    def __init__(self, address, snapshot):
+        server_class = ThreadingHTTPServerV6 if ":" in address[0] else ThreadingHTTPServer
+        try:
+            self._server = server_class(address, MetricsHandler)
+        except OSError as bind_error:
+            raise ValueError("Unable to start metrics endpoint on {}:{} ({}).".format(address[0], address[1],
+                                                                                      bind_error))
+        self._server.snapshot = snapshot
+        self.address = self._server.server_address
+        self._thread = Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
 
 
 class RepeatedTimer(object):
@@ -100,6 +418,231 @@ class RepeatedTimer(object):
         self.is_running = False
 
 
+# Capture files extensions and streamed compressions (decompressed on the fly while fed to meters).
+CAPTURE_EXTENSIONS = (".pcap", ".pcapng")
+STREAM_COMPRESSIONS = (".gz", ".bz2", ".xz", ".zst")
+
+
+def is_capture_file(path, compressed):
+    """ Check capture file extension (with a compression extension when compressed is set) """
+    root, ext = os.path.splitext(path)
+    if compressed:
+        if ext not in STREAM_COMPRESSIONS:
+            return False
+        ext = os.path.splitext(root)[1]
+    return ext in CAPTURE_EXTENSIONS
+
+
+def is_stream_source(path):
+    """ Streamed sources (stdin, FIFOs and compressed capture files) cannot be read by each meter on its own """
+    if path == "-":
+        return True
+    try:
+        if stat.S_ISFIFO(os.stat(path).st_mode):
+            return True
+    except OSError:
+        return False
+    return os.path.isfile(path) and is_capture_file(path, True)
+
+
+def open_stream(path):
+    """ Open a streamed source as a binary file object (decompressed on the fly) """
+    if path == "-":
+        return sys.stdin.buffer
+    ext = os.path.splitext(path)[1]
+    if ext == ".gz":
+        return gzip.open(path, "rb")
+    if ext == ".bz2":
+        return bz2.open(path, "rb")
+    if ext == ".xz":
+        return lzma.open(path, "rb")
+    if ext == ".zst":
+        import zstandard  # Optional dependency, checked on source validation.
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True)
+    return open(path, "rb")
+
+
+# Meters FIFOs are opened as soon as their meter opens them, polled until meter terminates or timeout (s).
+FEED_OPEN_POLL = 0.01
+FEED_OPEN_TIMEOUT = 60
+
+
+def release_fifo(path):
+    """ Wake up a reader waiting for a FIFO writer: it reads an empty stream """
+    try:
+        os.close(os.open(path, os.O_RDWR | os.O_NONBLOCK))
+    except OSError:
+        pass
+
+
+class StreamFeeder(object):
+    """ Feed a streamed source to each meter through its own FIFO (meters perform offline fanout on full stream) """
+    def __init__(self, source, n_meters, chunk_size=1048576):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._directory = tempfile.mkdtemp(prefix="nfstream-")
+        self._thread = None
+        self.paths = []
+        for idx in range(n_meters):
+            path = os.path.join(self._directory, "meter{}.pcap".format(idx))
+            os.mkfifo(path)
+            self.paths.append(path)
+
+    def start(self, meters):
+        """ Start feeding meters processes (meters[idx] reads paths[idx]) """
+        self._thread = Thread(target=self._feed, args=(meters,), daemon=True)
+        self._thread.start()
+
+    def _open_outputs(self, meters, outputs, opened):
+        """ Open meters FIFOs without blocking, leaving out the ones of meters terminated before opening them """
+        pending = list(range(len(self.paths)))
+        deadline = monotonic() + FEED_OPEN_TIMEOUT
+        while len(pending) > 0 and monotonic() < deadline:
+            for idx in list(pending):
+                try:
+                    fd = os.open(self.paths[idx], os.O_WRONLY | os.O_NONBLOCK)
+                except OSError as error:
+                    if error.errno != errno.ENXIO or not meters[idx].is_alive():  # ENXIO: no reader yet.
+                        pending.remove(idx)
+                    continue
+                os.set_blocking(fd, True)  # Writes then wait for meter (backpressure).
+                outputs.append(os.fdopen(fd, "wb"))
+                opened.add(idx)
+                pending.remove(idx)
+            if len(pending) > 0:
+                sleep(FEED_OPEN_POLL)
+
+    def _feed(self, meters):
+        stream, outputs, opened = None, [], set()
+        try:
+            stream = open_stream(self._source)
+            self._open_outputs(meters, outputs, opened)
+            while len(outputs) > 0:
+                chunk = stream.read(self._chunk_size)
+                if not chunk:
+                    break
+                for output in list(outputs):
+                    try:
+                        output.write(chunk)
+                    except (BrokenPipeError, ValueError):  # Meter terminated.
+                        outputs.remove(output)
+        finally:
+            for output in outputs:
+                try:
+                    output.close()
+                except BrokenPipeError:
+                    pass
+            for idx, path in enumerate(self.paths):  # Meters still waiting for their FIFO get an empty stream.
+                if idx not in opened:
+                    release_fifo(path)
+            if stream is not None and stream is not sys.stdin.buffer:
+                stream.close()
+
+    def stop(self):
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+        shutil.rmtree(self._directory, ignore_errors=True)
+
+
+# Pcap offset index: an entry (packet number, record offset, timestamp, previous packets timestamps ceiling) each
+# interval packets, stored as a JSON sidecar of the capture file. Classic pcap magics give byte order and timestamp
+# fraction units per millisecond.
+PCAP_INDEX_VERSION = 1
+PCAP_INDEX_INTERVAL = 10000
+PCAP_INDEX_EXTENSION = ".nfidx"
+PCAP_MAGICS = {b"\xd4\xc3\xb2\xa1": ("<", 1000), b"\xa1\xb2\xc3\xd4": (">", 1000),
+               b"\x4d\x3c\xb2\xa1": ("<", 1000000), b"\xa1\xb2\x3c\x4d": (">", 1000000)}
+PCAP_HEADER_SIZE, PCAP_RECORD_SIZE = 24, 16
+WINDOW_END = 2 ** 64 - 1  # Unbounded time window end (ms).
+
+
+def pcap_format(path):
+    """ Classic pcap byte order and timestamp fraction units per millisecond, None for other formats (pcapng) """
+    try:
+        with open(path, "rb") as f:
+            return PCAP_MAGICS.get(f.read(4))
+    except OSError:
+        return None
+
+
+def build_pcap_index(path, interval=PCAP_INDEX_INTERVAL):
+    """ Build pcap offset index (packet number -> record offset -> timestamp each interval packets) and its sidecar """
+    if not isinstance(interval, int) or isinstance(interval, bool) or interval < 1:
+        raise ValueError("Please specify a valid pcap index interval (>= 1 packets).")
+    pcap = pcap_format(path)
+    if pcap is None:
+        raise ValueError("Pcap offset index is available only for pcap (not pcapng) files.")
+    record, fraction = struct.Struct(pcap[0] + "IIII"), pcap[1]
+    entries = []
+    packets, offset, ceiling = 0, PCAP_HEADER_SIZE, 0
+    with open(path, "rb") as f:
+        f.seek(PCAP_HEADER_SIZE)
+        while True:
+            header = f.read(PCAP_RECORD_SIZE)
+            if len(header) < PCAP_RECORD_SIZE:
+                break
+            ts_sec, ts_fraction, caplen, _ = record.unpack(header)
+            time = ts_sec * 1000 + ts_fraction // fraction
+            if packets % interval == 0:
+                entries.append([packets, offset, time, ceiling])
+            ceiling = max(ceiling, time)
+            offset += PCAP_RECORD_SIZE + caplen
+            f.seek(caplen, 1)  # Only records headers are read.
+            packets += 1
+    source = os.stat(path)
+    index = {"version": PCAP_INDEX_VERSION, "source_size": source.st_size, "source_mtime_ns": source.st_mtime_ns,
+             "interval": interval, "packets": packets, "entries": entries}
+    try:
+        with open(path + PCAP_INDEX_EXTENSION + ".tmp", "w") as f:
+            json.dump(index, f)
+        os.replace(path + PCAP_INDEX_EXTENSION + ".tmp", path + PCAP_INDEX_EXTENSION)
+    except OSError:  # Read only capture directory, index is used without sidecar.
+        pass
+    return index
+
+
+def load_pcap_index(path, interval=PCAP_INDEX_INTERVAL):
+    """ Load pcap offset index sidecar, built again when missing or stale (capture file modified) """
+    try:
+        with open(path + PCAP_INDEX_EXTENSION) as f:
+            index = json.load(f)
+        source = os.stat(path)
+        if index["version"] == PCAP_INDEX_VERSION and index["source_size"] == source.st_size and \
+                index["source_mtime_ns"] == source.st_mtime_ns:
+            return index
+    except (OSError, ValueError, KeyError, TypeError):
+        pass
+    return build_pcap_index(path, interval)
+
+
+def pcap_index_seek(ceilings, time):
+    """ Last index entry from which reading skips no packet timestamped at or after time (ms) """
+    return max(0, bisect_left(ceilings, time) - 1)
+
+
+def pcap_windows(index, n_meters, start, end, chunked, lookback):
+    """
+        Meters windows (seek offset, start time, end time, chunk start offset, chunk end offset, next chunk seek offset)
+        over an indexed pcap. On parallel chunks, each meter also reads lookback (ms) before its chunk to learn flows
+        owned by previous one.
+    """
+    entries = index["entries"]
+    start, end = int(start * 1000) if start is not None else 0, int(end * 1000) if end is not None else WINDOW_END
+    if len(entries) == 0:  # No packets.
+        return [(PCAP_HEADER_SIZE, start, end, -1, -1, -1)] * n_meters
+    ceilings = [entry[3] for entry in entries]
+    first = pcap_index_seek(ceilings, start)
+    if not chunked:
+        return [(entries[first][1], start, end, -1, -1, -1)] * n_meters
+    last = min(len(entries), bisect_left(ceilings, end) + 1)  # Entries after last one start after time window.
+    bounds = [entries[first + (last - first) * idx // n_meters] for idx in range(n_meters)]
+    seeks = [entry[1] if idx == 0 else
+             entries[max(first, pcap_index_seek(ceilings, max(entry[2], entry[3]) - lookback))][1]
+             for idx, entry in enumerate(bounds)]
+    return [(seeks[idx], start, end, entry[1], bounds[idx + 1][1] if idx < n_meters - 1 else -1,
+             seeks[idx + 1] if idx < n_meters - 1 else -1) for idx, entry in enumerate(bounds)]
+
+
 def chunks(l, n):
     """ create list of chunks of size n from range l"""
     n = max(1, n)
@@ -19,8 +19,21 @@ import subprocess
 import json
 import os
 import csv
+import urllib.request
+import time
+import platform
+import tempfile
+import threading
+import gzip
+import bz2
+import lzma
 from nfstream import NFStreamer
+from nfstream.anonymizer import NFAnonymizer, anonymize_ip
+from nfstream.engine import create_engine
 from nfstream.plugins import SPLT, DHCP, FlowSlicer, MDNS
+from nfstream.utils import create_csv_file_path, build_pcap_index, load_pcap_index
+from psutil import net_if_addrs
+from benchmarks import generate_pcap
 
 
 def get_files_list(path):
@@ -68,6 +81,283 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(value_errors, 3)
         print("{}\t: \033[94mOK\033[0m".format(".Test source parameter".ljust(60, ' ')))
 
+    def test_multiple_interfaces_source(self):
+        print("\n----------------------------------------------------------------------")
+        interfaces = sorted(net_if_addrs().keys())
+        value_errors = 0
+        source = [[], [interfaces[0], interfaces[0]], [interfaces[0], "inexisting0"], ['tests/google_ssl.pcap'],
+                  [interfaces[0], 22]]
+        for x in source:
+            try:
+                for flow in NFStreamer(source=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        try:
+            NFStreamer(source=interfaces[:1], replay_speed=1)
+        except ValueError:
+            value_errors += 1
+        self.assertEqual(value_errors, 6)
+        self.assertEqual(NFStreamer(source=interfaces[:1]).source, interfaces[0])
+        if len(interfaces) > 1:
+            streamer = NFStreamer(source=interfaces[:2])
+            self.assertEqual(streamer.source, tuple(interfaces[:2]))
+            self.assertEqual(create_csv_file_path(None, streamer.source), "+".join(interfaces[:2]) + ".csv")
+        print("{}\t: \033[94mOK\033[0m".format(".Test multiple interfaces source".ljust(60, ' ')))
+
+    def test_stream_sources(self):
+        print("\n----------------------------------------------------------------------")
+        n_meters = int(os.getenv('MAX_NFMETERS', 0))
+
+        def flows_keys(source):
+            return sorted([(flow.src_ip, flow.src_port, flow.dst_ip, flow.dst_port, flow.protocol,
+                            flow.bidirectional_packets, flow.application_name)
+                           for flow in NFStreamer(source=source, n_meters=n_meters)])
+        with open('tests/teams.pcap', 'rb') as capture:
+            data = capture.read()
+        reference = flows_keys('tests/teams.pcap')
+        with tempfile.TemporaryDirectory() as directory:
+            for extension, compression in [(".gz", gzip), (".bz2", bz2), (".xz", lzma)]:
+                path = os.path.join(directory, "teams.pcap" + extension)
+                with compression.open(path, "wb") as compressed:
+                    compressed.write(data)
+                self.assertEqual(flows_keys(path), reference)
+            fifo = os.path.join(directory, "teams.fifo")
+            os.mkfifo(fifo)
+
+            def writer():
+                with open(fifo, "wb") as output:
+                    output.write(data)
+            writer_thread = threading.Thread(target=writer)
+            writer_thread.start()
+            self.assertEqual(flows_keys(fifo), reference)
+            writer_thread.join()
+            value_errors = 0
+            for x in [os.path.join(directory, "missing.pcap.gz"), os.path.join(directory, "teams.gz")]:
+                try:
+                    NFStreamer(source=x)
+                except ValueError:
+                    value_errors += 1
+            self.assertEqual(value_errors, 2)
+        print("{}\t: \033[94mOK\033[0m".format(".Test stream sources".ljust(60, ' ')))
+
+    def test_time_window_parameters(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        interface = list(net_if_addrs().keys())[0]
+        parameters = [('tests/google_ssl.pcap', {"time_window": "1h"}),
+                      ('tests/google_ssl.pcap', {"time_window": (1,)}),
+                      ('tests/google_ssl.pcap', {"time_window": (5, 1)}),
+                      ('tests/google_ssl.pcap', {"time_window": (True, None)}),
+                      ('tests/google_ssl.pcap', {"time_window": (-1, None)}),
+                      ('tests/upnp.pcap', {"time_window": (0, None)}),  # pcapng
+                      (interface, {"time_window": (0, None)}),
+                      ('tests/google_ssl.pcap', {"parallel_chunks": 1}),
+                      ('tests/upnp.pcap', {"parallel_chunks": True}),
+                      ('tests/google_ssl.pcap', {"parallel_chunks": True, "replay_speed": 1})]
+        for source, kwargs in parameters:
+            try:
+                NFStreamer(source=source, **kwargs)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 10)
+        print("{}\t: \033[94mOK\033[0m".format(".Test time window parameters".ljust(60, ' ')))
+
+    def test_pcap_index(self):
+        print("\n----------------------------------------------------------------------")
+
+        def flows_keys(streamer):
+            return sorted([(flow.src_ip, flow.src_port, flow.dst_ip, flow.dst_port, flow.protocol, flow.vlan_id,
+                           flow.bidirectional_packets, flow.bidirectional_first_seen_ms) for flow in streamer])
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "teams.pcap")
+            with open('tests/teams.pcap', 'rb') as capture, open(path, 'wb') as copy:
+                copy.write(capture.read())
+            index = build_pcap_index(path, 100)
+            self.assertTrue(os.path.isfile(path + ".nfidx"))
+            self.assertEqual(load_pcap_index(path), index)
+            self.assertEqual([entry[0] for entry in index["entries"]], list(range(0, index["packets"], 100)))
+            reference = flows_keys(NFStreamer(source=path, n_dissections=0, n_meters=1))
+            # Time window halves cover all packets and flows start within their window.
+            split = index["entries"][len(index["entries"]) // 2][2] / 1000
+            before = flows_keys(NFStreamer(source=path, n_dissections=0, n_meters=1, time_window=(None, split)))
+            after = flows_keys(NFStreamer(source=path, n_dissections=0, n_meters=1, time_window=(split, None)))
+            self.assertEqual(sum([flow[6] for flow in before + after]), sum([flow[6] for flow in reference]))
+            self.assertTrue(all([flow[7] < split * 1000 for flow in before]))
+            self.assertTrue(all([flow[7] >= split * 1000 for flow in after]))
+            # Flows crossing chunks boundaries are stitched: same flows as a sequential run.
+            streamer = NFStreamer(source=path, n_dissections=0, n_meters=3, parallel_chunks=True)
+            self.assertEqual(flows_keys(streamer), reference)
+        print("{}\t: \033[94mOK\033[0m".format(".Test pcap index".ljust(60, ' ')))
+
+    def test_memory_map(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        for x in [1, "True"]:
+            try:
+                NFStreamer(source='tests/google_ssl.pcap', memory_map=x)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 2)
+
+        def flows_keys(source, memory_map, bpf_filter=None):
+            return sorted([(flow.src_ip, flow.src_port, flow.dst_ip, flow.dst_port, flow.protocol,
+                            flow.bidirectional_packets, flow.bidirectional_bytes, flow.bidirectional_first_seen_ms,
+                            flow.application_name)
+                           for flow in NFStreamer(source=source, memory_map=memory_map, bpf_filter=bpf_filter)])
+        # Memory mapped reader (pcap and pcapng) meters the same flows as libpcap one.
+        for source in ['tests/teams.pcap', 'tests/upnp.pcap']:
+            self.assertEqual(flows_keys(source, True), flows_keys(source, False))
+        self.assertEqual(flows_keys('tests/teams.pcap', True, "udp"), flows_keys('tests/teams.pcap', False, "udp"))
+        # Truncated files: remaining records are read through libpcap once truncated record is met.
+        with tempfile.TemporaryDirectory() as directory:
+            for source in ['tests/teams.pcap', 'tests/upnp.pcap']:
+                path = os.path.join(directory, "truncated" + os.path.splitext(source)[1])
+                with open(source, 'rb') as capture:
+                    content = capture.read()
+                for cut in [10, 100]:
+                    with open(path, 'wb') as truncated:
+                        truncated.write(content[:-cut])
+                    self.assertEqual(flows_keys(path, True), flows_keys(path, False))
+                    self.assertEqual(flows_keys(path, True, "udp"), flows_keys(path, False, "udp"))
+        print("{}\t: \033[94mOK\033[0m".format(".Test memory map".ljust(60, ' ')))
+
+    def test_bounded_cache_parameters(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        parameters = [("max_flows", -1), ("max_flows", 1.5), ("max_flows", True), ("memory_budget", -1),
+                      ("memory_budget", "1GB"), ("eviction_policy", "lru"), ("eviction_policy", 0)]
+        for name, x in parameters:
+            try:
+                NFStreamer(source='tests/google_ssl.pcap', **{name: x})
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 7)
+        print("{}\t: \033[94mOK\033[0m".format(".Test bounded cache parameters".ljust(60, ' ')))
+
+    def test_bounded_cache(self):
+        print("\n----------------------------------------------------------------------")
+        reference = NFStreamer(source='tests/teams.pcap', n_dissections=0, n_meters=1).to_pandas()
+        for eviction_policy in ["oldest_idle", "smallest", "random"]:
+            streamer = NFStreamer(source='tests/teams.pcap', n_dissections=0, n_meters=1, max_flows=8,
+                                  eviction_policy=eviction_policy)
+            flows = streamer.to_pandas()
+            meter = streamer.metrics()["meters"][0]
+            self.assertLessEqual(meter["active_flows_peak"], 8)
+            self.assertGreater(meter["flows_expired_evicted"], 0)
+            self.assertEqual(meter["flows_expired_evicted"], len(flows[flows["expiration_id"] == 3]))
+            # Evicted flows are exported: no packet is lost.
+            self.assertEqual(flows["bidirectional_packets"].sum(), reference["bidirectional_packets"].sum())
+        streamer = NFStreamer(source='tests/teams.pcap', n_dissections=0, n_meters=1, memory_budget=64 * 1024)
+        flows = streamer.to_pandas()
+        meter = streamer.metrics()["meters"][0]
+        self.assertLess(meter["active_flows_peak"], reference.shape[0])
+        self.assertEqual(flows["bidirectional_packets"].sum(), reference["bidirectional_packets"].sum())
+        print("{}\t: \033[94mOK\033[0m".format(".Test bounded cache".ljust(60, ' ')))
+
+    def test_scan_protection_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        for x in [1, "True", None]:
+            try:
+                NFStreamer(source='tests/google_ssl.pcap', scan_protection=x)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 3)
+        print("{}\t: \033[94mOK\033[0m".format(".Test scan protection parameter".ljust(60, ' ')))
+
+    def test_scan_protection(self):
+        print("\n----------------------------------------------------------------------")
+        # Staging timeout is idle_timeout when shorter: promoted flows are then reference multi packets ones.
+        reference = NFStreamer(source='tests/skype.pcap', n_meters=1, idle_timeout=5).to_pandas()
+        streamer = NFStreamer(source='tests/skype.pcap', n_meters=1, idle_timeout=5, scan_protection=True)
+        flows = streamer.to_pandas()
+        meter = streamer.metrics()["meters"][0]
+        summaries = flows[flows["expiration_id"] == 4]
+        self.assertGreater(meter["flows_summarized"], 0)
+        self.assertEqual(meter["flows_staged"], meter["flows_promoted"] + meter["flows_summarized"])
+        self.assertEqual(meter["summary_flows"], summaries.shape[0])
+        self.assertEqual(meter["staged_flows"], 0)
+        # Summaries fold single packet flows of a same initiator.
+        self.assertLess(summaries.shape[0], meter["flows_summarized"])
+        self.assertEqual(summaries["bidirectional_packets"].sum(), meter["flows_summarized"])
+        self.assertEqual(summaries["dst_port"].max(), 0)
+        self.assertEqual(summaries["src_port"].max(), 0)
+        # Multi packets flows are exactly the flows of reference and no packet is lost.
+        self.assertEqual(flows[(flows["expiration_id"] != 4) & (flows["bidirectional_packets"] > 1)].shape[0],
+                         reference[reference["bidirectional_packets"] > 1].shape[0])
+        self.assertEqual(flows["bidirectional_packets"].sum(), reference["bidirectional_packets"].sum())
+        print("{}\t: \033[94mOK\033[0m".format(".Test scan protection".ljust(60, ' ')))
+
+    def test_tcp_linger_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        for x in [-1, 0.5, True, "1"]:
+            try:
+                NFStreamer(source='tests/google_ssl.pcap', tcp_linger=x)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 4)
+        print("{}\t: \033[94mOK\033[0m".format(".Test tcp linger parameter".ljust(60, ' ')))
+
+    def test_tcp_linger(self):
+        print("\n----------------------------------------------------------------------")
+        reference = NFStreamer(source='tests/443-curl.pcap', n_meters=1).to_pandas()
+        self.assertEqual(reference[reference["expiration_id"] == 2].shape[0], 0)
+        streamer = NFStreamer(source='tests/443-curl.pcap', n_meters=1, tcp_linger=1, statistical_analysis=True)
+        flows = streamer.to_pandas()
+        closed = flows[flows["expiration_id"] == 2]
+        self.assertGreater(closed.shape[0], 0)
+        self.assertEqual(streamer.metrics()["meters"][0]["flows_expired_closed"], closed.shape[0])
+        # Only TCP flows with both FINs or a RST are closed.
+        self.assertEqual(closed[closed["protocol"] != 6].shape[0], 0)
+        self.assertEqual(closed[(closed["bidirectional_rst_packets"] == 0) &
+                                ((closed["src2dst_fin_packets"] == 0) | (closed["dst2src_fin_packets"] == 0))].shape[0],
+                         0)
+        self.assertEqual(flows["bidirectional_packets"].sum(), reference["bidirectional_packets"].sum())
+        print("{}\t: \033[94mOK\033[0m".format(".Test tcp linger".ljust(60, ' ')))
+
+    def test_timeout_policies_parameters(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        parameters = [{"timeout_policies": []},
+                      {"timeout_policies": "dns"},
+                      {"timeout_policies": [{"port": 53}]},
+                      {"timeout_policies": [{"protocol": 17, "idle_timeout": -1}]},
+                      {"timeout_policies": [{"port": 53, "idle_timeout": 5}] * 65},
+                      {"timeout_policies": [{"application": "NotAProtocol", "idle_timeout": 5}]},
+                      {"timeout_policies": [{"application": "DNS", "idle_timeout": 5}], "n_dissections": 0}]
+        for kwargs in parameters:
+            try:
+                NFStreamer(source='tests/google_ssl.pcap', **kwargs)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 7)
+        print("{}\t: \033[94mOK\033[0m".format(".Test timeout policies parameters".ljust(60, ' ')))
+
+    def test_timeout_policies(self):
+        print("\n----------------------------------------------------------------------")
+        reference = NFStreamer(source='tests/skype.pcap', n_meters=1).to_pandas()
+        # Most specific policy applies: UDP flows are expired on each packet but DNS port ones.
+        flows = NFStreamer(source='tests/skype.pcap', n_meters=1,
+                           timeout_policies=[{"protocol": 17, "idle_timeout": 0},
+                                             {"protocol": 17, "port": 53, "idle_timeout": 120}]).to_pandas()
+        dns = (flows["protocol"] == 17) & ((flows["src_port"] == 53) | (flows["dst_port"] == 53))
+        reference_dns = (reference["protocol"] == 17) & ((reference["src_port"] == 53) |
+                                                         (reference["dst_port"] == 53))
+        self.assertEqual(flows[(flows["protocol"] == 17) & ~dns]["bidirectional_packets"].max(), 1)
+        self.assertEqual(flows[dns].shape[0], reference[reference_dns].shape[0])
+        self.assertEqual(flows[flows["protocol"] == 6].shape[0], reference[reference["protocol"] == 6].shape[0])
+        self.assertEqual(flows["bidirectional_packets"].sum(), reference["bidirectional_packets"].sum())
+        # Application policy applies once flow is classified and overrides port one.
+        flows = NFStreamer(source='tests/skype.pcap', n_meters=1,
+                           timeout_policies=[{"protocol": 17, "port": 53, "idle_timeout": 120},
+                                             {"application": "DNS", "idle_timeout": 0}]).to_pandas()
+        dns = (flows["protocol"] == 17) & ((flows["src_port"] == 53) | (flows["dst_port"] == 53))
+        self.assertGreater(flows[dns].shape[0], reference[reference_dns].shape[0])
+        self.assertEqual(flows["bidirectional_packets"].sum(), reference["bidirectional_packets"].sum())
+        print("{}\t: \033[94mOK\033[0m".format(".Test timeout policies".ljust(60, ' ')))
+
     def test_decode_tunnels_parameter(self):
         print("\n----------------------------------------------------------------------")
         value_errors = 0
@@ -237,6 +527,345 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(value_errors, 2)
         print("{}\t: \033[94mOK\033[0m".format(".Test performance_report parameter".ljust(60, ' ')))
 
+    def test_ip_anonymization_key_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        ip_anonymization_key = ["yes", b"short", bytes(33)]
+        for x in ip_anonymization_key:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', ip_anonymization_key=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 3)
+        # Prefix preserving: same subnet before anonymization implies same anonymized prefix.
+        key = bytes(range(32))
+        flows = [flow for flow in NFStreamer(source='tests/google_ssl.pcap', ip_anonymization_key=key,
+                                             n_meters=int(os.getenv('MAX_NFMETERS', 0)))]
+        self.assertEqual(len(flows), 1)
+        self.assertNotEqual(flows[0].src_ip, '172.31.3.224')
+        self.assertNotEqual(flows[0].dst_ip, '216.58.212.100')
+        self.assertEqual(flows[0].src_ip, [flow for flow in NFStreamer(source='tests/google_ssl.pcap',
+                                                                       ip_anonymization_key=key)][0].src_ip)
+        print("{}\t: \033[94mOK\033[0m".format(".Test ip_anonymization_key parameter".ljust(60, ' ')))
+
+    def test_metrics_callback_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        metrics_callback = ["yes", 1]
+        for x in metrics_callback:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', metrics_callback=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 2)
+        print("{}\t: \033[94mOK\033[0m".format(".Test metrics_callback parameter".ljust(60, ' ')))
+
+    def test_metrics(self):
+        print("\n----------------------------------------------------------------------")
+        snapshots = []
+        streamer_metrics = NFStreamer(source='tests/google_ssl.pcap', idle_timeout=0, metrics_callback=snapshots.append,
+                                      n_meters=int(os.getenv('MAX_NFMETERS', 0)))
+        flows = [flow for flow in streamer_metrics]
+        self.assertEqual(len(snapshots), 1)  # performance_report disabled: final snapshot only.
+        self.assertEqual(snapshots[-1], streamer_metrics.metrics())
+        meters = snapshots[-1]["meters"]
+        self.assertEqual(len(meters), streamer_metrics.n_meters)
+        self.assertEqual(snapshots[-1]["flows_expired"], len(flows))
+        self.assertEqual(sum([meter["flows_created"] for meter in meters]), 28)
+        self.assertEqual(sum([meter["flows_expired_idle"] for meter in meters]), 27)
+        self.assertEqual(sum([meter["flows_expired_end_of_capture"] for meter in meters]), 1)
+        self.assertEqual(sum([meter["active_flows"] for meter in meters]), 0)
+        self.assertEqual(sum([meter["packets_processed"] for meter in meters]), 28)
+        self.assertEqual(sum([meter["plugins_time_us"] for meter in meters]), 0)
+        print("{}\t: \033[94mOK\033[0m".format(".Test structured metrics".ljust(60, ' ')))
+
+    def test_memory_accounting(self):
+        print("\n----------------------------------------------------------------------")
+        streamer_memory = NFStreamer(source='tests/google_ssl.pcap', splt_analysis=10,
+                                     n_meters=int(os.getenv('MAX_NFMETERS', 0)))
+        flows = [flow for flow in streamer_memory]
+        self.assertEqual(len(flows), 1)
+        meters = streamer_memory.metrics()["meters"]
+        self.assertEqual(sum([meter["active_flows_peak"] for meter in meters]), 1)
+        self.assertGreater(max([meter["memory_c_flow_bytes"] for meter in meters]), 0)
+        self.assertEqual(max([meter["memory_splt_bytes"] for meter in meters]), 10 * (1 + 4 + 8))
+        self.assertGreater(max([meter["memory_python_flow_bytes"] for meter in meters]), 0)
+        self.assertGreater(max([meter["memory_cache_entry_bytes"] for meter in meters]), 0)
+        self.assertGreater(sum([meter["memory_peak_bytes"] for meter in meters]), 0)
+        self.assertEqual(sum([meter["memory_active_flows_bytes"] for meter in meters]), 0)  # All released.
+        print("{}\t: \033[94mOK\033[0m".format(".Test memory accounting".ljust(60, ' ')))
+
+    def test_object_pools(self):
+        print("\n----------------------------------------------------------------------")
+        streamer_pools = NFStreamer(source='tests/google_ssl.pcap', idle_timeout=0, splt_analysis=10,
+                                    n_meters=int(os.getenv('MAX_NFMETERS', 0)))
+        flows = [flow for flow in streamer_pools]
+        self.assertEqual(len(flows), 28)
+        meters = streamer_pools.metrics()["meters"]
+        for pool in ("flow", "ndpi_id", "splt"):  # All objects are released, a single empty slab is kept.
+            self.assertEqual(sum([meter["pool_{}_objects".format(pool)] for meter in meters]), 0)
+            self.assertEqual(max([meter["pool_{}_slabs".format(pool)] for meter in meters]), 1)
+        self.assertEqual(sum([meter["pool_slabs_allocated"] - meter["pool_slabs_released"] for meter in meters]),
+                         sum([meter["pool_flow_slabs"] + meter["pool_ndpi_id_slabs"] + meter["pool_splt_slabs"]
+                              for meter in meters]))
+        for flow in flows:
+            self.assertEqual(len(flow.splt_ps), 10)
+        print("{}\t: \033[94mOK\033[0m".format(".Test object pools".ljust(60, ' ')))
+
+    def test_metrics_address_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        metrics_address = [9100, "localhost", "localhost:port", "localhost:70000"]
+        for x in metrics_address:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', metrics_address=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 4)
+        print("{}\t: \033[94mOK\033[0m".format(".Test metrics_address parameter".ljust(60, ' ')))
+
+    def test_metrics_endpoint(self):
+        print("\n----------------------------------------------------------------------")
+        exposition = ""
+        for flow in NFStreamer(source='tests/google_ssl.pcap', metrics_address="127.0.0.1:29100",
+                               n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+            exposition = urllib.request.urlopen("http://127.0.0.1:29100/metrics").read().decode('utf-8')
+        self.assertIn("# TYPE nfstream_packets_processed_total counter", exposition)
+        self.assertIn('nfstream_meter_packets_processed_total{meter="0"}', exposition)
+        self.assertIn("# TYPE nfstream_active_flows gauge", exposition)
+        self.assertIn("nfstream_meters_processing_imbalance", exposition)
+        print("{}\t: \033[94mOK\033[0m".format(".Test metrics endpoint".ljust(60, ' ')))
+
+    def test_profiling_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        profiling = ["yes", -1, True]
+        for x in profiling:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', profiling=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 3)
+        print("{}\t: \033[94mOK\033[0m".format(".Test profiling parameter".ljust(60, ' ')))
+
+    def test_profiling(self):
+        print("\n----------------------------------------------------------------------")
+        streamer_profiling = NFStreamer(source='tests/google_ssl.pcap', profiling=1, udps=FlowSlicer(limit=100),
+                                        n_meters=int(os.getenv('MAX_NFMETERS', 0)))
+        for flow in streamer_profiling:
+            pass
+        profiling = streamer_profiling.metrics()["profiling"]
+        self.assertEqual(profiling["consume"]["samples"], 28)
+        self.assertEqual(profiling["get_flow_key"]["samples"], 28)
+        self.assertEqual(profiling["channel_put"]["samples"], 1)
+        self.assertEqual(profiling["0.FlowSlicer.on_init"]["samples"], 1)
+        self.assertEqual(profiling["0.FlowSlicer.on_update"]["samples"], 27)
+        self.assertEqual(profiling["0.FlowSlicer.on_expire"]["samples"], 1)
+        self.assertTrue(profiling["consume"]["p50_us"] <= profiling["consume"]["p99_us"])
+        self.assertNotIn("profiling", NFStreamer(source='tests/google_ssl.pcap').metrics())
+        print("{}\t: \033[94mOK\033[0m".format(".Test profiling".ljust(60, ' ')))
+
+    def test_replay_speed_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        replay_speed = ["yes", -1, True]
+        for x in replay_speed:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', replay_speed=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 3)
+        # Replay is checked against live sources whichever of source and replay_speed is set last.
+        interface = list(net_if_addrs().keys())[0]
+        streamer_replay = NFStreamer(source='tests/google_ssl.pcap', replay_speed=10)
+        with self.assertRaises(ValueError):
+            streamer_replay.source = interface
+        with self.assertRaises(ValueError):
+            streamer_replay.source = [interface]
+        streamer_live = NFStreamer(source=interface)
+        with self.assertRaises(ValueError):
+            streamer_live.replay_speed = 10
+        streamer_live.source = 'tests/google_ssl.pcap'
+        streamer_live.replay_speed = 10
+        streamer_live.replay_speed = 0
+        print("{}\t: \033[94mOK\033[0m".format(".Test replay_speed parameter".ljust(60, ' ')))
+
+    def test_replay(self):
+        print("\n----------------------------------------------------------------------")
+        streamer_replay = NFStreamer(source='tests/google_ssl.pcap', replay_speed=100,
+                                     n_meters=int(os.getenv('MAX_NFMETERS', 0)))
+        start = time.time()
+        flows = [flow for flow in streamer_replay]
+        self.assertEqual(len(flows), 1)
+        self.assertEqual(flows[0].bidirectional_packets, 28)
+        # Packets are timestamped at their replay arrival (wall clock, 100 times faster than recorded ones).
+        self.assertTrue(flows[0].bidirectional_first_seen_ms >= int(start * 1000))
+        self.assertTrue(flows[0].bidirectional_duration_ms < 1000)
+        meters = streamer_replay.metrics()["meters"]
+        self.assertEqual(sum([meter["packets_dropped_filtered_by_kernel"] for meter in meters]), 0)
+        print("{}\t: \033[94mOK\033[0m".format(".Test real-time replay".ljust(60, ' ')))
+
+    def test_dissected_protocols_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        dissected_protocols = ["TLS", [], [1], ["-"], ["NotAProtocol"], ["TLS", "-NotACategory"]]
+        for x in dissected_protocols:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', dissected_protocols=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 6)
+        print("{}\t: \033[94mOK\033[0m".format(".Test dissected_protocols parameter".ljust(60, ' ')))
+
+    def test_dissected_protocols(self):
+        print("\n----------------------------------------------------------------------")
+        for flow in NFStreamer(source='tests/google_ssl.pcap', dissected_protocols=["tls", "DNS"],
+                               n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+            self.assertEqual(flow.application_name.split(".")[0], "TLS")
+            self.assertEqual(flow.application_is_guessed, 0)
+        for flow in NFStreamer(source='tests/google_ssl.pcap', dissected_protocols=["-TLS"],
+                               n_meters=int(os.getenv('MAX_NFMETERS', 0))):
+            self.assertEqual(flow.application_is_guessed, 1)  # TLS dissector disabled: detection falls back to guess.
+        print("{}\t: \033[94mOK\033[0m".format(".Test dissected protocols selection".ljust(60, ' ')))
+
+    def test_service_cache_parameters(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        service_cache_size = [-1, "yes", True, 2**32]
+        for x in service_cache_size:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', service_cache_size=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        for x in [1, "yes"]:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', service_cache_verify=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 6)
+        print("{}\t: \033[94mOK\033[0m".format(".Test service cache parameters".ljust(60, ' ')))
+
+    def test_service_cache(self):
+        print("\n----------------------------------------------------------------------")
+        n_meters = int(os.getenv('MAX_NFMETERS', 0))
+        names = [flow.application_name for flow in NFStreamer(source='tests/wechat.pcap', n_meters=n_meters)]
+        # Verification mode: flows are still dissected and cached detections are compared to dissection results.
+        streamer_verify = NFStreamer(source='tests/wechat.pcap', service_cache_size=1024, service_cache_verify=True,
+                                     n_meters=n_meters)
+        self.assertEqual([flow.application_name for flow in streamer_verify], names)
+        meters = streamer_verify.metrics()["meters"]
+        hits = sum([meter["service_cache_hits"] for meter in meters])
+        self.assertGreater(hits, 0)
+        self.assertEqual(sum([meter["service_cache_verified"] for meter in meters]), hits)
+        # Classification mode: hits are classified without dissection.
+        streamer_cache = NFStreamer(source='tests/wechat.pcap', service_cache_size=1024, n_meters=n_meters)
+        self.assertEqual(len([flow for flow in streamer_cache]), len(names))
+        meters = streamer_cache.metrics()["meters"]
+        self.assertGreater(sum([meter["service_cache_hits"] for meter in meters]), 0)
+        self.assertEqual(sum([meter["service_cache_verified"] for meter in meters]), 0)
+        print("{}\t: \033[94mOK\033[0m".format(".Test service cache".ljust(60, ' ')))
+
+    def test_host_table_size_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        host_table_size = [-1, "yes", True, 2**32]
+        for x in host_table_size:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', host_table_size=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 4)
+        print("{}\t: \033[94mOK\033[0m".format(".Test host_table_size parameter".ljust(60, ' ')))
+
+    def test_host_table(self):
+        print("\n----------------------------------------------------------------------")
+        n_meters = int(os.getenv('MAX_NFMETERS', 0))
+        flows_count = len([flow for flow in NFStreamer(source='tests/wechat.pcap', n_meters=n_meters)])
+        streamer_hosts = NFStreamer(source='tests/wechat.pcap', host_table_size=1024, n_meters=n_meters)
+        self.assertEqual(len([flow for flow in streamer_hosts]), flows_count)
+        meters = streamer_hosts.metrics()["meters"]
+        self.assertGreater(sum([meter["host_table_hits"] for meter in meters]), 0)  # Endpoints shared across flows.
+        for meter in meters:
+            self.assertLessEqual(meter["host_table_hosts"], 1024)
+            self.assertEqual(meter["pool_ndpi_id_objects"], meter["host_table_hosts"])  # Only table hosts remain.
+        # A table smaller than the active endpoints set falls back to private id structures.
+        streamer_hosts = NFStreamer(source='tests/wechat.pcap', host_table_size=1, n_meters=n_meters)
+        self.assertEqual(len([flow for flow in streamer_hosts]), flows_count)
+        for meter in streamer_hosts.metrics()["meters"]:
+            self.assertLessEqual(meter["host_table_hosts"], 1)
+        print("{}\t: \033[94mOK\033[0m".format(".Test host table".ljust(60, ' ')))
+
+    def test_fanout_hash_parameter(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        fanout_hash = ["toeplitz", 1, None]
+        for x in fanout_hash:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', fanout_hash=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 3)
+        print("{}\t: \033[94mOK\033[0m".format(".Test fanout_hash parameter".ljust(60, ' ')))
+
+    def test_fanout_hash(self):
+        print("\n----------------------------------------------------------------------")
+
+        def flows_keys(streamer):
+            return sorted([(flow.src_ip, flow.src_port, flow.dst_ip, flow.dst_port, flow.protocol, flow.vlan_id,
+                            flow.bidirectional_packets) for flow in streamer])
+        reference = flows_keys(NFStreamer(source='tests/teams.pcap', n_dissections=0, n_meters=1))
+        for fanout_hash in ["symmetric", "legacy"]:
+            # Both directions of each flow must be dispatched to the same meter.
+            streamer = NFStreamer(source='tests/teams.pcap', n_dissections=0, n_meters=3, fanout_hash=fanout_hash)
+            self.assertEqual(flows_keys(streamer), reference)
+            snapshot = streamer.metrics()
+            self.assertEqual(sum([meter["packets_processed"] for meter in snapshot["meters"]]),
+                             sum([flow[-1] for flow in reference]))
+            self.assertGreaterEqual(snapshot["processing_imbalance"], 1.0)
+            self.assertLessEqual(snapshot["processing_imbalance"], 3.0)
+        print("{}\t: \033[94mOK\033[0m".format(".Test fanout hash".ljust(60, ' ')))
+
+    def test_live_capture_parameters(self):
+        print("\n----------------------------------------------------------------------")
+        value_errors = 0
+        parameters = [("fanout_mode", "fifo"), ("fanout_mode", 0), ("fanout_group_id", -1),
+                      ("fanout_group_id", 65536), ("fanout_group_id", True), ("buffer_size", -1),
+                      ("buffer_size", 2**31), ("buffer_size", "2MB"), ("immediate_mode", 1), ("poll_timeout", 0),
+                      ("poll_timeout", 1.5), ("poll_timeout", False)]
+        for name, x in parameters:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', **{name: x}):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        for x in ["af_xdp", 1]:
+            try:
+                for flow in NFStreamer(source='tests/google_ssl.pcap', capture_backend=x):
+                    print(flow)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 14)
+        # Unset fanout groups are allocated by kernel on live capture.
+        self.assertIsNone(NFStreamer(source='tests/google_ssl.pcap').fanout_group_id)
+        self.assertEqual(NFStreamer(source='tests/google_ssl.pcap', fanout_group_id=42).fanout_group_id, 42)
+        # Live capture options are ignored on offline sources.
+        flows = [flow for flow in NFStreamer(source='tests/google_ssl.pcap', fanout_mode="cpu", buffer_size=2**24,
+                                             immediate_mode=True, poll_timeout=10,
+                                             capture_backend="packet_mmap" if platform.system() == "Linux"
+                                             else "pcap")]
+        self.assertEqual(len(flows), len([flow for flow in NFStreamer(source='tests/google_ssl.pcap')]))
+        print("{}\t: \033[94mOK\033[0m".format(".Test live capture parameters".ljust(60, ' ')))
+
     def test_expiration_management(self):
         print("\n----------------------------------------------------------------------")
         # Idle expiration
@@ -383,6 +1012,13 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(df_anon.shape[1], df.shape[1])
         self.assertEqual(df_anon['src_ip'].nunique(), df['src_ip'].nunique())
         self.assertEqual(df_anon['dst_ip'].nunique(), df['dst_ip'].nunique())
+        df_anon_short = NFStreamer(source='tests/steam.pcap',
+                                   statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                                   n_dissections=20).to_pandas(columns_to_anonymize=["src_ip", "dst_mac"],
+                                                               anonymization_digest_size=8)
+        self.assertEqual(df_anon_short['src_ip'].nunique(), df['src_ip'].nunique())
+        self.assertEqual(df_anon_short['dst_mac'].nunique(), df['dst_mac'].nunique())
+        self.assertTrue(all(df_anon_short['src_ip'].str.len() == 16))
 
         total_flows = NFStreamer(source='tests/steam.pcap',
                                  statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
@@ -400,6 +1036,102 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(total_flows_anon, df_anon.shape[0])
         print("{}\t: \033[94mOK\033[0m".format(".Test export interfaces".ljust(60, ' ')))
 
+    def test_anonymizer(self):
+        print("\n----------------------------------------------------------------------")
+        anonymizer = NFAnonymizer(cols_names=["src_ip"], digest_size=16)
+        column = ["10.0.0.1", "10.0.0.2", None, "10.0.0.1"]
+        anonymized = anonymizer.process_column(column)
+        self.assertEqual(anonymized[0], anonymized[3])
+        self.assertNotEqual(anonymized[0], anonymized[1])
+        self.assertIsNone(anonymized[2])
+        self.assertEqual(len(anonymized[0]), 32)
+        self.assertEqual(anonymized, anonymizer.process_column(column))
+        value_errors = 0
+        for x in [0, 65, "short", True]:
+            try:
+                NFAnonymizer(cols_names=["src_ip"], digest_size=x)
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 4)
+        # Secret is random here (reference vectors are checked by Crypto-PAn test), we check prefix preservation.
+        anonymizer = NFAnonymizer(cols_names=["src_ip"], prefix_preserving=True)
+        anonymized = anonymizer.process_column(["10.0.0.1", "10.0.0.2", "11.0.0.1", "00:0e:8e:4d:b4:a8"])
+        self.assertEqual(anonymized[0].split(".")[:3], anonymized[1].split(".")[:3])
+        self.assertNotEqual(anonymized[0], anonymized[1])
+        self.assertNotEqual(anonymized[0].split(".")[0], anonymized[2].split(".")[0])
+        self.assertEqual(len(anonymized[3]), 128)  # non IP values fall back to blake2b
+        print("{}\t: \033[94mOK\033[0m".format(".Test anonymizer".ljust(60, ' ')))
+
+    def test_crypto_pan(self):
+        print("\n----------------------------------------------------------------------")
+        # Crypto-PAn reference key and vectors (IPv4 from original implementation, IPv6 from its IPv6 extension).
+        key = bytes([21, 34, 23, 141, 51, 164, 207, 128, 19, 10, 91, 22, 73, 144, 125, 16,
+                     216, 152, 143, 131, 121, 121, 101, 39, 98, 87, 76, 45, 42, 132, 34, 2])
+        vectors = {"128.11.68.132": "135.242.180.132",
+                   "129.118.74.4": "134.136.186.123",
+                   "130.132.252.244": "133.68.164.234",
+                   "141.223.7.43": "141.167.8.160",
+                   "152.163.225.39": "151.140.114.167",
+                   "156.29.3.236": "147.225.12.42",
+                   "::1": "78ff:f001:9fc0:20df:8380:b1f1:704:ed",
+                   "::2": "78ff:f001:9fc0:20df:8380:b1f1:704:ef",
+                   "::ffff": "78ff:f001:9fc0:20df:8380:b1f1:704:f838",
+                   "2001:db8::1": "4401:2bc:603f:d91d:27f:ff8e:e6f1:dc1e",
+                   "2001:db8::2": "4401:2bc:603f:d91d:27f:ff8e:e6f1:dc1c"}
+        ffi, lib = create_engine()
+        ip_anonymizer = lib.anonymizer_init(key, 64)
+        self.assertNotEqual(ip_anonymizer, ffi.NULL)
+        for _ in range(2):  # Second pass is served from prefix caches.
+            for ip, anonymized in vectors.items():
+                self.assertEqual(anonymize_ip(ffi, lib, ip_anonymizer, ip), anonymized)
+        self.assertIsNone(anonymize_ip(ffi, lib, ip_anonymizer, "00:0e:8e:4d:b4:a8"))
+        lib.anonymizer_cleanup(ip_anonymizer)
+        ffi.dlclose(lib)
+        print("{}\t: \033[94mOK\033[0m".format(".Test Crypto-PAn reference vectors".ljust(60, ' ')))
+
+    def test_sharded_export(self):
+        print("\n----------------------------------------------------------------------")
+        total_flows = NFStreamer(source='tests/steam.pcap',
+                                 statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                                 n_dissections=20).to_csv()
+        df = pd.read_csv('tests/steam.pcap.csv')
+        os.remove('tests/steam.pcap.csv')
+        total_sharded_flows = NFStreamer(source='tests/steam.pcap',
+                                         statistical_analysis=True, n_meters=int(os.getenv('MAX_NFMETERS', 0)),
+                                         n_dissections=20).to_csv(shard_per_meter=True)
+        with open('tests/steam.pcap.manifest.json') as f:
+            manifest = json.load(f)
+        df_sharded = pd.concat([pd.read_csv(shard["path"]) for shard in manifest["shards"]])
+        for shard in manifest["shards"]:
+            os.remove(shard["path"])
+        os.remove('tests/steam.pcap.manifest.json')
+        self.assertEqual(total_flows, total_sharded_flows)
+        self.assertEqual(manifest["flows"], total_sharded_flows)
+        self.assertEqual(manifest["columns"], list(df.columns))
+        self.assertEqual(df_sharded.shape[0], df.shape[0])
+        self.assertEqual(df_sharded['bidirectional_bytes'].sum(), df['bidirectional_bytes'].sum())
+        value_errors = 0
+        for x in [(0, "yes"), (10, True)]:
+            try:
+                NFStreamer(source='tests/steam.pcap').to_csv(flows_per_file=x[0], shard_per_meter=x[1])
+            except ValueError:
+                value_errors += 1
+        self.assertEqual(value_errors, 2)
+        print("{}\t: \033[94mOK\033[0m".format(".Test sharded export".ljust(60, ' ')))
+
+    def test_synthetic_traffic(self):
+        print("\n----------------------------------------------------------------------")
+        for tunnel in ["none", "gtp", "ipip"]:
+            traffic = generate_pcap('tests/synthetic.pcap', 100, 10, ipv6_ratio=0.5, udp_ratio=0.5, tunnel=tunnel)
+            flows = [flow for flow in NFStreamer(source='tests/synthetic.pcap', n_dissections=0,
+                                                 n_meters=int(os.getenv('MAX_NFMETERS', 0)))]
+            os.remove('tests/synthetic.pcap')
+            self.assertEqual(len(flows), traffic["flows"])
+            self.assertEqual(sum([flow.bidirectional_packets for flow in flows]), traffic["packets"])
+            self.assertEqual(len([flow for flow in flows if flow.ip_version == 6]),
+                             len([flow for flow in flows if flow.ip_version == 6 and flow.src_ip.startswith("fd00")]))
+        print("{}\t: \033[94mOK\033[0m".format(".Test synthetic traffic".ljust(60, ' ')))
+
     def test_bpf(self):
         print("\n----------------------------------------------------------------------")
         streamer_test = NFStreamer(source='tests/facebook.pcap',